@@ -24,11 +24,27 @@ from pyxsim.spectral_models import \
 
 from pyxsim.responses import \
     AuxiliaryResponseFile, \
-    RedistributionMatrixFile
+    RedistributionMatrixFile, \
+    GaussianPSF, TabulatedPSF, \
+    VignettingTable
 
 from pyxsim.instruments import \
     InstrumentSimulator, \
     ACIS_I, ACIS_S, \
     XRS_Imager, XRS_Calorimeter, \
     Hitomi_SXS, Athena_WFI, \
-    Athena_XIFU
+    Athena_XIFU, ChipLayout, \
+    ACIS_I_chips, ACIS_S_chips, \
+    Athena_WFI_chips
+
+from pyxsim.light_cone import \
+    LightCone
+
+from pyxsim.light_curves import \
+    LightCurve
+
+from pyxsim.regions import \
+    CircleRegion, AnnulusRegion, \
+    BoxRegion, EllipseRegion, \
+    PolygonRegion, parse_ds9_region, \
+    UnsupportedRegion
@@ -1,7 +1,7 @@
 import numpy as np
 cimport numpy as np
 cimport cython
-from libc.math cimport erf
+from libc.math cimport erf, sqrt
     
 @cython.cdivision(True)
 @cython.boundscheck(False)
@@ -28,3 +28,32 @@ def broaden_lines(np.ndarray[np.float64_t, ndim=1] E0,
         for j in range(m-1):
             vec[j] = vec[j] + (cdf[j+1] - cdf[j])*amp[i]
     return vec
+
+@cython.cdivision(True)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def doppler_shift(double[:] energy, np.int64_t[:] idxs, np.int64_t[:] cells,
+                  double[:] vx, double[:] vy, double[:] vz,
+                  double nx, double ny, double nz, double scale_factor,
+                  double[:] eobs):
+    """
+    Compute the observed energies *eobs* of the photons with indices *idxs*
+    into *energy*, which belong to the cells with indices *cells*, in a
+    single pass. The line-of-sight velocity of each cell is projected onto
+    the direction (nx, ny, nz), which must be scaled so that the projected
+    velocity is in units of the speed of light, and the energies are
+    multiplied by the relativistic Doppler factor and the *scale_factor*
+    for the redshift or distance. The loop does not hold the GIL, so
+    slices of the photons may be shifted in separate threads.
+    """
+    cdef Py_ssize_t i, n
+    cdef np.int64_t c
+    cdef double beta
+
+    n = idxs.shape[0]
+
+    with nogil:
+        for i in range(n):
+            c = cells[i]
+            beta = -(vx[c]*nx + vy[c]*ny + vz[c]*nz)
+            eobs[i] = energy[idxs[i]]*scale_factor*sqrt((1.0-beta)/(1.0+beta))
@@ -11,19 +11,79 @@ except ImportError:
     from yt.utilities.fits_image import assert_same_wcs
 from yt.utilities.parallel_tools.parallel_analysis_interface import \
     parallel_root_only
-from yt.units.yt_array import YTQuantity, YTArray, uconcatenate
+from yt.units.yt_array import YTQuantity, YTArray
 from yt.utilities.on_demand_imports import _astropy
 import h5py
-from pyxsim.utils import force_unicode, validate_parameters, parse_value
+from pyxsim.utils import force_unicode, validate_parameters, parse_value, \
+    create_h5_dataset, h5_file_version, h5_chunk_size, manifest_filename, \
+    shard_filename, write_manifest, read_manifest
 from pyxsim.responses import RedistributionMatrixFile
+from pyxsim.spectral_models import TBabsModel
+from pyxsim.regions import parse_ds9_region, EventIndex, UnsupportedRegion
+from pyxsim.light_curves import LightCurve
+from yt.utilities.physical_ratios import erg_per_keV
 import os
+import itertools
+
+# The schema of the event columns, giving the type each column is stored as
+# and the units which are attached to it when it is accessed through
+# EventList.__getitem__. Columns which are not in the schema are stored
+# as they are given.
+event_schema = {"xpix": ("float64", None),
+                "ypix": ("float64", None),
+                "eobs": ("float64", "keV"),
+                "xsky": ("float64", "degree"),
+                "ysky": ("float64", "degree"),
+                "time": ("float64", None),
+                "PI": ("int64", None),
+                "PHA": ("int64", None)}
+
+def _to_column(key, value):
+    dtype, units = event_schema.get(key, (None, None))
+    if isinstance(value, YTArray):
+        if units is not None:
+            value = value.in_units(units)
+        value = value.d
+    return np.ascontiguousarray(value, dtype=dtype)
+
+class EventColumns(dict):
+    """
+    A dictionary of the columns of an :class:`~pyxsim.event_list.EventList`,
+    which are stored as plain contiguous arrays with the types given by the
+    schema. Columns with units are converted to the units of the schema and
+    stripped of them when they are set.
+    """
+    def __init__(self, columns=None):
+        dict.__init__(self)
+        if columns is not None:
+            self.update(columns)
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, _to_column(key, value))
+
+    def update(self, columns):
+        for key, value in dict(columns).items():
+            self[key] = value
+
+    def setdefault(self, key, value=None):
+        if key not in self:
+            self[key] = value
+        return dict.__getitem__(self, key)
+
+    def copy(self):
+        return EventColumns(self)
 
 class EventList(object):
 
     def __init__(self, events, parameters, wcs=None):
+        if not isinstance(events, EventColumns):
+            events = EventColumns(events)
         self.events = events
         self.parameters = parameters
-        self.num_events = events["xpix"].shape[0]
+        if "xpix" in events:
+            self.num_events = events["xpix"].shape[0]
+        else:
+            self.num_events = len(next(iter(events.values())))
         if wcs is None:
             self.wcs = _astropy.pywcs.WCS(naxis=2)
             self.wcs.wcs.crpix = parameters["pix_center"]
@@ -33,12 +93,14 @@ class EventList(object):
             self.wcs.wcs.cunit = ["deg"]*2
         else:
             self.wcs = wcs
+        self._index = None
 
     @classmethod
     def create_empty_list(cls, exp_time, area, wcs, parameters=None):
         events = {"xpix": np.array([]),
                   "ypix": np.array([]),
-                  "eobs": YTArray([], "keV")}
+                  "eobs": YTArray([], "keV"),
+                  "time": np.array([])}
         if parameters is None:
             parameters = {}
         parameters["ExposureTime"] = parse_value(exp_time, "s")
@@ -64,9 +126,24 @@ class EventList(object):
         if key not in self.events:
             if key == "xsky" or key == "ysky":
                 x,y = self.wcs.wcs_pix2world(self.events["xpix"], self.events["ypix"], 1)
-                self.events["xsky"] = YTArray(x, "degree")
-                self.events["ysky"] = YTArray(y, "degree")
-        return self.events[key]
+                self.events["xsky"] = x
+                self.events["ysky"] = y
+        v = self.events[key]
+        units = event_schema.get(key, (None, None))[1]
+        if units is None:
+            return v
+        return YTArray(v, units)
+
+    def clear_sky_coords(self):
+        """
+        Remove the sky coordinates and the spatial index of the events, if they
+        have been computed, so that they are recomputed from the pixel coordinates
+        when next asked for. Must be called whenever the pixel coordinates are
+        modified.
+        """
+        self.events.pop("xsky", None)
+        self.events.pop("ysky", None)
+        self._index = None
 
     def __repr__(self):
         return self.events.__repr__()
@@ -77,22 +154,45 @@ class EventList(object):
     def __add__(self, other):
         assert_same_wcs(self.wcs, other.wcs)
         validate_parameters(self.parameters, other.parameters)
+        # The sky coordinates are only kept if both lists have them
+        keys1 = set(self.keys())
+        keys2 = set(other.keys())
+        if keys1-set(["xsky", "ysky"]) != keys2-set(["xsky", "ysky"]):
+            raise RuntimeError("The two EventLists do not have the same fields!")
         events = {}
-        for item1, item2 in zip(self.items(), other.items()):
-            k1, v1 = item1
-            k2, v2 = item2
-            events[k1] = uconcatenate([v1,v2])
+        for key in keys1 & keys2:
+            events[key] = np.concatenate([self.events[key], other.events[key]])
         return EventList(events, self.parameters)
 
+    def select(self, selection):
+        """
+        Return a new :class:`~pyxsim.event_list.EventList` with only the events
+        in *selection*, which may be a boolean mask, an array of indices, or a
+        slice. A boolean mask is converted to indices only once for all of the
+        columns, and selecting a slice returns views of the columns of this
+        list without copying them.
+        """
+        if not isinstance(selection, slice):
+            selection = np.asarray(selection)
+            if selection.dtype == np.bool_:
+                selection = np.flatnonzero(selection)
+        events = EventColumns()
+        for key, v in self.events.items():
+            if isinstance(selection, slice):
+                events[key] = v[selection]
+            else:
+                events[key] = v.take(selection)
+        return EventList(events, self.parameters.copy(), wcs=self.wcs)
+
     def add_point_sources(self, positions, energy_bins, spectra,
-                          prng=None, absorb_model=None):
+                          prng=None, absorb_model=None, light_curve=None):
         r"""
         Add point source events to an :class:`~pyxsim.event_list.EventList`.
         Returns a new :class:`~pyxsim.event_list.EventList`.
 
         Parameters
         ----------
-        positions : array of source positions, shape 2xN
+        positions : array of source positions, shape Nx2
             The positions of the point sources in RA, Dec, where N is the
             number of point sources. Coordinates should be in degrees.
         energy_bins : :class:`~yt.units.yt_array.YTArray` with units of keV, shape M+1
@@ -107,34 +207,276 @@ class EventList(object):
             test. Default is the :mod:`numpy.random` module.
         absorb_model : :class:`~pyxsim.spectral_models.AbsorptionModel` 
             A model for foreground galactic absorption.
+        light_curve : :class:`~pyxsim.light_curves.LightCurve` or list of them, optional
+            The light curve of the sources, or a list of the light curves of each source
+            (None for a constant source), which the times of the events are drawn from.
+            If not set, the times of the events are uniform over the exposure.
+        """
+        positions = np.asarray(positions, dtype="float64").reshape(-1, 2)
+        spectra = np.array([np.asarray(spectrum) for spectrum in ensure_list(spectra)])
+        return self.add_point_source_catalog(positions[:,0], positions[:,1], energy_bins,
+                                             spectra, prng=prng, absorb_model=absorb_model,
+                                             light_curve=light_curve)
+
+    def add_point_source_catalog(self, ra, dec, energy_bins, spectra, fluxes=None,
+                                 prng=None, absorb_model=None, light_curve=None):
+        r"""
+        Add events from a catalog of point sources to an
+        :class:`~pyxsim.event_list.EventList`. The numbers of events for all of
+        the sources are drawn at once, so this is much faster than adding many
+        point sources one at a time. Returns a new :class:`~pyxsim.event_list.EventList`.
+
+        Parameters
+        ----------
+        ra : array_like, shape N
+            The right ascensions of the point sources in degrees.
+        dec : array_like, shape N
+            The declinations of the point sources in degrees.
+        energy_bins : :class:`~yt.units.yt_array.YTArray` with units of keV, shape M+1
+            The edges of the energy bins for the spectra, where M is the number of
+            bins
+        spectra : :class:`~yt.units.yt_array.YTArray` with units of photons/s/cm**2, shape NxM or M
+            If *fluxes* is not set, the spectra of the N point sources. Otherwise, the
+            spectral shape shared by all of the sources, which is normalized to the
+            source fluxes.
+        fluxes : :class:`~yt.units.yt_array.YTArray` with units of photons/s/cm**2, shape N, optional
+            The photon fluxes of the point sources, if they share a spectral shape.
+        prng : :class:`~numpy.random.RandomState` object or :mod:`numpy.random`, optional
+            A pseudo-random number generator. Typically will only be specified
+            if you have a reason to generate the same set of random numbers, such as for a
+            test. Default is the :mod:`numpy.random` module.
+        absorb_model : :class:`~pyxsim.spectral_models.AbsorptionModel` 
+            A model for foreground galactic absorption.
+        light_curve : :class:`~pyxsim.light_curves.LightCurve` or list of them, optional
+            The light curve of the sources, or a list of the light curves of each source
+            (None for a constant source), which the times of the events are drawn from.
+            If not set, the times of the events are uniform over the exposure.
         """
         if prng is None:
             prng = np.random
 
-        spectra = ensure_list(spectra)
-        positions = ensure_list(positions)
+        ra = np.atleast_1d(np.asarray(ra, dtype="float64"))
+        dec = np.atleast_1d(np.asarray(dec, dtype="float64"))
+        ebins = np.asarray(energy_bins, dtype="float64")
+        spectra = np.asarray(spectra, dtype="float64")
+
+        if fluxes is None:
+            spectra = np.atleast_2d(spectra)
+            rates = spectra.sum(axis=1)
+        else:
+            rates = np.atleast_1d(np.asarray(fluxes, dtype="float64"))
+
+        if rates.size != ra.size or dec.size != ra.size:
+            raise ValueError("The number of positions does not match the number of spectra or fluxes!")
+
+        exposure = float(self.parameters["ExposureTime"])*float(self.parameters["Area"])
+        num_events = prng.poisson(lam=exposure*rates)
+        src = np.repeat(np.arange(ra.size), num_events)
 
-        x = [self.events["xpix"]]
-        y = [self.events["ypix"]]
-        e = [self.events["eobs"]]
+        if fluxes is None:
+            eobs = _sample_spectra(ebins, spectra, src, prng)
+        else:
+            eobs = _sample_spectrum(ebins, spectra, src.size, prng)
 
-        for pos, spectrum in zip(positions, spectra):
-            eobs = self._add_events(energy_bins, spectrum, prng, absorb_model)
-            xpix, ypix = self.wcs.wcs_world2pix(pos[0], pos[1], 1)
-            ne = len(eobs)
-            x.append([xpix]*ne)
-            y.append([ypix]*ne)
-            e.append(eobs)
+        # Each source position is transformed to pixel coordinates only once
+        xpix, ypix = self.wcs.wcs_world2pix(ra, dec, 1)
+
+        return self._add_source_events(xpix, ypix, src, eobs, prng, absorb_model,
+                                       light_curve=light_curve)
+
+    def add_point_source_population(self, flux_limits=(1.0e-17, 1.0e-12),
+                                    flux_norm=1.5e16, flux_break=1.0e-14,
+                                    slopes=(1.6, 2.5), flux_band=(0.5, 2.0),
+                                    photon_index=(1.9, 0.2), log_nH=None,
+                                    energy_range=(0.1, 10.0), prng=None,
+                                    absorb_model=None, return_sources=False):
+        r"""
+        Add events from a randomly drawn population of extragalactic point sources,
+        such as the AGN in a deep field, to an :class:`~pyxsim.event_list.EventList`.
+        The source fluxes are drawn from a broken power-law logN-logS,
+
+        .. math::
+
+            \frac{dN}{dS} = K\left(\frac{S}{S_b}\right)^{-\beta}
+
+        with :math:`\beta = \beta_1` below the break flux :math:`S_b` and :math:`\beta = \beta_2`
+        above it. The sources have absorbed power-law spectra, and are placed uniformly
+        over the footprint of the event list. Returns a new
+        :class:`~pyxsim.event_list.EventList`.
+
+        Parameters
+        ----------
+        flux_limits : tuple of floats, optional
+            The minimum and maximum source flux in erg/s/cm**2 in the *flux_band*.
+        flux_norm : float, optional
+            The normalization *K* of the differential logN-logS, in units of
+            deg**-2 (erg/s/cm**2)**-1.
+        flux_break : float, optional
+            The break flux :math:`S_b` in erg/s/cm**2.
+        slopes : tuple of floats, optional
+            The slopes :math:`(\beta_1, \beta_2)` of the differential logN-logS below and
+            above the break flux. The defaults are roughly representative of AGN in the
+            0.5-2 keV band.
+        flux_band : tuple of floats, optional
+            The energy band in keV in which the source fluxes are defined.
+        photon_index : tuple of floats, optional
+            The mean and standard deviation of the normal distribution of the photon
+            indices of the source power-law spectra.
+        log_nH : tuple of floats, optional
+            The mean and standard deviation of the normal distribution of the logarithm
+            of the intrinsic column densities of the sources, in cm**-2. The intrinsic
+            absorption is applied in the observer frame using the TBabs cross section.
+            Default is no intrinsic absorption.
+        energy_range : tuple of floats, optional
+            The energy range in keV of the events which are generated.
+        prng : :class:`~numpy.random.RandomState` object or :mod:`numpy.random`, optional
+            A pseudo-random number generator. Typically will only be specified
+            if you have a reason to generate the same set of random numbers, such as for a
+            test. Default is the :mod:`numpy.random` module.
+        absorb_model : :class:`~pyxsim.spectral_models.AbsorptionModel` 
+            A model for foreground galactic absorption.
+        return_sources : boolean, optional
+            If True, also return a dictionary of the positions, fluxes, photon indices,
+            and column densities of the sources.
+
+        Examples
+        --------
+        >>> prng = np.random.RandomState(24)
+        >>> new_events = events.add_point_source_population(prng=prng,
+        ...                                                 log_nH=(21.5, 1.0))
+        """
+        if prng is None:
+            prng = np.random
+
+        # Draw the number of sources over the footprint of the event list,
+        # and then their fluxes from the inverse CDFs of the two branches of
+        # the logN-logS
+        smin, smax = flux_limits
+        nx = 2.*self.parameters["pix_center"][0]-1.
+        ny = 2.*self.parameters["pix_center"][1]-1.
+        solid_angle = nx*ny*float(self.parameters["dtheta"])**2
+        branches = [(smin, min(smax, flux_break), slopes[0]),
+                    (max(smin, flux_break), smax, slopes[1])]
+        nbranch = [solid_angle*flux_norm*flux_break *
+                   _power_law_integral(s0/flux_break, s1/flux_break, beta)
+                   if s1 > s0 else 0.0 for s0, s1, beta in branches]
+        num_sources = prng.poisson(lam=sum(nbranch))
+        faint = prng.uniform(size=num_sources)*sum(nbranch) < nbranch[0]
+        flux = np.zeros(num_sources)
+        for i, (s0, s1, beta) in enumerate(branches):
+            idxs = faint if i == 0 else ~faint
+            flux[idxs] = _power_law_inverse_cdf(prng.uniform(size=idxs.sum()), s0, s1, beta)
+
+        mylog.info("Adding %d point sources." % num_sources)
+
+        gamma = prng.normal(loc=photon_index[0], scale=photon_index[1], size=num_sources)
+
+        # Convert the energy fluxes in the flux band to photon fluxes in the
+        # energy range of the events
+        emin, emax = energy_range
+        e_flux = _power_law_integral(flux_band[0], flux_band[1], gamma-1.)*erg_per_keV
+        p_flux = _power_law_integral(emin, emax, gamma)
+        exposure = float(self.parameters["ExposureTime"])*float(self.parameters["Area"])
+        num_events = prng.poisson(lam=exposure*flux*p_flux/e_flux)
+        src = np.repeat(np.arange(num_sources), num_events)
+
+        eobs = _power_law_inverse_cdf(prng.uniform(size=src.size), emin, emax, gamma,
+                                      src=src)
+
+        if log_nH is None:
+            nH = np.zeros(num_sources)
+        else:
+            nH = 10**prng.normal(loc=log_nH[0], scale=log_nH[1], size=num_sources)
+            # The optical depth for a column density of 10^22 cm**-2 is
+            # tabulated on a logarithmic energy grid, which can be indexed
+            # directly, and scaled to the column density of each source
+            ngrid = 8192
+            loge = np.log(eobs/emin)/np.log(emax/emin)*(ngrid-1)
+            egrid = emin*(emax/emin)**(np.arange(ngrid+1)/(ngrid-1.))
+            tau = -np.log(np.asarray(TBabsModel(1.0).get_absorb(YTArray(egrid, "keV"))))
+            i = np.clip(loge.astype("int64"), 0, ngrid-1)
+            tau = tau[i] + (loge-i)*(tau[i+1]-tau[i])
+            tau *= nH[src]/1.0e22
+            detected = prng.uniform(size=src.size) < np.exp(-tau)
+            src = src[detected]
+            eobs = eobs[detected]
+
+        xpix = prng.uniform(low=0.5, high=nx+0.5, size=num_sources)
+        ypix = prng.uniform(low=0.5, high=ny+0.5, size=num_sources)
+
+        new_events = self._add_source_events(xpix, ypix, src, eobs, prng, absorb_model)
+
+        if return_sources:
+            ra, dec = self.wcs.wcs_pix2world(xpix, ypix, 1)
+            sources = {"ra": YTArray(ra, "deg"), "dec": YTArray(dec, "deg"),
+                       "flux": YTArray(flux, "erg/s/cm**2"), "photon_index": gamma,
+                       "nH": YTArray(nH, "cm**-2")}
+            return new_events, sources
+        else:
+            return new_events
+
+    def _add_source_events(self, xpix, ypix, src, eobs, prng, absorb_model,
+                           light_curve=None):
+        # Add events with energies *eobs* from the sources with indices *src*
+        # at the pixel positions *xpix*, *ypix*, which are sorted by source
+        if absorb_model is not None:
+            detected = absorb_model.absorb_photons(YTArray(eobs, "keV"), prng=prng)
+            src = src[detected]
+            eobs = eobs[detected]
+
+        mylog.info("Adding %d new events." % eobs.size)
 
         events = {}
-        events["xpix"] = uconcatenate(x)
-        events["ypix"] = uconcatenate(y)
-        events["eobs"] = uconcatenate(e)
+        events["xpix"] = np.concatenate([self.events["xpix"], xpix[src]])
+        events["ypix"] = np.concatenate([self.events["ypix"], ypix[src]])
+        events["eobs"] = np.concatenate([self.events["eobs"], eobs])
+
+        times = None
+        if light_curve is not None:
+            times = self._source_times(src, xpix.size, light_curve, prng)
+        self._add_times(events, times, src.size, prng)
 
         return EventList(events, self.parameters)
 
+    def _source_times(self, src, num_sources, light_curve, prng):
+        # Draw the times of the events from the sources with indices *src*
+        # from the light curve shared by all of the sources, or from the
+        # light curves of each source, grouping the sources which share one
+        exp_time = float(self.parameters["ExposureTime"])
+        if isinstance(light_curve, LightCurve):
+            return light_curve.generate_times(src.size, exp_time, prng=prng)
+        light_curve = list(light_curve)
+        if len(light_curve) != num_sources:
+            raise ValueError("The number of light curves does not match the number of sources!")
+        times = prng.uniform(low=0.0, high=exp_time, size=src.size)
+        groups = {}
+        for i, lc in enumerate(light_curve):
+            if lc is not None:
+                groups.setdefault(id(lc), (lc, []))[1].append(i)
+        for lc, sources in groups.values():
+            idxs = np.flatnonzero(np.in1d(src, sources))
+            times[idxs] = lc.generate_times(idxs.size, exp_time, prng=prng)
+        return times
+
+    def _add_times(self, events, times, num_new, prng, prepend=False):
+        # Add the times of *num_new* new events to the new columns *events*.
+        # New events without times are from constant sources, and get
+        # uniform times, as do the old events if they were read from a file
+        # written before events always had times.
+        exp_time = float(self.parameters["ExposureTime"])
+        if times is None:
+            times = prng.uniform(low=0.0, high=exp_time, size=num_new)
+        old_times = self.events.get("time")
+        if old_times is None:
+            old_times = prng.uniform(low=0.0, high=exp_time, size=self.num_events)
+        if prepend:
+            events["time"] = np.concatenate([times, old_times])
+        else:
+            events["time"] = np.concatenate([old_times, times])
+
     def add_background(self, energy_bins, spectrum,
-                       prng=None, absorb_model=None):
+                       prng=None, absorb_model=None, template=None,
+                       template_bins=None):
         r"""
         Add background events to an :class:`~pyxsim.event_list.EventList`.
         Returns a new :class:`~pyxsim.event_list.EventList`.
@@ -152,19 +494,58 @@ class EventList(object):
             test. Default is the :mod:`numpy.random` module.
         absorb_model : :class:`~pyxsim.spectral_models.AbsorptionModel` 
             A model for foreground galactic absorption.
+        template : array_like or string, optional
+            An image of the spatial distribution of the background, such as a
+            background image or an exposure map, covering the whole field of the
+            event list, or the name of a FITS file containing one. It may have any
+            resolution, must be non-negative, and is normalized internally. If
+            *template_bins* is set, this should be a 3D array of images, one for
+            each energy band. Default is a spatially constant background.
+        template_bins : array_like, optional
+            The edges of the energy bands in keV of the images in *template*, for
+            an energy-dependent background template.
         """
         if prng is None:
             prng = np.random
 
+        if template is not None:
+            if isinstance(template, string_types):
+                template = _astropy.pyfits.getdata(template)
+            template = np.asarray(template, dtype="float64")
+            ndim = 2 if template_bins is None else 3
+            if template.ndim != ndim:
+                raise ValueError("The background template must be a %dD array, " % ndim +
+                                 "not %dD!" % template.ndim)
+            if not np.all(np.isfinite(template)) or np.any(template < 0.0):
+                raise ValueError("The background template must be finite and non-negative!")
+            if template.sum() <= 0.0:
+                raise ValueError("The background template is zero everywhere!")
+
         eobs = self._add_events(energy_bins, spectrum, prng, absorb_model)
         ne = len(eobs)
-        x = np.random.uniform(low=0.5, high=2.*self.parameters["pix_center"][0]-0.5, size=ne)
-        y = np.random.uniform(low=0.5, high=2.*self.parameters["pix_center"][1]-0.5, size=ne)
+        xmax = 2.*self.parameters["pix_center"][0]-1.
+        ymax = 2.*self.parameters["pix_center"][1]-1.
+        if template is None:
+            x = prng.uniform(low=0.5, high=xmax+0.5, size=ne)
+            y = prng.uniform(low=0.5, high=ymax+0.5, size=ne)
+        else:
+            if template_bins is None:
+                template = template.reshape((1,)+template.shape)
+                band = np.zeros(ne, dtype="int64")
+            else:
+                template_bins = np.asarray(template_bins, dtype="float64")
+                if template.shape[0] != template_bins.size-1:
+                    raise ValueError("The number of template images does not match "
+                                     "the number of energy bands!")
+                band = np.searchsorted(template_bins, eobs.d, side="right")-1
+                band = np.clip(band, 0, template.shape[0]-1)
+            x, y = _sample_image_positions(template, band, prng, xmax, ymax)
 
         events = {}
-        events["xpix"] = uconcatenate([x, self.events["xpix"]])
-        events["ypix"] = uconcatenate([y, self.events["ypix"]])
-        events["eobs"] = uconcatenate([eobs, self.events["eobs"]])
+        events["xpix"] = np.concatenate([x, self.events["xpix"]])
+        events["ypix"] = np.concatenate([y, self.events["ypix"]])
+        events["eobs"] = np.concatenate([eobs.d, self.events["eobs"]])
+        self._add_times(events, None, ne, prng, prepend=True)
 
         return EventList(events, self.parameters)
 
@@ -191,81 +572,129 @@ class EventList(object):
 
     def filter_events(self, region):
         """
-        Filter events using a ds9 *region*. Requires the `pyregion <http://pyregion.readthedocs.org/en/latest/>`_ package.
+        Filter events using a *region*, which may be a :class:`~pyxsim.regions.Region`
+        or a ds9 region string or file. ds9 regions with shapes or coordinate systems
+        which are not supported by :func:`~pyxsim.regions.parse_ds9_region` require the
+        `pyregion <http://pyregion.readthedocs.org/en/latest/>`_ package.
         Returns a new :class:`~pyxsim.event_list.EventList`.
         """
+        idxs = self.region_indices(region)
+        if idxs.size == 0:
+            raise RuntimeError("No events are inside this region!")
+        return self.select(idxs)
+
+    def region_indices(self, region):
+        """
+        Return the sorted indices of the events inside a *region*, which may be a
+        :class:`~pyxsim.regions.Region` or a ds9 region string or file. A spatial
+        index of the events is built the first time this is called, so that only
+        the events near a bounded region are tested for whether they are inside it.
+        """
+        if isinstance(region, string_types):
+            try:
+                region = parse_ds9_region(region, self.wcs)
+            except UnsupportedRegion:
+                return self._pyregion_indices(region)
+        if self._index is None:
+            self._index = EventIndex(self.events["xpix"], self.events["ypix"])
+        idxs = self._index.candidates(region.bounding_box())
+        if idxs is None:
+            return np.where(region.contains(self.events["xpix"], self.events["ypix"]))[0]
+        inside = region.contains(self.events["xpix"][idxs], self.events["ypix"][idxs])
+        return np.sort(idxs[inside])
+
+    def _pyregion_indices(self, region):
         import pyregion
-        import os
         if os.path.exists(region):
             reg = pyregion.open(region)
         else:
             reg = pyregion.parse(region)
         r = reg.as_imagecoord(header=self.wcs.to_header())
         f = r.get_filter()
-        idxs = f.inside_x_y(self["xpix"], self["ypix"])
-        if idxs.sum() == 0:
-            raise RuntimeError("No events are inside this region!")
-        new_events = {}
-        for k, v in self.items():
-            new_events[k] = v[idxs]
-        return EventList(new_events, self.parameters)
+        return np.where(f.inside_x_y(self["xpix"], self["ypix"]))[0]
 
     @classmethod
-    def from_h5_file(cls, h5file):
+    def from_h5_file(cls, h5file, emin=None, emax=None, box=None, fields=None):
         """
-        Initialize an :class:`~pyxsim.event_list.EventList` from a HDF5 file with filename *h5file*.
+        Initialize an :class:`~pyxsim.event_list.EventList` from a HDF5 file with filename *h5file*,
+        or from the directory *h5file* of a sharded file set written by
+        :meth:`~pyxsim.event_list.EventList.write_shards`.
+
+        Parameters
+        ----------
+        h5file : string
+            The name of the HDF5 file or sharded file set directory to read.
+        emin : float, (value, unit) tuple, or :class:`~yt.units.yt_array.YTQuantity`, optional
+            If set, only events with energies greater than or equal to this value are read.
+            Assumed to be in keV if units are not specified.
+        emax : float, (value, unit) tuple, or :class:`~yt.units.yt_array.YTQuantity`, optional
+            If set, only events with energies less than this value are read. Assumed to
+            be in keV if units are not specified.
+        box : tuple of floats, optional
+            If set, only events inside the box (xmin, xmax, ymin, ymax) in pixel
+            coordinates are read.
+        fields : list of strings, optional
+            The event fields to read, e.g. ["xpix", "ypix"]. Default is to read all
+            of the fields in the file.
+
+        Notes
+        -----
+        The events are read in blocks, so only the selected events are ever held in
+        memory. If the file was written with ``sort_by_energy=True``, only the blocks
+        which can contain events in the energy band are read.
         """
-        events = {}
-        parameters = {}
+        emin, emax = _parse_energy_band(emin, emax)
+
+        if os.path.isdir(h5file):
+            f, shards = read_manifest(h5file)
+            parameters = _parse_h5_parameters(f["parameters"])
+            f.close()
+            data = []
+            for shard in shards:
+                fs = h5py.File(shard["filename"], "r")
+                data.append(_read_h5_events(fs, emin, emax, box, fields))
+                fs.close()
+            events = {}
+            for key in data[0]:
+                events[key] = np.concatenate([v[key] for v in data])
+            return cls(events, parameters)
 
         f = h5py.File(h5file, "r")
 
-        p = f["/parameters"]
-        parameters["ExposureTime"] = YTQuantity(p["exp_time"].value, "s")
-        parameters["Area"] = YTQuantity(p["area"].value, "cm**2")
-        if "redshift" in p:
-            parameters["Redshift"] = p["redshift"].value
-        if "d_a" in p:
-            parameters["AngularDiameterDistance"] = YTQuantity(p["d_a"].value, "Mpc")
-        parameters["sky_center"] = YTArray(p["sky_center"][:], "deg")
-        parameters["dtheta"] = YTQuantity(p["dtheta"].value, "deg")
-        parameters["pix_center"] = p["pix_center"][:]
-        if "rmf" in p:
-            parameters["RMF"] = force_unicode(p["rmf"].value)
-        if "arf" in p:
-            parameters["ARF"] = force_unicode(p["arf"].value)
-        if "channel_type" in p:
-            parameters["ChannelType"] = force_unicode(p["channel_type"].value)
-        if "mission" in p:
-            parameters["Mission"] = force_unicode(p["mission"].value)
-        if "telescope" in p:
-            parameters["Telescope"] = force_unicode(p["telescope"].value)
-        if "instrument" in p:
-            parameters["Instrument"] = force_unicode(p["instrument"].value)
-
-        d = f["/data"]
-        events["xpix"] = d["xpix"][:]
-        events["ypix"] = d["ypix"][:]
-        events["eobs"] = YTArray(d["eobs"][:], "keV")
-        if "pi" in d:
-            events["PI"] = d["pi"][:]
-        if "pha" in d:
-            events["PHA"] = d["pha"][:]
+        parameters = _parse_h5_parameters(f["/parameters"])
+
+        events = _read_h5_events(f, emin, emax, box, fields)
 
         f.close()
 
         return cls(events, parameters)
 
     @classmethod
-    def from_fits_file(cls, fitsfile):
+    def from_fits_file(cls, fitsfile, emin=None, emax=None, box=None, fields=None):
         """
         Initialize an :class:`~pyxsim.event_list.EventList` from a FITS file with filename *fitsfile*.
+
+        Parameters
+        ----------
+        fitsfile : string
+            The name of the FITS file to read.
+        emin : float, (value, unit) tuple, or :class:`~yt.units.yt_array.YTQuantity`, optional
+            If set, only events with energies greater than or equal to this value are read.
+            Assumed to be in keV if units are not specified.
+        emax : float, (value, unit) tuple, or :class:`~yt.units.yt_array.YTQuantity`, optional
+            If set, only events with energies less than this value are read. Assumed to
+            be in keV if units are not specified.
+        box : tuple of floats, optional
+            If set, only events inside the box (xmin, xmax, ymin, ymax) in pixel
+            coordinates are read.
+        fields : list of strings, optional
+            The event fields to read, e.g. ["xpix", "ypix"]. Default is to read all
+            of the fields in the file.
         """
-        hdulist = _astropy.pyfits.open(fitsfile)
+        hdulist = _astropy.pyfits.open(fitsfile, memmap=True)
 
         tblhdu = hdulist["EVENTS"]
 
-        events = {}
         parameters = {}
 
         parameters["ExposureTime"] = YTQuantity(tblhdu.header["EXPOSURE"], "s")
@@ -287,140 +716,44 @@ class EventList(object):
         if "INSTRUME" in tblhdu.header:
             parameters["Instrument"] = tblhdu.header["INSTRUME"]
         parameters["sky_center"] = YTArray([tblhdu.header["TCRVL2"], tblhdu.header["TCRVL3"]], "deg")
-        parameters["pix_center"] = np.array([tblhdu.header["TCRVL2"], tblhdu.header["TCRVL3"]])
-        parameters["dtheta"] = YTQuantity(tblhdu.header["TCRVL3"], "deg")
-        events["xpix"] = tblhdu.data["X"]
-        events["ypix"] = tblhdu.data["Y"]
-        events["eobs"] = YTArray(tblhdu.data["ENERGY"]/1000., "keV")
-        if "PI" in tblhdu.columns.names:
-            events["PI"] = tblhdu.data["PI"]
-        if "PHA" in tblhdu.columns.names:
-            events["PHA"] = tblhdu.data["PHA"]
+        parameters["pix_center"] = np.array([tblhdu.header["TCRPX2"], tblhdu.header["TCRPX3"]])
+        parameters["dtheta"] = YTQuantity(tblhdu.header["TCDLT3"], "deg")
+
+        names = tblhdu.columns.names
+        columns = dict((k, v) for k, v in fits_event_fields.items() if v in names)
+        data = tblhdu.data
+
+        def _read_column(key, i0, i1):
+            v = data.field(columns[key])[i0:i1]
+            if key == "eobs":
+                v = v/1000.
+            return v
+
+        emin, emax = _parse_energy_band(emin, emax)
+        events = _read_events(_read_column, columns, 0, tblhdu.header["NAXIS2"],
+                              emin, emax, box, fields)
+
+        hdulist.close()
 
         return cls(events, parameters)
 
     @parallel_root_only
-    def write_fits_file(self, fitsfile, clobber=False):
+    def write_fits_file(self, fitsfile, clobber=False, block_size=1000000):
         """
         Write events to a FITS binary table file with filename *fitsfile*.
         Set *clobber* to True if you need to overwrite a previous file.
+        The events are written in blocks of *block_size* rows, so only
+        one block at a time needs to be converted to the FITS format.
         """
-        from astropy.time import Time, TimeDelta
-        pyfits = _astropy.pyfits
-
-        exp_time = float(self.parameters["ExposureTime"])
-
-        t_begin = Time.now()
-        dt = TimeDelta(exp_time, format='sec')
-        t_end = t_begin + dt
-
-        col_e = pyfits.Column(name='ENERGY', format='E', unit='eV',
-                              array=self["eobs"].in_units("eV").d)
-        col_x = pyfits.Column(name='X', format='D', unit='pixel',
-                              array=self["xpix"])
-        col_y = pyfits.Column(name='Y', format='D', unit='pixel',
-                              array=self["ypix"])
-
-        cols = [col_e, col_x, col_y]
-
-        if "ChannelType" in self.parameters:
-             chantype = self.parameters["ChannelType"]
-             if chantype == "PHA":
-                  cunit = "adu"
-             elif chantype == "PI":
-                  cunit = "Chan"
-             col_ch = pyfits.Column(name=chantype.upper(), format='1J',
-                                    unit=cunit, array=self.events[chantype])
-             cols.append(col_ch)
-
-             mylog.info("Generating times for events assuming uniform time "
-                        "distribution. In future versions this will be made "
-                        "more general.")
-
-             time = np.random.uniform(size=self.num_events, low=0.0,
-                                      high=float(self.parameters["ExposureTime"]))
-             col_t = pyfits.Column(name="TIME", format='1D', unit='s',
-                                   array=time)
-             cols.append(col_t)
-
-        coldefs = pyfits.ColDefs(cols)
-        tbhdu = pyfits.BinTableHDU.from_columns(coldefs)
-        tbhdu.name = "EVENTS"
-
-        tbhdu.header["MTYPE1"] = "sky"
-        tbhdu.header["MFORM1"] = "x,y"
-        tbhdu.header["MTYPE2"] = "EQPOS"
-        tbhdu.header["MFORM2"] = "RA,DEC"
-        tbhdu.header["TCTYP2"] = "RA---TAN"
-        tbhdu.header["TCTYP3"] = "DEC--TAN"
-        tbhdu.header["TCRVL2"] = float(self.parameters["sky_center"][0])
-        tbhdu.header["TCRVL3"] = float(self.parameters["sky_center"][1])
-        tbhdu.header["TCDLT2"] = -float(self.parameters["dtheta"])
-        tbhdu.header["TCDLT3"] = float(self.parameters["dtheta"])
-        tbhdu.header["TCRPX2"] = self.parameters["pix_center"][0]
-        tbhdu.header["TCRPX3"] = self.parameters["pix_center"][1]
-        tbhdu.header["TLMIN2"] = 0.5
-        tbhdu.header["TLMIN3"] = 0.5
-        tbhdu.header["TLMAX2"] = 2.*self.parameters["pix_center"][0]-0.5
-        tbhdu.header["TLMAX3"] = 2.*self.parameters["pix_center"][1]-0.5
-        if "ChannelType" in self.parameters:
-            rmf = RedistributionMatrixFile(self.parameters["RMF"])
-            tbhdu.header["TLMIN4"] = rmf.cmin
-            tbhdu.header["TLMAX4"] = rmf.cmax
-            tbhdu.header["RESPFILE"] = os.path.split(self.parameters["RMF"])[-1]
-            tbhdu.header["PHA_BINS"] = rmf.n_ch
-        tbhdu.header["EXPOSURE"] = exp_time
-        tbhdu.header["TSTART"] = 0.0
-        tbhdu.header["TSTOP"] = exp_time
-        tbhdu.header["AREA"] = float(self.parameters["Area"])
-        if "AngularDiameterDistance" in self.parameters:
-            tbhdu.header["D_A"] = float(self.parameters["AngularDiameterDistance"])
-        if "Redshift" in self.parameters:
-            tbhdu.header["REDSHIFT"] = self.parameters["Redshift"]
-        tbhdu.header["HDUVERS"] = "1.1.0"
-        tbhdu.header["RADECSYS"] = "FK5"
-        tbhdu.header["EQUINOX"] = 2000.0
-        tbhdu.header["HDUCLASS"] = "OGIP"
-        tbhdu.header["HDUCLAS1"] = "EVENTS"
-        tbhdu.header["HDUCLAS2"] = "ACCEPTED"
-        tbhdu.header["DATE"] = t_begin.tt.isot
-        tbhdu.header["DATE-OBS"] = t_begin.tt.isot
-        tbhdu.header["DATE-END"] = t_end.tt.isot
-        if "ARF" in self.parameters:
-            tbhdu.header["ANCRFILE"] = os.path.split(self.parameters["ARF"])[-1]
-        if "ChannelType" in self.parameters:
-            tbhdu.header["CHANTYPE"] = self.parameters["ChannelType"]
-        if "Mission" in self.parameters:
-            tbhdu.header["MISSION"] = self.parameters["Mission"]
-        if "Telescope" in self.parameters:
-            tbhdu.header["TELESCOP"] = self.parameters["Telescope"]
-        if "Instrument" in self.parameters:
-            tbhdu.header["INSTRUME"] = self.parameters["Instrument"]
-
-        hdulist = [pyfits.PrimaryHDU(), tbhdu]
-
+        keys = ["xpix", "ypix", "eobs"]
         if "ChannelType" in self.parameters:
-            start = pyfits.Column(name='START', format='1D', unit='s',
-                                  array=np.array([0.0]))
-            stop = pyfits.Column(name='STOP', format='1D', unit='s',
-                                 array=np.array([exp_time]))
-
-            tbhdu_gti = pyfits.BinTableHDU.from_columns([start,stop])
-            tbhdu_gti.name = "STDGTI"
-            tbhdu_gti.header["TSTART"] = 0.0
-            tbhdu_gti.header["TSTOP"] = exp_time
-            tbhdu_gti.header["HDUCLASS"] = "OGIP"
-            tbhdu_gti.header["HDUCLAS1"] = "GTI"
-            tbhdu_gti.header["HDUCLAS2"] = "STANDARD"
-            tbhdu_gti.header["RADECSYS"] = "FK5"
-            tbhdu_gti.header["EQUINOX"] = 2000.0
-            tbhdu_gti.header["DATE"] = t_begin.tt.isot
-            tbhdu_gti.header["DATE-OBS"] = t_begin.tt.isot
-            tbhdu_gti.header["DATE-END"] = t_end.tt.isot
-
-            hdulist.append(tbhdu_gti)
-
-        pyfits.HDUList(hdulist).writeto(fitsfile, clobber=clobber)
+            keys.append(self.parameters["ChannelType"])
+        if "time" in self.events:
+            keys.append("time")
+        def _blocks():
+            for start in range(0, self.num_events, block_size):
+                yield dict((k, self.events[k][start:start+block_size]) for k in keys)
+        write_fits_event_file(fitsfile, self.parameters, _blocks(), clobber=clobber)
 
     @parallel_root_only
     def write_simput_file(self, prefix, clobber=False, emin=None, emax=None):
@@ -449,7 +782,7 @@ class EventList(object):
         if emax is None:
             emax = self["eobs"].max().value
 
-        idxs = np.logical_and(self["eobs"].d >= emin, self["eobs"].d <= emax)
+        idxs = np.logical_and(self.events["eobs"] >= emin, self.events["eobs"] <= emax)
         flux = np.sum(self["eobs"][idxs].in_units("erg")) / \
                self.parameters["ExposureTime"]/self.parameters["Area"]
 
@@ -508,11 +841,110 @@ class EventList(object):
         wrhdu.writeto(simputfile, clobber=clobber)
 
     @parallel_root_only
-    def write_h5_file(self, h5file):
+    def write_h5_file(self, h5file, compression=None, single_precision=False,
+                      sort_by_energy=False):
         """
         Write an :class:`~pyxsim.event_list.EventList` to the HDF5 file given by *h5file*.
+
+        Parameters
+        ----------
+        h5file : string
+            The name of the HDF5 file to write.
+        compression : string, optional
+            The lossless compression filter to apply to the event datasets,
+            either "gzip" or "lzf". Default is no compression.
+        single_precision : boolean, optional
+            If True, the event positions and energies are stored in single
+            precision. Default: False
+        sort_by_energy : boolean, optional
+            If True, the events are stored sorted by energy, along with an
+            index which allows :meth:`~pyxsim.event_list.EventList.from_h5_file`
+            to read only the part of the file within an energy band.
+            Default: False
         """
+        if sort_by_energy:
+            idxs = np.argsort(self.events["eobs"], kind="mergesort")
+        else:
+            idxs = slice(None)
+
         f = h5py.File(h5file, "w")
+        self._write_h5_parameters(f)
+
+        if single_precision:
+            float_type = "float32"
+        else:
+            float_type = "float64"
+
+        d = f.create_group("data")
+        self._write_h5_data(d, idxs, compression, float_type)
+
+        if sort_by_energy:
+            eobs = d["eobs"][::h5_chunk_size]
+            index = f.create_group("index")
+            index.attrs["stride"] = h5_chunk_size
+            index.create_dataset("eobs", data=eobs)
+
+        f.close()
+
+    @parallel_root_only
+    def write_shards(self, dirname, shard_size=None, compression=None,
+                     single_precision=False, clobber=False):
+        """
+        Write an :class:`~pyxsim.event_list.EventList` to a sharded file set in the
+        directory *dirname*. The events are written to shard files of *shard_size*
+        events each, and a manifest file with the parameters and the sizes and
+        offsets of the shards is written alongside them. The file set can be read
+        back in with :meth:`~pyxsim.event_list.EventList.from_h5_file`, and merged
+        with other file sets using :func:`~pyxsim.utils.merge_files`.
+
+        Parameters
+        ----------
+        dirname : string
+            The directory to write the shards and manifest to. It is created if
+            it does not exist.
+        shard_size : integer, optional
+            The number of events in each shard. Default is to write all of the
+            events to a single shard.
+        compression : string, optional
+            The lossless compression filter to apply to the event datasets,
+            either "gzip" or "lzf". Default is no compression.
+        single_precision : boolean, optional
+            If True, the event positions and energies are stored in single
+            precision. Default: False
+        clobber : boolean, optional
+            Set to True to overwrite a previous file set in *dirname*.
+        """
+        if os.path.exists(os.path.join(dirname, manifest_filename)) and not clobber:
+            raise IOError("Cannot overwrite existing file set in %s. " % dirname +
+                          "If you want to do this, set clobber=True.")
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+        if single_precision:
+            float_type = "float32"
+        else:
+            float_type = "float64"
+
+        if shard_size is None:
+            shard_size = max(self.num_events, 1)
+
+        sizes = []
+        for i, start in enumerate(range(0, max(self.num_events, 1), shard_size)):
+            end = min(start+shard_size, self.num_events)
+            f = h5py.File(os.path.join(dirname, shard_filename(i)), "w")
+            d = f.create_group("data")
+            self._write_h5_data(d, slice(start, end), compression, float_type)
+            f.close()
+            sizes.append(end-start)
+
+        f = h5py.File(os.path.join(dirname, manifest_filename), "w")
+        self._write_h5_parameters(f)
+        write_manifest(f, [shard_filename(i) for i in range(len(sizes))],
+                       {"num_events": sizes})
+        f.close()
+
+    def _write_h5_parameters(self, f):
+        f.attrs["version"] = h5_file_version
 
         p = f.create_group("parameters")
         p.create_dataset("exp_time", data=float(self.parameters["ExposureTime"]))
@@ -537,22 +969,22 @@ class EventList(object):
         p.create_dataset("pix_center", data=self.parameters["pix_center"])
         p.create_dataset("dtheta", data=float(self.parameters["dtheta"]))
 
-        d = f.create_group("data")
-        d.create_dataset("xpix", data=self["xpix"])
-        d.create_dataset("ypix", data=self["ypix"])
-        d.create_dataset("xsky", data=self["xsky"].d)
-        d.create_dataset("ysky", data=self["ysky"].d)
-        d.create_dataset("eobs", data=self["eobs"].d)
-        if "PI" in self.events:
-            d.create_dataset("pi", data=self.events["PI"])
-        if "PHA" in self.events:
-            d.create_dataset("pha", data=self.events["PHA"])
-
-        f.close()
+    def _write_h5_data(self, d, idxs, compression, float_type):
+        # The sky coordinates are not stored, since they can be derived
+        # from the pixel coordinates. The times are always stored in double
+        # precision, since single precision cannot resolve long exposures.
+        for key, name in h5_event_fields.items():
+            if key in self.events:
+                v = self.events[key][idxs]
+                if v.dtype.kind == "f" and key != "time":
+                    dtype = float_type
+                else:
+                    dtype = None
+                create_h5_dataset(d, name, v, compression=compression, dtype=dtype)
 
     @parallel_root_only
     def write_fits_image(self, imagefile, clobber=False,
-                         emin=None, emax=None):
+                         emin=None, emax=None, reblock=1, exposure_map=None):
         r"""
         Generate a image by binning X-ray counts and write it to a FITS file.
 
@@ -566,45 +998,223 @@ class EventList(object):
             The minimum energy of the photons to put in the image, in keV.
         emax : float, optional
             The maximum energy of the photons to put in the image, in keV.
+        reblock : integer, optional
+            The number of event list pixels along each axis which are binned
+            into one image pixel. Default: 1
+        exposure_map : array_like, optional
+            If set, the counts are divided by this exposure map (in cm**2*s) on
+            the same image grid, e.g. from
+            :meth:`~pyxsim.instruments.InstrumentSimulator.make_exposure_map`, to
+            write a flux image in photons/cm**2/s. Pixels with zero exposure are
+            set to zero.
         """
-        if emin is None:
-            mask_emin = np.ones(self.num_events, dtype='bool')
-        else:
-            mask_emin = self["eobs"].d > emin
-        if emax is None:
-            mask_emax = np.ones(self.num_events, dtype='bool')
-        else:
-            mask_emax = self["eobs"].d < emax
+        mask = None
+        if emin is not None:
+            mask = self.events["eobs"] > emin
+        if emax is not None:
+            mask_emax = self.events["eobs"] < emax
+            mask = mask_emax if mask is None else mask & mask_emax
+
+        H = self._bin_events(None, reblock, mask=mask).astype("float64")
+        if exposure_map is not None:
+            if hasattr(exposure_map, "in_units"):
+                exposure_map = exposure_map.in_units("cm**2*s")
+            exposure_map = np.asarray(exposure_map, dtype="float64")
+            if exposure_map.shape != H.shape:
+                raise ValueError("The shape of the exposure map %s does not match " % (exposure_map.shape,) +
+                                 "the shape of the image %s!" % (H.shape,))
+            exposed = exposure_map > 0.0
+            H[exposed] /= exposure_map[exposed]
+            H[~exposed] = 0.0
+
+        hdu = _astropy.pyfits.PrimaryHDU(H)
+        self._image_header(hdu.header, reblock)
+        if exposure_map is not None:
+            hdu.header["BUNIT"] = "photon/cm**2/s"
+
+        hdu.writeto(imagefile, clobber=clobber)
 
-        mask = np.logical_and(mask_emin, mask_emax)
+    def make_image_cube(self, energy_bins, reblock=1):
+        r"""
+        Bin the events into a cube of images in energy bands, in a single pass over
+        the events. Returns an array of counts with shape (number of bands, ny, nx).
 
+        Parameters
+        ----------
+        energy_bins : array_like
+            The edges of the energy bands in keV.
+        reblock : integer, optional
+            The number of event list pixels along each axis which are binned
+            into one image pixel. Default: 1
+        """
+        return self._bin_events(np.asarray(energy_bins, dtype="float64"), reblock)
+
+    @parallel_root_only
+    def write_fits_cube(self, cubefile, energy_bins, reblock=1, clobber=False):
+        r"""
+        Bin the events into a cube of images in energy bands, in a single pass over
+        the events, and write it to a FITS file. The third axis of the cube is a
+        spectral axis. If the bands are evenly spaced, it has a linear "ENERGY" WCS;
+        otherwise the edges of the bands are written to an "EBOUNDS" extension.
+
+        Parameters
+        ----------
+        cubefile : string
+            The name of the FITS file to write.
+        energy_bins : array_like
+            The edges of the energy bands in keV.
+        reblock : integer, optional
+            The number of event list pixels along each axis which are binned
+            into one image pixel. Default: 1
+        clobber : boolean, optional
+            Set to True to overwrite a previous file.
+        """
+        energy_bins = np.asarray(energy_bins, dtype="float64")
+        cube = self.make_image_cube(energy_bins, reblock=reblock)
+
+        hdu = _astropy.pyfits.PrimaryHDU(cube.astype("int32"))
+        self._image_header(hdu.header, reblock)
+        de = np.diff(energy_bins)
+        hdus = [hdu]
+        if np.allclose(de, de[0], rtol=1.0e-8, atol=0.0):
+            hdu.header["CTYPE3"] = "ENERGY"
+            hdu.header["CUNIT3"] = "keV"
+            hdu.header["CRPIX3"] = 1.0
+            hdu.header["CRVAL3"] = 0.5*(energy_bins[0]+energy_bins[1])
+            hdu.header["CDELT3"] = de[0]
+        else:
+            hdu.header["CTYPE3"] = "BAND"
+            hdu.header["CRPIX3"] = 1.0
+            hdu.header["CRVAL3"] = 1.0
+            hdu.header["CDELT3"] = 1.0
+            col1 = _astropy.pyfits.Column(name='BAND', format='1J',
+                                          array=np.arange(de.size, dtype="int32")+1)
+            col2 = _astropy.pyfits.Column(name='E_MIN', format='1D', unit='keV',
+                                          array=energy_bins[:-1])
+            col3 = _astropy.pyfits.Column(name='E_MAX', format='1D', unit='keV',
+                                          array=energy_bins[1:])
+            cols = _astropy.pyfits.ColDefs([col1, col2, col3])
+            tbhdu = _astropy.pyfits.BinTableHDU.from_columns(cols)
+            tbhdu.name = "EBOUNDS"
+            hdus.append(tbhdu)
+
+        _astropy.pyfits.HDUList(hdus).writeto(cubefile, clobber=clobber)
+
+    def _bin_events(self, energy_bins, reblock, mask=None):
+        # Bin the events into images using integer pixel indices and a
+        # single bincount on the flattened (energy, y, x) index. If
+        # energy_bins is None, a single image is returned.
         nx = int(2*self.parameters["pix_center"][0]-1.)
         ny = int(2*self.parameters["pix_center"][1]-1.)
+        nxb = -(-nx // reblock)
+        nyb = -(-ny // reblock)
+        x = self["xpix"]
+        y = self["ypix"]
+        ix = np.floor((x-0.5)/reblock).astype("int64")
+        iy = np.floor((y-0.5)/reblock).astype("int64")
+        valid = (ix >= 0) & (ix < nxb) & (iy >= 0) & (iy < nyb) & \
+            (x < nx+0.5) & (y < ny+0.5)
+        if mask is not None:
+            valid &= mask
+        idxs = iy*nxb+ix
+        if energy_bins is None:
+            nb = 1
+        else:
+            nb = energy_bins.size-1
+            ie = np.searchsorted(energy_bins, self.events["eobs"], side="right")-1
+            valid &= (ie >= 0) & (ie < nb)
+            idxs += ie*(nxb*nyb)
+        H = np.bincount(idxs[valid], minlength=nb*nyb*nxb).reshape(nb, nyb, nxb)
+        if energy_bins is None:
+            H = H[0]
+        return H
+
+    def _image_header(self, header, reblock):
+        nx = int(2*self.parameters["pix_center"][0]-1.)
+        ny = int(2*self.parameters["pix_center"][1]-1.)
+        header["MTYPE1"] = "EQPOS"
+        header["MFORM1"] = "RA,DEC"
+        header["CTYPE1"] = "RA---TAN"
+        header["CTYPE2"] = "DEC--TAN"
+        header["CRPIX1"] = 0.5*(nx/float(reblock)+1)
+        header["CRPIX2"] = 0.5*(ny/float(reblock)+1)
+        header["CRVAL1"] = float(self.parameters["sky_center"][0])
+        header["CRVAL2"] = float(self.parameters["sky_center"][1])
+        header["CUNIT1"] = "deg"
+        header["CUNIT2"] = "deg"
+        header["CDELT1"] = -float(self.parameters["dtheta"])*reblock
+        header["CDELT2"] = float(self.parameters["dtheta"])*reblock
+        header["EXPOSURE"] = float(self.parameters["ExposureTime"])
 
-        xbins = np.linspace(0.5, float(nx)+0.5, nx+1, endpoint=True)
-        ybins = np.linspace(0.5, float(ny)+0.5, ny+1, endpoint=True)
-
-        H, xedges, yedges = np.histogram2d(self["xpix"][mask],
-                                           self["ypix"][mask],
-                                           bins=[xbins,ybins])
-
-        hdu = _astropy.pyfits.PrimaryHDU(H.T)
-
-        hdu.header["MTYPE1"] = "EQPOS"
-        hdu.header["MFORM1"] = "RA,DEC"
-        hdu.header["CTYPE1"] = "RA---TAN"
-        hdu.header["CTYPE2"] = "DEC--TAN"
-        hdu.header["CRPIX1"] = 0.5*(nx+1)
-        hdu.header["CRPIX2"] = 0.5*(nx+1)
-        hdu.header["CRVAL1"] = float(self.parameters["sky_center"][0])
-        hdu.header["CRVAL2"] = float(self.parameters["sky_center"][1])
-        hdu.header["CUNIT1"] = "deg"
-        hdu.header["CUNIT2"] = "deg"
-        hdu.header["CDELT1"] = -float(self.parameters["dtheta"])
-        hdu.header["CDELT2"] = float(self.parameters["dtheta"])
-        hdu.header["EXPOSURE"] = float(self.parameters["ExposureTime"])
+    @parallel_root_only
+    def write_light_curve(self, lcfile, time_bin, emin=None, emax=None, clobber=False):
+        r"""
+        Bin the times of the events into a light curve and write it to a
+        FITS binary table in the OGIP format.
 
-        hdu.writeto(imagefile, clobber=clobber)
+        Parameters
+        ----------
+        lcfile : string
+            The name of the FITS file to write.
+        time_bin : float, (value, unit) tuple, or :class:`~yt.units.yt_array.YTQuantity`
+            The width of the time bins. If units are not specified, it is
+            assumed to be in seconds. The last bin is shortened if the exposure
+            time is not a multiple of the bin width.
+        emin : float, optional
+            The minimum energy of the events to put in the light curve, in keV.
+        emax : float, optional
+            The maximum energy of the events to put in the light curve, in keV.
+        clobber : boolean, optional
+            Set to True to overwrite a previous file.
+        """
+        if "time" not in self.events:
+            raise RuntimeError("The events do not have times!")
+        pyfits = _astropy.pyfits
+        exp_time = float(self.parameters["ExposureTime"])
+        dt = float(parse_value(time_bin, "s"))
+        nbins = int(np.ceil(exp_time/dt))
+
+        time = self.events["time"]
+        ib = np.floor(time/dt).astype("int64")
+        mask = (ib >= 0) & (ib < nbins)
+        if emin is not None:
+            mask &= self.events["eobs"] > emin
+        if emax is not None:
+            mask &= self.events["eobs"] < emax
+        counts = np.bincount(ib[mask], minlength=nbins)
+
+        tstart = np.arange(nbins)*dt
+        tstop = np.minimum(tstart+dt, exp_time)
+        timedel = tstop-tstart
+
+        col1 = pyfits.Column(name='TIME', format='1D', unit='s', array=0.5*(tstart+tstop))
+        col2 = pyfits.Column(name='TIMEDEL', format='1D', unit='s', array=timedel)
+        col3 = pyfits.Column(name='COUNTS', format='1J', unit='count',
+                             array=counts.astype("int32"))
+        col4 = pyfits.Column(name='RATE', format='1D', unit='count/s', array=counts/timedel)
+        col5 = pyfits.Column(name='ERROR', format='1D', unit='count/s',
+                             array=np.sqrt(counts)/timedel)
+        col6 = pyfits.Column(name='FRACEXP', format='1D', array=timedel/dt)
+
+        tbhdu = pyfits.BinTableHDU.from_columns(pyfits.ColDefs([col1, col2, col3,
+                                                                col4, col5, col6]))
+        tbhdu.name = "RATE"
+        tbhdu.header["HDUCLASS"] = "OGIP"
+        tbhdu.header["HDUCLAS1"] = "LIGHTCURVE"
+        tbhdu.header["HDUCLAS2"] = "TOTAL"
+        tbhdu.header["HDUCLAS3"] = "RATE"
+        tbhdu.header["TIMEDEL"] = dt
+        tbhdu.header["TSTART"] = 0.0
+        tbhdu.header["TSTOP"] = exp_time
+        tbhdu.header["TIMEUNIT"] = "s"
+        tbhdu.header["EXPOSURE"] = exp_time
+        tbhdu.header["TOTCTS"] = counts.sum()
+        for key, name in [("Mission", "MISSION"), ("Telescope", "TELESCOP"),
+                          ("Instrument", "INSTRUME")]:
+            tbhdu.header[name] = self.parameters.get(key, "none")
+
+        hdulist = pyfits.HDUList([pyfits.PrimaryHDU(), tbhdu])
+        hdulist.writeto(lcfile, clobber=clobber)
 
     @parallel_root_only
     def write_spectrum(self, specfile, bin_type="channel", emin=0.1,
@@ -628,19 +1238,125 @@ class EventList(object):
         nchan : integer, optional
             The number of channels. Only used if binning without an RMF.
         """
-        pyfits = _astropy.pyfits
+        chan, bins, spectype = self._spectrum_channels(bin_type, emin, emax, nchan)
+        valid = chan >= 0
+        spec = np.bincount(chan[valid], minlength=bins.size)
+
+        hdulist = _astropy.pyfits.HDUList([_astropy.pyfits.PrimaryHDU(),
+                                           self._spectrum_hdu(spec, bins, spectype)])
+
+        hdulist.writeto(specfile, clobber=clobber)
+
+    @parallel_root_only
+    def write_region_spectra(self, specfile, regions, bin_type="channel", emin=0.1,
+                             emax=10.0, nchan=2000, clobber=False, separate_files=False):
+        r"""
+        Bin the event energies in a number of spatial regions into spectra, in a
+        single pass over the events, and write them to FITS binary tables. The
+        binning of the spectra is the same as in
+        :meth:`~pyxsim.event_list.EventList.write_spectrum`.
+
+        Parameters
+        ----------
+        specfile : string
+            The name of the FITS file to be written, which will contain one "SPECTRUM"
+            extension per region. If *separate_files* is True, a spectrum file for each
+            region is written instead, named by inserting the region number before
+            the extension, e.g. "spec.0001.pi", "spec.0002.pi", etc.
+        regions : list, array_like, or string
+            The regions to extract the spectra from. Either a list of
+            :class:`~pyxsim.regions.Region` objects or ds9 region strings or files,
+            which may overlap, or a 2-D integer label map (or the name of a FITS file
+            containing one) covering the field of the event list, in which the pixels
+            of region i have the value i, and pixels with values <= 0 are not in any
+            region. The label map does not have to have the resolution of the event list.
+            A file is read as a label map if it has a FITS extension (.fits, .fit, or
+            .fts, optionally gzipped) or begins with a FITS header, and as a ds9 region
+            file otherwise.
+        bin_type : string, optional
+            Bin on "energy" or "channel". If an RMF is detected, channel information will be
+            imported from it.
+        emin : float, optional
+            The minimum energy of the spectral bins in keV. Only used if binning without an RMF.
+        emax : float, optional
+            The maximum energy of the spectral bins in keV. Only used if binning without an RMF.
+        nchan : integer, optional
+            The number of channels. Only used if binning without an RMF.
+        clobber : boolean, optional
+            Set to True to overwrite previous files.
+        separate_files : boolean, optional
+            Set to True to write each spectrum to its own file.
+        """
+        chan, bins, spectype = self._spectrum_channels(bin_type, emin, emax, nchan)
+        nreg, label, idxs = self._region_labels(regions)
+        chan = chan[idxs]
+        valid = chan >= 0
+        nch = bins.size
+        spec = np.bincount(label[valid]*nch+chan[valid],
+                           minlength=nreg*nch).reshape(nreg, nch)
+
+        hdus = []
+        for i in range(nreg):
+            hdu = self._spectrum_hdu(spec[i], bins, spectype)
+            hdu.header["EXTVER"] = i+1
+            hdu.header["REGION"] = i+1
+            hdus.append(hdu)
+
+        if separate_files:
+            prefix, ext = os.path.splitext(specfile)
+            for i, hdu in enumerate(hdus):
+                fn = "%s.%04d%s" % (prefix, i+1, ext)
+                _astropy.pyfits.HDUList([_astropy.pyfits.PrimaryHDU(), hdu]).writeto(fn, clobber=clobber)
+        else:
+            hdulist = _astropy.pyfits.HDUList([_astropy.pyfits.PrimaryHDU()]+hdus)
+            hdulist.writeto(specfile, clobber=clobber)
+
+    def _region_labels(self, regions):
+        # Return the number of regions, and the zero-based region label and
+        # the index of each event in each region. For a label map, each
+        # event is in at most one region, but for a list of regions, events
+        # are repeated for each region they are in.
+        if isinstance(regions, string_types) and not _is_fits_file(regions):
+            regions = [regions]
+        if isinstance(regions, (string_types, np.ndarray)):
+            if isinstance(regions, string_types):
+                regions = _astropy.pyfits.getdata(regions)
+            label_map = np.asarray(regions).astype("int64")
+            if label_map.ndim != 2:
+                raise ValueError("The label map must be a 2-D image!")
+            ny, nx = label_map.shape
+            xmax = 2.*self.parameters["pix_center"][0]-1.
+            ymax = 2.*self.parameters["pix_center"][1]-1.
+            ix = np.floor((self["xpix"]-0.5)*nx/xmax).astype("int64")
+            iy = np.floor((self["ypix"]-0.5)*ny/ymax).astype("int64")
+            idxs = np.where((ix >= 0) & (ix < nx) & (iy >= 0) & (iy < ny))[0]
+            label = label_map[iy[idxs], ix[idxs]]-1
+            inside = label >= 0
+            return max(label_map.max(), 0), label[inside], idxs[inside]
+        idxs = [self.region_indices(region) for region in regions]
+        label = np.repeat(np.arange(len(idxs)), [i.size for i in idxs])
+        if len(idxs) == 0:
+            return 0, label, np.zeros(0, dtype="int64")
+        return len(idxs), label, np.concatenate(idxs)
+
+    def _spectrum_channels(self, bin_type, emin, emax, nchan):
+        # Return the zero-based spectral channel of each event (-1 if it is
+        # outside the spectrum), the channels or energies of the bins, and
+        # the type of the spectrum. The RMF, if any, is only read here.
         if bin_type == "channel" and "ChannelType" in self.parameters:
             spectype = self.parameters["ChannelType"]
             rmf = RedistributionMatrixFile(self.parameters["RMF"])
-            minlength = rmf.n_ch
-            if rmf.cmin == 1: minlength += 1
-            spec = np.bincount(self[spectype], minlength=minlength)
-            if rmf.cmin == 1: spec = spec[1:]
             bins = (np.arange(rmf.n_ch)+rmf.cmin).astype("int32")
+            chan = np.asarray(self[spectype]).astype("int64")-rmf.cmin
+            chan[(chan < 0) | (chan >= rmf.n_ch)] = -1
         else:
-            espec = self["eobs"].d
-            erange = (emin, emax)
-            spec, ee = np.histogram(espec, bins=nchan, range=erange)
+            ee = np.linspace(emin, emax, nchan+1)
+            espec = self.events["eobs"]
+            # This matches the binning of np.histogram, which includes
+            # the right edge of the last bin
+            chan = np.searchsorted(ee, espec, side="right")-1
+            chan[espec == ee[-1]] = nchan-1
+            chan[(chan < 0) | (chan >= nchan)] = -1
             if bin_type == "energy":
                 bins = 0.5*(ee[1:]+ee[:-1])
                 spectype = "energy"
@@ -649,6 +1365,10 @@ class EventList(object):
                            "a perfect response and %d PI channels." % nchan)
                 bins = (np.arange(nchan)+1).astype("int32")
                 spectype = "pi"
+        return chan, bins, spectype
+
+    def _spectrum_hdu(self, spec, bins, spectype):
+        pyfits = _astropy.pyfits
 
         col1 = pyfits.Column(name='CHANNEL', format='1J', array=bins)
         col2 = pyfits.Column(name=spectype.upper(), format='1D', array=bins.astype("float64"))
@@ -700,6 +1420,409 @@ class EventList(object):
         tbhdu.header["CORRSCAL"] = 0.0
         tbhdu.header["BACKSCAL"] = 1.0
 
-        hdulist = pyfits.HDUList([pyfits.PrimaryHDU(), tbhdu])
-
-        hdulist.writeto(specfile, clobber=clobber)
+        return tbhdu
+
+# Mappings of event field names to the dataset names in HDF5 files and
+# column names in FITS files
+h5_event_fields = {"xpix": "xpix", "ypix": "ypix", "eobs": "eobs",
+                   "PI": "pi", "PHA": "pha", "time": "time"}
+fits_event_fields = {"xpix": "X", "ypix": "Y", "eobs": "ENERGY",
+                     "PI": "PI", "PHA": "PHA", "time": "TIME"}
+
+def _is_fits_file(filename):
+    # Whether *filename* is an existing FITS file, judging by its extension
+    # or, failing that, by the "SIMPLE" keyword which every FITS file
+    # starts with
+    if not os.path.isfile(filename):
+        return False
+    fn = filename.lower()
+    if fn.endswith(".gz"):
+        fn = fn[:-3]
+    if fn.endswith((".fits", ".fit", ".fts")):
+        return True
+    with open(filename, "rb") as f:
+        return f.read(6) == b"SIMPLE"
+
+def _sample_image_positions(images, band, prng, xmax, ymax):
+    # Draw pixel positions for events from the images of their energy bands
+    # *band*, where the images cover the field from 0.5 to xmax+0.5 and
+    # 0.5 to ymax+0.5. The cumulative distributions of the images are
+    # offset by the band index and flattened into one increasing table, so
+    # a single searchsorted finds the image pixels of all of the events,
+    # and the events are then distributed uniformly within the pixels.
+    nb, ny, nx = images.shape
+    npix = nx*ny
+    cdf = np.cumsum(images.reshape(nb, npix), axis=1)
+    norm = cdf[:,-1].copy()
+    if np.any(norm[np.unique(band)] <= 0.0):
+        raise ValueError("The background template is zero for an energy band with events!")
+    norm[norm <= 0.0] = 1.0
+    cdf /= norm[:,np.newaxis]
+    cdf += np.arange(nb)[:,np.newaxis]
+    u = prng.uniform(size=band.size) + band
+    idxs = np.searchsorted(cdf.ravel(), u, side="right")
+    idxs = np.clip(idxs - band*npix, 0, npix-1)
+    iy = idxs // nx
+    ix = idxs - iy*nx
+    x = 0.5 + (ix + prng.uniform(size=band.size))*xmax/nx
+    y = 0.5 + (iy + prng.uniform(size=band.size))*ymax/ny
+    return x, y
+
+def _power_law_integral(x0, x1, alpha):
+    # The integral of x**-alpha from x0 to x1, for scalar or array alpha
+    alpha = np.asarray(alpha, dtype="float64")
+    one = np.isclose(alpha, 1.0)
+    a = np.where(one, 1.0, 1.0-alpha)
+    return np.where(one, np.log(x1/x0), (x1**a-x0**a)/a)
+
+def _power_law_inverse_cdf(u, x0, x1, alpha, src=None):
+    # Draw from x**-alpha between x0 and x1 given uniform deviates u, for
+    # scalar or array alpha. If *src* is set, alpha is given per source and
+    # src gives the source of each deviate, so the powers of the limits are
+    # only computed once per source.
+    alpha = np.asarray(alpha, dtype="float64")
+    one = np.isclose(alpha, 1.0)
+    a = np.where(one, 1.0, 1.0-alpha)
+    c0 = x0**a
+    dc = x1**a-c0
+    if src is not None:
+        one = one[src]
+        a = a[src]
+        c0 = c0[src]
+        dc = dc[src]
+    x = (c0 + u*dc)**(1.0/a)
+    if one.any():
+        x = np.where(one, x0*(x1/x0)**u, x)
+    return x
+
+def _sample_spectrum(ebins, spectrum, num_events, prng):
+    # Draw *num_events* energies from a single binned spectrum
+    cumspec = np.insert(np.cumsum(spectrum), 0, 0.0)
+    cumspec /= cumspec[-1]
+    randvec = prng.uniform(size=num_events)
+    return np.interp(randvec, cumspec, ebins)
+
+def _sample_spectra(ebins, spectra, src, prng):
+    # Draw an energy from the spectrum of source src[i] for each event i.
+    # The normalized cumulative spectra of the sources are offset by the
+    # source index and flattened into one increasing table, so a single
+    # searchsorted finds the energy bins of all of the events.
+    num_sources, num_bins = spectra.shape
+    cumspec = np.zeros((num_sources, num_bins+1))
+    np.cumsum(spectra, axis=1, out=cumspec[:,1:])
+    norm = cumspec[:,-1].copy()
+    norm[norm == 0.0] = 1.0
+    cumspec /= norm[:,np.newaxis]
+    cumspec += np.arange(num_sources)[:,np.newaxis]
+    cumspec = cumspec.ravel()
+    u = prng.uniform(size=src.size) + src
+    idxs = np.searchsorted(cumspec, u, side="right") - 1
+    ibin = np.clip(idxs - src*(num_bins+1), 0, num_bins-1)
+    idxs = src*(num_bins+1) + ibin
+    c0 = cumspec[idxs]
+    dc = cumspec[idxs+1] - c0
+    dc[dc == 0.0] = 1.0
+    frac = np.clip((u-c0)/dc, 0.0, 1.0)
+    return ebins[ibin] + frac*(ebins[ibin+1]-ebins[ibin])
+
+def _parse_energy_band(emin, emax):
+    if emin is not None:
+        emin = float(parse_value(emin, "keV"))
+    if emax is not None:
+        emax = float(parse_value(emax, "keV"))
+    return emin, emax
+
+def _parse_h5_parameters(p):
+    parameters = {}
+    parameters["ExposureTime"] = YTQuantity(p["exp_time"].value, "s")
+    parameters["Area"] = YTQuantity(p["area"].value, "cm**2")
+    if "redshift" in p:
+        parameters["Redshift"] = p["redshift"].value
+    if "d_a" in p:
+        parameters["AngularDiameterDistance"] = YTQuantity(p["d_a"].value, "Mpc")
+    parameters["sky_center"] = YTArray(p["sky_center"][:], "deg")
+    parameters["dtheta"] = YTQuantity(p["dtheta"].value, "deg")
+    parameters["pix_center"] = p["pix_center"][:]
+    if "rmf" in p:
+        parameters["RMF"] = force_unicode(p["rmf"].value)
+    if "arf" in p:
+        parameters["ARF"] = force_unicode(p["arf"].value)
+    if "channel_type" in p:
+        parameters["ChannelType"] = force_unicode(p["channel_type"].value)
+    if "mission" in p:
+        parameters["Mission"] = force_unicode(p["mission"].value)
+    if "telescope" in p:
+        parameters["Telescope"] = force_unicode(p["telescope"].value)
+    if "instrument" in p:
+        parameters["Instrument"] = force_unicode(p["instrument"].value)
+    return parameters
+
+def _read_h5_events(f, emin, emax, box, fields):
+    d = f["/data"]
+    num_events = d["xpix"].shape[0]
+    columns = dict((k, v) for k, v in h5_event_fields.items() if v in d)
+
+    start = 0
+    end = num_events
+    if "index" in f and (emin is not None or emax is not None):
+        start, end = _index_range(f["index"], emin, emax, num_events)
+
+    def _read_column(key, i0, i1):
+        return d[columns[key]][i0:i1]
+
+    return _read_events(_read_column, columns, start, end,
+                        emin, emax, box, fields)
+
+def _index_range(index, emin, emax, num_events):
+    # The index stores the energy of every "stride"-th event of a file
+    # sorted by energy, so the events in the band lie between these rows
+    ie = index["eobs"][:]
+    stride = index.attrs["stride"]
+    start = 0
+    end = num_events
+    if emin is not None:
+        start = max(np.searchsorted(ie, emin, side="left")-1, 0)*stride
+    if emax is not None:
+        end = min(np.searchsorted(ie, emax, side="right")*stride, num_events)
+    return start, end
+
+def _read_events(read_column, columns, start, end, emin, emax, box, fields):
+    """
+    Read the events in rows *start* to *end* block by block, using the function
+    *read_column(key, i0, i1)*, keeping only those events within the energy
+    band and pixel box. Returns a dictionary of the requested *fields*.
+    """
+    if fields is None:
+        fields = list(columns.keys())
+    fields = ensure_list(fields)
+    for field in fields:
+        if field not in columns:
+            raise KeyError("The field '%s' is not in this file!" % field)
+    select_e = emin is not None or emax is not None
+    if select_e and "eobs" not in columns:
+        raise KeyError("Cannot select events by energy without the 'eobs' field!")
+    data = dict((field, []) for field in fields)
+    for i0 in range(start, max(end, start+1), h5_chunk_size):
+        i1 = min(i0+h5_chunk_size, end)
+        block = {}
+        def _get(key):
+            if key not in block:
+                v = np.asarray(read_column(key, i0, i1))
+                if v.dtype.kind == "f":
+                    v = v.astype("float64")
+                elif v.dtype.byteorder not in "=|":
+                    v = v.astype(v.dtype.newbyteorder("="))
+                block[key] = v
+            return block[key]
+        mask = None
+        if select_e:
+            e = _get("eobs")
+            mask = np.ones(e.shape, dtype="bool")
+            if emin is not None:
+                mask &= e >= emin
+            if emax is not None:
+                mask &= e < emax
+        if box is not None:
+            x = _get("xpix")
+            y = _get("ypix")
+            in_box = (x >= box[0]) & (x <= box[1]) & (y >= box[2]) & (y <= box[3])
+            mask = in_box if mask is None else mask & in_box
+        for field in fields:
+            v = _get(field)
+            if mask is not None:
+                v = v[mask]
+            data[field].append(v)
+    events = {}
+    for field in fields:
+        events[field] = np.concatenate(data[field])
+    return events
+
+def _events_header(tbhdu, parameters, t_begin, t_end):
+    exp_time = float(parameters["ExposureTime"])
+    tbhdu.header["MTYPE1"] = "sky"
+    tbhdu.header["MFORM1"] = "x,y"
+    tbhdu.header["MTYPE2"] = "EQPOS"
+    tbhdu.header["MFORM2"] = "RA,DEC"
+    tbhdu.header["TCTYP2"] = "RA---TAN"
+    tbhdu.header["TCTYP3"] = "DEC--TAN"
+    tbhdu.header["TCRVL2"] = float(parameters["sky_center"][0])
+    tbhdu.header["TCRVL3"] = float(parameters["sky_center"][1])
+    tbhdu.header["TCDLT2"] = -float(parameters["dtheta"])
+    tbhdu.header["TCDLT3"] = float(parameters["dtheta"])
+    tbhdu.header["TCRPX2"] = parameters["pix_center"][0]
+    tbhdu.header["TCRPX3"] = parameters["pix_center"][1]
+    tbhdu.header["TLMIN2"] = 0.5
+    tbhdu.header["TLMIN3"] = 0.5
+    tbhdu.header["TLMAX2"] = 2.*parameters["pix_center"][0]-0.5
+    tbhdu.header["TLMAX3"] = 2.*parameters["pix_center"][1]-0.5
+    if "ChannelType" in parameters:
+        rmf = RedistributionMatrixFile(parameters["RMF"])
+        tbhdu.header["TLMIN4"] = rmf.cmin
+        tbhdu.header["TLMAX4"] = rmf.cmax
+        tbhdu.header["RESPFILE"] = os.path.split(parameters["RMF"])[-1]
+        tbhdu.header["PHA_BINS"] = rmf.n_ch
+    tbhdu.header["EXPOSURE"] = exp_time
+    tbhdu.header["TSTART"] = 0.0
+    tbhdu.header["TSTOP"] = exp_time
+    tbhdu.header["AREA"] = float(parameters["Area"])
+    if "AngularDiameterDistance" in parameters:
+        tbhdu.header["D_A"] = float(parameters["AngularDiameterDistance"])
+    if "Redshift" in parameters:
+        tbhdu.header["REDSHIFT"] = parameters["Redshift"]
+    tbhdu.header["HDUVERS"] = "1.1.0"
+    tbhdu.header["RADECSYS"] = "FK5"
+    tbhdu.header["EQUINOX"] = 2000.0
+    tbhdu.header["HDUCLASS"] = "OGIP"
+    tbhdu.header["HDUCLAS1"] = "EVENTS"
+    tbhdu.header["HDUCLAS2"] = "ACCEPTED"
+    tbhdu.header["DATE"] = t_begin.tt.isot
+    tbhdu.header["DATE-OBS"] = t_begin.tt.isot
+    tbhdu.header["DATE-END"] = t_end.tt.isot
+    if "ARF" in parameters:
+        tbhdu.header["ANCRFILE"] = os.path.split(parameters["ARF"])[-1]
+    if "ChannelType" in parameters:
+        tbhdu.header["CHANTYPE"] = parameters["ChannelType"]
+    if "Mission" in parameters:
+        tbhdu.header["MISSION"] = parameters["Mission"]
+    if "Telescope" in parameters:
+        tbhdu.header["TELESCOP"] = parameters["Telescope"]
+    if "Instrument" in parameters:
+        tbhdu.header["INSTRUME"] = parameters["Instrument"]
+
+def _pad_fits_block(f, nbytes):
+    # FITS data units are padded with zeros to a multiple of 2880 bytes
+    pad = -nbytes % 2880
+    if pad > 0:
+        f.write(b"\0"*pad)
+
+def write_fits_event_file(fitsfile, parameters, blocks, clobber=False):
+    r"""
+    Write events to a FITS binary table file, streaming the rows to disk
+    in blocks so that the full table never needs to be held in memory.
+    The header of the EVENTS table is written first, the blocks of rows
+    are appended, and then the number of rows in the header is updated.
+
+    Parameters
+    ----------
+    fitsfile : string
+        The name of the FITS file to write.
+    parameters : dict
+        The parameters of the events, as in the *parameters* attribute
+        of an :class:`~pyxsim.event_list.EventList`.
+    blocks : iterable of dicts
+        The blocks of events, each a dictionary with the ``"xpix"``,
+        ``"ypix"``, and ``"eobs"`` (in keV) arrays, and optionally the
+        channel (e.g. ``"PI"``) and ``"time"`` arrays. Every block must
+        have the same keys.
+    clobber : boolean, optional
+        Set to True to overwrite a previous file.
+
+    Examples
+    --------
+    >>> blocks = (events_for_chunk(chunk) for chunk in chunks)
+    >>> write_fits_event_file("events.fits", events.parameters, blocks,
+    ...                       clobber=True)
+    """
+    from astropy.time import Time, TimeDelta
+    pyfits = _astropy.pyfits
+
+    if os.path.exists(fitsfile) and not clobber:
+        raise IOError("Cannot overwrite existing file %s. " % fitsfile +
+                      "If you want to do this, set clobber=True.")
+
+    exp_time = float(parameters["ExposureTime"])
+
+    t_begin = Time.now()
+    dt = TimeDelta(exp_time, format='sec')
+    t_end = t_begin + dt
+
+    blocks = iter(blocks)
+    first_block = next(blocks, None)
+    has_times = first_block is not None and "time" in first_block
+
+    cols = [pyfits.Column(name='ENERGY', format='E', unit='eV', array=np.zeros(0)),
+            pyfits.Column(name='X', format='D', unit='pixel', array=np.zeros(0)),
+            pyfits.Column(name='Y', format='D', unit='pixel', array=np.zeros(0))]
+    dtype = [("ENERGY", ">f4"), ("X", ">f8"), ("Y", ">f8")]
+    chantype = None
+
+    if "ChannelType" in parameters:
+        chantype = parameters["ChannelType"]
+        if chantype == "PHA":
+            cunit = "adu"
+        elif chantype == "PI":
+            cunit = "Chan"
+        cols.append(pyfits.Column(name=chantype.upper(), format='1J', unit=cunit,
+                                  array=np.zeros(0, dtype="int32")))
+        dtype.append((chantype.upper(), ">i4"))
+    if has_times:
+        cols.append(pyfits.Column(name="TIME", format='1D', unit='s', array=np.zeros(0)))
+        dtype.append(("TIME", ">f8"))
+
+    tbhdu = pyfits.BinTableHDU.from_columns(pyfits.ColDefs(cols))
+    tbhdu.name = "EVENTS"
+    _events_header(tbhdu, parameters, t_begin, t_end)
+
+    # Remove the partially written file if anything goes wrong, so that
+    # a truncated file with an inconsistent header is not left behind
+    try:
+        with open(fitsfile, "wb") as f:
+            f.write(pyfits.PrimaryHDU().header.tostring().encode("ascii"))
+
+            header_start = f.tell()
+            f.write(tbhdu.header.tostring().encode("ascii"))
+
+            num_events = 0
+            if first_block is not None:
+                for block in itertools.chain([first_block], blocks):
+                    n = len(block["xpix"])
+                    rows = np.empty(n, dtype=dtype)
+                    rows["ENERGY"] = block["eobs"]
+                    rows["ENERGY"] *= 1000.
+                    rows["X"] = block["xpix"]
+                    rows["Y"] = block["ypix"]
+                    if chantype is not None:
+                        rows[chantype.upper()] = block[chantype]
+                    if has_times:
+                        rows["TIME"] = block["time"]
+                    f.write(rows.tobytes())
+                    num_events += n
+                    del rows
+
+            _pad_fits_block(f, num_events*np.dtype(dtype).itemsize)
+
+            # Now that we know how many events there are, rewrite the header.
+            # Its length does not change, since only the value of a card does.
+            end_of_events = f.tell()
+            tbhdu.header["NAXIS2"] = num_events
+            f.seek(header_start)
+            f.write(tbhdu.header.tostring().encode("ascii"))
+            f.seek(end_of_events)
+
+            if chantype is not None:
+                start = pyfits.Column(name='START', format='1D', unit='s',
+                                      array=np.array([0.0]))
+                stop = pyfits.Column(name='STOP', format='1D', unit='s',
+                                     array=np.array([exp_time]))
+
+                tbhdu_gti = pyfits.BinTableHDU.from_columns([start,stop])
+                tbhdu_gti.name = "STDGTI"
+                tbhdu_gti.header["TSTART"] = 0.0
+                tbhdu_gti.header["TSTOP"] = exp_time
+                tbhdu_gti.header["HDUCLASS"] = "OGIP"
+                tbhdu_gti.header["HDUCLAS1"] = "GTI"
+                tbhdu_gti.header["HDUCLAS2"] = "STANDARD"
+                tbhdu_gti.header["RADECSYS"] = "FK5"
+                tbhdu_gti.header["EQUINOX"] = 2000.0
+                tbhdu_gti.header["DATE"] = t_begin.tt.isot
+                tbhdu_gti.header["DATE-OBS"] = t_begin.tt.isot
+                tbhdu_gti.header["DATE-END"] = t_end.tt.isot
+
+                gti = np.array([(0.0, exp_time)], dtype=[("START", ">f8"), ("STOP", ">f8")])
+                f.write(tbhdu_gti.header.tostring().encode("ascii"))
+                f.write(gti.tobytes())
+                _pad_fits_block(f, gti.nbytes)
+    except BaseException:
+        if os.path.exists(fitsfile):
+            os.remove(fitsfile)
+        raise
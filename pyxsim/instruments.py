@@ -1,7 +1,10 @@
 import numpy as np
+import numbers
+from six import string_types
 from pyxsim.event_list import EventList
 from pyxsim.responses import AuxiliaryResponseFile, \
-    RedistributionMatrixFile
+    RedistributionMatrixFile, GaussianPSF, VignettingTable, \
+    sigma_to_fwhm
 from pyxsim.utils import mylog
 from yt.funcs import get_pbar, ensure_numpy_array, \
     iterable
@@ -9,11 +12,128 @@ from yt.units.yt_array import YTQuantity, YTArray
 from yt.utilities.on_demand_imports import _astropy
 from copy import deepcopy
 
-sigma_to_fwhm = 2.*np.sqrt(2.*np.log(2.))
+def same_tangent_plane(wcs1, wcs2):
+    """
+    Determine whether two celestial WCSes are simple tangent-plane
+    projections about the same reference point, in which case pixel
+    coordinates in one can be linearly mapped to the other.
+    """
+    w1 = wcs1.wcs
+    w2 = wcs2.wcs
+    if list(w1.ctype) != list(w2.ctype):
+        return False
+    if not np.allclose(w1.crval, w2.crval, rtol=0.0, atol=1.0e-12):
+        return False
+    for w in (w1, w2):
+        if w.has_cd() or not np.allclose(w.get_pc(), np.identity(2)):
+            return False
+    return wcs1.sip is None and wcs2.sip is None
+
+def select_events(events, mask):
+    """
+    Keep only the events in the :class:`~pyxsim.event_list.EventList`
+    *events* where the boolean array *mask* is True, or with the indices
+    *mask*, in place.
+    """
+    idxs = np.asarray(mask)
+    if idxs.dtype == np.bool_:
+        idxs = np.flatnonzero(idxs)
+    for key in list(events.keys()):
+        events.events[key] = events.events[key].take(idxs)
+    events.num_events = idxs.size
+    events._index = None
+
+class ChipLayout(object):
+    r"""
+    The layout of the chips of a detector, which is converted into a
+    boolean mask of the pixels which can detect events.
+
+    Parameters
+    ----------
+    chips : list of 4-tuples of integers
+        The pixel ranges (xmin, xmax, ymin, ymax) of each chip, in detector
+        pixels relative to the aimpoint at the center of the field of view.
+        The maximum values are exclusive.
+    bad_pixels : list of 2-tuples of integers, optional
+        The (x, y) coordinates of bad pixels, in the same coordinates as
+        the chips.
+
+    Examples
+    --------
+    >>> layout = ChipLayout([(-1033, -9, -1033, -9), (9, 1033, -1033, -9),
+    ...                      (-1033, -9, 9, 1033), (9, 1033, 9, 1033)])
+    """
+    def __init__(self, chips, bad_pixels=None):
+        self.chips = np.atleast_2d(np.array(chips, dtype="int64"))
+        self.xmin = self.chips[:,0].min()
+        self.ymin = self.chips[:,2].min()
+        if bad_pixels is not None:
+            bad_pixels = np.atleast_2d(np.array(bad_pixels, dtype="int64"))
+        self.bad_pixels = bad_pixels
+        self._mask = None
+
+    @property
+    def mask(self):
+        """
+        The boolean mask of the good pixels of the chips, which is only
+        made when it is first needed.
+        """
+        if self._mask is None:
+            nx = self.chips[:,1].max()-self.xmin
+            ny = self.chips[:,3].max()-self.ymin
+            mask = np.zeros((ny, nx), dtype="bool")
+            for xmin, xmax, ymin, ymax in self.chips:
+                mask[ymin-self.ymin:ymax-self.ymin,
+                     xmin-self.xmin:xmax-self.xmin] = True
+            if self.bad_pixels is not None:
+                mask[self.bad_pixels[:,1]-self.ymin, self.bad_pixels[:,0]-self.xmin] = False
+            self._mask = mask
+        return self._mask
+
+    @classmethod
+    def from_file(cls, filename):
+        """
+        Read a chip layout from the text file *filename*, which has one
+        line for each chip of the form ``chip xmin xmax ymin ymax``, and
+        one line for each bad pixel of the form ``bad x y``. Blank lines
+        and lines beginning with ``#`` are ignored.
+        """
+        chips = []
+        bad_pixels = []
+        with open(filename, "r") as f:
+            for line in f:
+                words = line.split()
+                if len(words) == 0 or words[0].startswith("#"):
+                    continue
+                if words[0] == "chip":
+                    chips.append([int(w) for w in words[1:5]])
+                elif words[0] == "bad":
+                    bad_pixels.append([int(w) for w in words[1:3]])
+                else:
+                    raise RuntimeError("Unrecognized entry '%s' in chip layout file %s!"
+                                       % (words[0], filename))
+        if len(bad_pixels) == 0:
+            bad_pixels = None
+        return cls(chips, bad_pixels=bad_pixels)
+
+    def on_chips(self, x, y):
+        """
+        Determine which of the positions *x*, *y* (in detector pixels relative
+        to the aimpoint) fall on a good pixel of a chip. Returns a boolean array.
+        """
+        ny, nx = self.mask.shape
+        ix = np.floor(x).astype("int64")-self.xmin
+        iy = np.floor(y).astype("int64")-self.ymin
+        inside = (ix >= 0) & (ix < nx) & (iy >= 0) & (iy < ny)
+        on_chips = np.zeros(inside.shape, dtype="bool")
+        on_chips[inside] = self.mask[iy[inside], ix[inside]]
+        return on_chips
 
 class InstrumentSimulator(object):
-    def __init__(self, dtheta, nx, psf_scale, arf,
-                 rmf):
+    def __init__(self, dtheta, nx, psf, arf,
+                 rmf, vignetting=None, chips=None,
+                 dither_params=None, frame_time=None,
+                 island_size=3):
         """
         Construct an instrument simulator.
 
@@ -24,14 +144,40 @@ class InstrumentSimulator(object):
         nx : integer
             The number of resolution elements on a side across
             the field of view.
-        psf_scale : float
-            The FWHM of the Gaussian PSF in degrees.
+        psf : float or PSF object
+            If a number, the FWHM of a Gaussian PSF in degrees. Otherwise,
+            a PSF object such as :class:`~pyxsim.responses.TabulatedPSF`,
+            which may depend on energy and off-axis angle. The FWHM of the
+            PSF in degrees is stored in the *psf_scale* attribute.
         arf : string
             The path to the ARF file that will be used for
             the effective area.
         rmf : string
             The path to the RMF file that will be used for
             the spectral response matrix. 
+        vignetting : string or :class:`~pyxsim.responses.VignettingTable`, optional
+            The vignetting table (or the path to the file containing it)
+            giving the fraction of the on-axis effective area as a function
+            of energy and off-axis angle. If not specified, the on-axis
+            effective area is used for all events.
+        chips : :class:`~pyxsim.instruments.ChipLayout`, optional
+            The layout of the chips of the detector. If specified, events
+            which do not fall on a good chip pixel are removed. If not
+            specified, the field of view is assumed to be fully covered.
+        dither_params : 4-tuple of floats, optional
+            The parameters of a Lissajous dither pattern, given as
+            (x amplitude, y amplitude, x period, y period), with the
+            amplitudes in arcseconds and the periods in seconds. The
+            dither is only used when applying the chip layout.
+        frame_time : float, optional
+            The readout time of a detector frame in seconds. If specified,
+            pile-up is simulated: events which arrive in the same frame and
+            land in the same island of pixels are detected as a single event
+            with the sum of their energies. 
+        island_size : integer, optional
+            The width in detector pixels of the square islands within which
+            events in the same frame are piled together. Only used if
+            *frame_time* is specified. Default: 3
 
         Examples
         --------
@@ -42,13 +188,28 @@ class InstrumentSimulator(object):
         """
         self.dtheta = dtheta
         self.nx = nx
-        self.psf_scale = psf_scale
+        if isinstance(psf, numbers.Real):
+            self.psf = GaussianPSF(float(psf))
+        else:
+            self.psf = psf
+        # The FWHM of the PSF in degrees, which for a tabulated PSF is
+        # that of its on-axis image at the lowest energy
+        self.psf_scale = float(self.psf.fwhm)
         self.arf = arf
         self.rmf = rmf
+        if isinstance(vignetting, string_types):
+            vignetting = VignettingTable(vignetting)
+        self.vignetting = vignetting
+        self.chips = chips
+        self.dither_params = dither_params
+        self.frame_time = frame_time
+        self.island_size = island_size
+        self._exposure_maps = {}
 
     def __call__(self, events, rebin=True,
                  convolve_psf=True, convolve_arf=True, 
-                 convolve_rmf=True, prng=None):
+                 convolve_rmf=True, apply_chips=True, apply_pileup=True,
+                 prng=None):
         new_events = EventList(deepcopy(events.events), 
                                events.parameters.copy(), events.wcs.copy())
         if prng is None:
@@ -58,45 +219,73 @@ class InstrumentSimulator(object):
         if convolve_psf:
             self.convolve_with_psf(new_events, prng)
         if convolve_arf:
-            new_events["xsky"]
-            new_events["ysky"]
             self.apply_effective_area(new_events, prng)
-            if convolve_rmf:
-                self.convolve_energies(new_events, prng)
+        if apply_chips and self.chips is not None:
+            self.apply_chip_layout(new_events, prng)
+        rmf = None
+        if (apply_pileup and self.frame_time is not None) or \
+            (convolve_arf and convolve_rmf):
+            rmf = RedistributionMatrixFile(self.rmf)
+        if apply_pileup and self.frame_time is not None:
+            self.apply_pileup(new_events, prng, rmf=rmf)
+        if convolve_arf and convolve_rmf:
+            self.convolve_energies(new_events, prng, rmf=rmf)
         return new_events
 
-    def rebin(self, events):
-        """
-        Rebin event positions to a new binning with the same celestial
-        coordinates.
-        """
+    def _make_wcs(self, sky_center):
         new_wcs = _astropy.pywcs.WCS(naxis=2)
-        new_wcs.wcs.crval = events.parameters["sky_center"].d
+        new_wcs.wcs.crval = sky_center
         new_wcs.wcs.crpix = np.array([0.5*(self.nx+1)]*2)
         new_wcs.wcs.cdelt = [-self.dtheta, self.dtheta]
         new_wcs.wcs.ctype = ["RA---TAN","DEC--TAN"]
         new_wcs.wcs.cunit = ["deg"]*2
-        xpix, ypix = new_wcs.wcs_world2pix(events["xsky"], events["ysky"], 1)
+        return new_wcs
+
+    def rebin(self, events):
+        """
+        Rebin event positions to a new binning with the same celestial
+        coordinates. If the old and new WCSes share the same tangent point,
+        the pixel coordinates are transformed directly without a round-trip
+        through the sky coordinates, which are only recomputed if needed.
+        """
+        new_wcs = self._make_wcs(events.parameters["sky_center"].d)
+        if same_tangent_plane(events.wcs, new_wcs):
+            scale = events.wcs.wcs.cdelt/new_wcs.wcs.cdelt
+            xpix = events["xpix"]-events.wcs.wcs.crpix[0]
+            xpix *= scale[0]
+            xpix += new_wcs.wcs.crpix[0]
+            ypix = events["ypix"]-events.wcs.wcs.crpix[1]
+            ypix *= scale[1]
+            ypix += new_wcs.wcs.crpix[1]
+        else:
+            xpix, ypix = new_wcs.wcs_world2pix(events["xsky"], events["ysky"], 1)
         events.events['xpix'] = xpix
         events.events['ypix'] = ypix
-        xsky, ysky = new_wcs.wcs_pix2world(events["xpix"], events["ypix"], 1)
-        events.events['xsky'] = xsky
-        events.events['ysky'] = ysky
+        events.clear_sky_coords()
         events.parameters['pix_center'] = new_wcs.wcs.crpix[:]
         events.parameters['dtheta'] = YTQuantity(self.dtheta, "deg")
         events.wcs = new_wcs
 
+    def _off_axis_angle(self, events):
+        # The off-axis angle of the events in arcminutes, measured
+        # from the center of the field of view
+        xc, yc = events.parameters["pix_center"]
+        theta = np.hypot(events["xpix"]-xc, events["ypix"]-yc)
+        theta *= 60.0*float(events.parameters["dtheta"])
+        return theta
+
     def convolve_with_psf(self, events, prng):
         r"""
-        Convolve the event positions with a PSF.
+        Convolve the event positions with a PSF. The off-axis angle of
+        each event is measured from the center of the field of view.
         """
-        dtheta = events.parameters["dtheta"]
-        psf = lambda n: prng.normal(scale=self.psf_scale/sigma_to_fwhm/dtheta, size=n)
-        events.events["xpix"] += psf(events.num_events)
-        events.events["ypix"] += psf(events.num_events)
-        xsky, ysky = events.wcs.wcs_pix2world(events["xpix"], events["ypix"], 1)
-        events.events['xsky'] = xsky
-        events.events['ysky'] = ysky
+        mylog.info("Convolving event positions with the PSF.")
+        dtheta = float(events.parameters["dtheta"])
+        theta = self._off_axis_angle(events)
+        dx, dy = self.psf.generate_offsets(events["eobs"].d, theta, prng=prng)
+        events.events["xpix"] += dx/dtheta
+        events.events["ypix"] += dy/dtheta
+        events.clear_sky_coords()
 
     def apply_effective_area(self, events, prng):
         """
@@ -110,19 +299,115 @@ class InstrumentSimulator(object):
             raise RuntimeError("The area used to create the events is less than "
                                "the maximum of the effective area curve! Re-create the "
                                "events with a collecting area higher than %s!" % arf.max_area)
-        detected = arf.detect_events(events["eobs"], events.parameters["Area"], prng=prng)
+        if self.vignetting is None:
+            detected = arf.detect_events(events["eobs"], events.parameters["Area"], prng=prng)
+        else:
+            mylog.info("Applying vignetting from %s." % self.vignetting)
+            theta = self._off_axis_angle(events)
+            detected = arf.detect_events(events["eobs"], events.parameters["Area"], prng=prng,
+                                         theta=theta, vignetting=self.vignetting)
         mylog.info("%s events detected." % detected.sum())
-        for key in ["xpix", "ypix", "xsky", "ysky", "eobs"]:
-            events.events[key] = events[key][detected]
+        select_events(events, detected)
         events.parameters["ARF"] = arf.filename
-        events.num_events = len(events.events["eobs"])
 
-    def convolve_energies(self, events, prng):
+    def _assign_times(self, events, prng):
+        if "time" not in events:
+            events.events["time"] = prng.uniform(low=0.0, size=events.num_events,
+                                                 high=float(events.parameters["ExposureTime"]))
+
+    def _detector_coords(self, events):
+        # The positions of the events in detector pixels relative
+        # to the aimpoint at the center of the field of view
+        scale = float(events.parameters["dtheta"])/self.dtheta
+        xc, yc = events.parameters["pix_center"]
+        detx = events["xpix"]-xc
+        detx *= scale
+        dety = events["ypix"]-yc
+        dety *= scale
+        return detx, dety
+
+    def dither_offsets(self, time):
+        """
+        Return the x and y offsets of the Lissajous dither pattern in
+        degrees at the times *time* (in seconds).
+        """
+        amp_x, amp_y, period_x, period_y = self.dither_params
+        dx = amp_x/3600.*np.sin(2.*np.pi*time/period_x)
+        dy = amp_y/3600.*np.sin(2.*np.pi*time/period_y)
+        return dx, dy
+
+    def apply_chip_layout(self, events, prng):
+        """
+        Remove the events which do not fall on a good pixel of a chip. If
+        dithering is turned on, the detector position of each event is
+        offset by the dither pattern at the time of the event, which is
+        assigned uniformly over the exposure if the events do not have times.
+        """
+        mylog.info("Applying the chip layout.")
+        detx, dety = self._detector_coords(events)
+        if self.dither_params is not None:
+            self._assign_times(events, prng)
+            dx, dy = self.dither_offsets(events["time"])
+            detx -= dx/self.dtheta
+            dety -= dy/self.dtheta
+        on_chips = self.chips.on_chips(detx, dety)
+        mylog.info("%d events fell on the chips." % on_chips.sum())
+        select_events(events, on_chips)
+
+    def apply_pileup(self, events, prng, rmf=None):
         """
-        Convolve the events with a RMF file.
+        Simulate pile-up by merging events which arrive within the same
+        frame and land within the same island of pixels into single events,
+        with the position and time of the first event and the sum of the
+        energies. Events are assigned times uniformly over the exposure if
+        they do not have them. Piled events with energies above the maximum
+        energy of the response are removed. The
+        :class:`~pyxsim.responses.RedistributionMatrixFile` *rmf* is read
+        from the instrument's RMF if it is not given.
         """
-        mylog.info("Reading response matrix file (RMF): %s" % self.rmf)
-        rmf = RedistributionMatrixFile(self.rmf)
+        mylog.info("Simulating pile-up with a frame time of %g s." % self.frame_time)
+        if events.num_events == 0:
+            return
+        self._assign_times(events, prng)
+        detx, dety = self._detector_coords(events)
+        ix = np.floor(detx/self.island_size).astype("int64")
+        iy = np.floor(dety/self.island_size).astype("int64")
+        ix -= ix.min()
+        iy -= iy.min()
+        frame = np.floor(events["time"]/self.frame_time).astype("int64")
+        cell = (frame*(iy.max()+1)+iy)*(ix.max()+1)+ix
+        # Sort the events by their (frame, island) cells and find the
+        # beginning of each segment of identical cells
+        idxs = np.argsort(cell, kind="mergesort")
+        cell = cell[idxs]
+        starts = np.concatenate([[0], np.nonzero(np.diff(cell))[0]+1])
+        counts = np.diff(np.append(starts, idxs.size))
+        piled = counts > 1
+        mylog.info("%d events were piled into %d events." %
+                   (counts[piled].sum(), piled.sum()))
+        eobs = np.add.reduceat(events["eobs"].d[idxs], starts)
+        # Keep the first event of each cell, in the original order
+        first = idxs[starts]
+        eobs = eobs[np.argsort(first)]
+        keep = np.zeros(events.num_events, dtype="bool")
+        keep[first] = True
+        select_events(events, keep)
+        events.events["eobs"] = YTArray(eobs, "keV")
+        if rmf is None:
+            rmf = RedistributionMatrixFile(self.rmf)
+        emax = rmf.ehi[-1]
+        if eobs.max() >= emax:
+            select_events(events, eobs < emax)
+
+    def convolve_energies(self, events, prng, rmf=None):
+        """
+        Convolve the events with a RMF file. The
+        :class:`~pyxsim.responses.RedistributionMatrixFile` *rmf* is read
+        from the instrument's RMF if it is not given.
+        """
+        if rmf is None:
+            mylog.info("Reading response matrix file (RMF): %s" % self.rmf)
+            rmf = RedistributionMatrixFile(self.rmf)
 
         eidxs = np.argsort(events["eobs"])
         sorted_e = events["eobs"][eidxs].d
@@ -165,8 +450,12 @@ class InstrumentSimulator(object):
 
         pbar.finish()
 
-        for key in ["xpix", "ypix", "xsky", "ysky"]:
-            events.events[key] = events[key][eidxs]
+        # The events are now sorted by energy, so the spatial index of
+        # their old order must be rebuilt
+        for key in list(events.keys()):
+            if key != "eobs":
+                events.events[key] = events.events[key][eidxs]
+        events._index = None
 
         events.events["eobs"] = YTArray(sorted_e, "keV")
         events.events[rmf.header["CHANTYPE"]] = np.concatenate(detectedChannels).astype("int")
@@ -177,6 +466,209 @@ class InstrumentSimulator(object):
         events.parameters["Instrument"] = rmf.header["INSTRUME"]
         events.parameters["Mission"] = rmf.header.get("MISSION","")
 
+    def make_exposure_map(self, events, emin=None, emax=None, reblock=1,
+                          coarse_size=16):
+        r"""
+        Make an exposure map, i.e. the effective area multiplied by the exposure
+        time, on the image grid of :meth:`~pyxsim.event_list.EventList.write_fits_image`
+        for the events *events*, which should have been created by this instrument.
+        The effective area is averaged over the energy band, and includes the
+        vignetting and the chip layout smeared by the dither pattern if the
+        instrument has them. Returns a :class:`~yt.units.yt_array.YTArray` in
+        cm**2*s with shape (ny, nx).
+
+        The exposure maps are cached by energy band, pointing, and image grid,
+        so further calls for the same band and pointing are fast.
+
+        Parameters
+        ----------
+        events : :class:`~pyxsim.event_list.EventList`
+            The events to make the exposure map for, which determine the pointing,
+            image grid, and exposure time.
+        emin : float, optional
+            The minimum energy of the band in keV. Default is the minimum energy
+            of the ARF.
+        emax : float, optional
+            The maximum energy of the band in keV. Default is the maximum energy
+            of the ARF.
+        reblock : integer, optional
+            The number of event list pixels along each axis which are binned
+            into one image pixel. Default: 1
+        coarse_size : integer, optional
+            The vignetted effective area is computed on a coarse grid with this
+            spacing in image pixels and bilinearly interpolated to the image
+            pixels. Default: 16
+        """
+        pix_center = tuple(float(c) for c in events.parameters["pix_center"])
+        dtheta = float(events.parameters["dtheta"])
+        sky_center = tuple(float(c) for c in events.parameters["sky_center"])
+        key = (emin, emax, sky_center, pix_center, dtheta, reblock, coarse_size)
+        if key not in self._exposure_maps:
+            self._exposure_maps[key] = self._make_exposure_map(pix_center, dtheta, emin, emax,
+                                                               reblock, coarse_size)
+        exp_time = float(events.parameters["ExposureTime"])
+        return YTArray(self._exposure_maps[key]*exp_time, "cm**2*s")
+
+    def write_exposure_map(self, events, expfile, emin=None, emax=None, reblock=1,
+                           clobber=False):
+        r"""
+        Make an exposure map with :meth:`~pyxsim.instruments.InstrumentSimulator.make_exposure_map`
+        and write it to the FITS file *expfile*, with the same WCS as the image
+        written by :meth:`~pyxsim.event_list.EventList.write_fits_image` for the
+        same *reblock*. Set *clobber* to True to overwrite a previous file.
+        """
+        expmap = self.make_exposure_map(events, emin=emin, emax=emax, reblock=reblock)
+        hdu = _astropy.pyfits.PrimaryHDU(expmap.d)
+        events._image_header(hdu.header, reblock)
+        hdu.header["BUNIT"] = "cm**2*s"
+        hdu.writeto(expfile, clobber=clobber)
+
+    def _make_exposure_map(self, pix_center, dtheta, emin, emax, reblock, coarse_size):
+        # The exposure map per unit time on the grid of image pixels
+        xc, yc = pix_center
+        nx = int(2*xc-1.)
+        ny = int(2*yc-1.)
+        nxb = -(-nx // reblock)
+        nyb = -(-ny // reblock)
+
+        if self.chips is None:
+            frac = np.ones((nyb, nxb))
+            x0, y0 = 0, 0
+        else:
+            frac, x0, y0 = self._chip_fraction(nx, ny, xc, yc, dtheta, reblock)
+        fy, fx = frac.shape
+
+        # The effective area averaged over the energy band, tabulated
+        # on the off-axis angles of the vignetting table
+        arf = AuxiliaryResponseFile(self.arf, rmffile=self.rmf)
+        elo = arf.elo.d
+        ehi = arf.ehi.d
+        if emin is None:
+            emin = elo[0]
+        if emax is None:
+            emax = ehi[-1]
+        weights = np.clip(np.minimum(ehi, emax)-np.maximum(elo, emin), 0.0, None)
+        if weights.sum() <= 0.0:
+            raise ValueError("The energy band (%g, %g) keV does not overlap " % (emin, emax) +
+                             "the energies of the ARF!")
+        weights /= weights.sum()
+        expmap = np.zeros((nyb, nxb))
+        if self.vignetting is None:
+            area = np.dot(weights, arf.eff_area.d)
+            expmap[y0:y0+fy,x0:x0+fx] = area*frac
+            return expmap
+
+        area_grid = arf.eff_area.d[:,np.newaxis]*self.vignetting.interpolate_energies(arf.emid.d)
+        area_theta = np.dot(weights, area_grid)
+
+        # The off-axis angle is smooth, so the vignetted area is computed on
+        # a coarse grid of image pixels and bilinearly interpolated
+        ix, iwx, jx, wx = _coarse_weights(fx, coarse_size)
+        iy, iwy, jy, wy = _coarse_weights(fy, coarse_size)
+        xn = 0.5+(x0+ix+0.5)*reblock
+        yn = 0.5+(y0+iy+0.5)*reblock
+        theta = np.hypot(xn[np.newaxis,:]-xc, yn[:,np.newaxis]-yc)
+        theta *= 60.0*dtheta
+        it, jt, wt = self.vignetting.theta_weights(theta)
+        coarse = (1.-wt)*area_theta[it]+wt*area_theta[jt]
+        coarse = (1.-wx)*coarse[:,iwx]+wx*coarse[:,jx]
+        coarse = (1.-wy)[:,np.newaxis]*coarse[iwy,:]+wy[:,np.newaxis]*coarse[jy,:]
+
+        expmap[y0:y0+fy,x0:x0+fx] = coarse*frac
+        return expmap
+
+    def _chip_fraction(self, nx, ny, xc, yc, dtheta, reblock):
+        # The fraction of the time each image pixel is on a good chip pixel,
+        # on the smallest window of image pixels which can be exposed. The
+        # chip mask is sampled at the event list pixels and averaged over
+        # the image pixels, and then convolved with the distribution of the
+        # dither offsets using FFTs.
+        layout = self.chips
+        scale = dtheta/self.dtheta
+        if self.dither_params is not None:
+            kernel = self._dither_kernel(dtheta*reblock)
+        else:
+            kernel = np.ones((1, 1))
+        kh = kernel.shape[0]//2
+
+        def _window(n, nb, pc, dmin, size):
+            # The detector pixel of each event list pixel along an axis, and
+            # the range of image pixels which can be exposed
+            det = np.floor((np.arange(n)+1.-pc)*scale).astype("int64")-dmin
+            on = np.nonzero((det >= 0) & (det < size))[0]
+            if on.size == 0:
+                return det, 0, 0
+            b0 = max(on[0]//reblock-kh-1, 0)
+            b1 = min(on[-1]//reblock+kh+2, nb)
+            return det, b0, b1
+
+        nxb = -(-nx // reblock)
+        nyb = -(-ny // reblock)
+        my, mx = layout.mask.shape
+        detx, x0, x1 = _window(nx, nxb, xc, layout.xmin, mx)
+        dety, y0, y1 = _window(ny, nyb, yc, layout.ymin, my)
+        fx = x1-x0
+        fy = y1-y0
+        if fx == 0 or fy == 0:
+            # No image pixel can be exposed
+            return np.zeros((nyb, nxb)), 0, 0
+
+        # Sample the mask at the event list pixels in the window, padded
+        # to whole image pixels
+        detx = np.append(detx, -np.ones(nxb*reblock-nx, dtype="int64"))[x0*reblock:x1*reblock]
+        dety = np.append(dety, -np.ones(nyb*reblock-ny, dtype="int64"))[y0*reblock:y1*reblock]
+        vx = (detx >= 0) & (detx < mx)
+        vy = (dety >= 0) & (dety < my)
+        mask = layout.mask[np.ix_(np.where(vy, dety, 0), np.where(vx, detx, 0))]
+        mask &= vy[:,np.newaxis] & vx[np.newaxis,:]
+        frac = mask.reshape(fy, reblock, fx, reblock).mean(axis=(1, 3))
+
+        if kh > 0:
+            shape = (fy+2*kh, fx+2*kh)
+            conv = np.fft.irfft2(np.fft.rfft2(frac, shape)*np.fft.rfft2(kernel, shape), shape)
+            frac = np.clip(conv[kh:kh+fy,kh:kh+fx], 0.0, 1.0)
+
+        return frac, x0, y0
+
+    def _dither_kernel(self, pixel_size, num_samples=100000):
+        # The distribution of the dither offsets over many periods of the
+        # Lissajous pattern, binned into pixels of size *pixel_size* (in
+        # degrees) on a square grid centered on zero offset
+        amp_x, amp_y, period_x, period_y = self.dither_params
+        t = (np.arange(num_samples)+0.5)*100.*max(period_x, period_y)/num_samples
+        dx, dy = self.dither_offsets(t)
+        ix = np.rint(dx/pixel_size).astype("int64")
+        iy = np.rint(dy/pixel_size).astype("int64")
+        kh = max(np.abs(ix).max(), np.abs(iy).max())
+        n = 2*kh+1
+        kernel = np.bincount((iy+kh)*n+ix+kh, minlength=n*n).reshape(n, n)
+        return kernel/float(num_samples)
+
+def _coarse_weights(n, coarse_size):
+    # The nodes of a coarse grid with spacing *coarse_size* over *n*
+    # pixels, which includes the last pixel, and the lower and upper nodes
+    # and the linear interpolation weight for each pixel
+    nodes = np.arange(0, n, coarse_size)
+    if nodes[-1] != n-1:
+        nodes = np.append(nodes, n-1)
+    pix = np.arange(n)
+    i = np.clip(np.searchsorted(nodes, pix, side="right")-1, 0, max(nodes.size-2, 0))
+    j = np.minimum(i+1, nodes.size-1)
+    w = np.zeros(n)
+    span = nodes[j]-nodes[i]
+    w[span > 0] = (pix-nodes[i])[span > 0]/span[span > 0].astype("float64")
+    return nodes, i, j, w
+
+# Approximate chip layouts, in detector pixels relative to the aimpoint
+
+ACIS_I_chips = ChipLayout([(-1033, -9, -1033, -9), (9, 1033, -1033, -9),
+                           (-1033, -9, 9, 1033), (9, 1033, 9, 1033)])
+ACIS_S_chips = ChipLayout([(-3638, -2614, -512, 512), (-2596, -1572, -512, 512),
+                           (-1554, -530, -512, 512), (-512, 512, -512, 512),
+                           (530, 1554, -512, 512), (1572, 2596, -512, 512)])
+Athena_WFI_chips = ChipLayout([(-516, -4, -516, -4), (4, 516, -516, -4),
+                               (-516, -4, 4, 516), (4, 516, 4, 516)])
+
 # Specific instrument approximations
 
 ACIS_S = InstrumentSimulator(0.0001366667, 8192, 0.0001388889,
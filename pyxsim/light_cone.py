@@ -0,0 +1,396 @@
+"""
+Classes for assembling event lists along a light cone from
+photons generated from many datasets.
+"""
+import numpy as np
+import os
+import types
+import numbers
+import hashlib
+from six import string_types
+from yt.funcs import iterable
+from yt.units.yt_array import YTQuantity, YTArray
+from yt.utilities.cosmology import Cosmology
+from yt.data_objects.static_output import Dataset
+from pyxsim.photon_list import PhotonList, _parse_h5_parameters
+from pyxsim.event_list import EventList
+from pyxsim.light_curves import LightCurve
+from pyxsim.utils import mylog, parse_value, force_unicode
+from yt.utilities.parallel_tools.parallel_analysis_interface import \
+    communication_system
+
+comm = communication_system.communicators[-1]
+
+# Attributes of source models which are only set while photons are being
+# generated, and so are not part of the description of the model
+_run_time_attrs = ["prng", "pbar", "spectral_norm", "redshift", "source_type",
+                   "scale_factor"]
+
+def _dataset_fingerprint(ds):
+    # A dataset on disk is identified by the absolute path of its file,
+    # whether it is given by name or has already been loaded
+    if isinstance(ds, string_types):
+        return os.path.abspath(ds)
+    fn = getattr(ds, "parameter_filename", None)
+    if isinstance(fn, string_types) and os.path.exists(fn):
+        return os.path.abspath(fn)
+    return "%s %s" % (ds, getattr(ds, "unique_identifier", ""))
+
+def _fingerprint(obj, depth=0):
+    # A string describing *obj* which does not depend on where it is stored
+    # in memory, so that it can be compared between sessions. Functions are
+    # described by their code and the values they refer to, and other
+    # objects by their class and attributes.
+    if depth > 6:
+        return type(obj).__name__
+    depth += 1
+    if obj is None or isinstance(obj, (bool, numbers.Number, string_types, bytes)):
+        return repr(obj)
+    if isinstance(obj, np.random.RandomState) or obj is np.random:
+        return "prng"
+    if isinstance(obj, Dataset):
+        return _dataset_fingerprint(obj)
+    if isinstance(obj, YTArray):
+        return "%s %s" % (_fingerprint(obj.d, depth), obj.units)
+    if isinstance(obj, np.ndarray):
+        if obj.dtype.kind == "O":
+            return _fingerprint(obj.tolist(), depth)
+        data = hashlib.sha1(np.ascontiguousarray(obj).tobytes()).hexdigest()
+        return "array(%s, %s, %s)" % (obj.dtype.str, obj.shape, data)
+    if isinstance(obj, (list, tuple)):
+        return "(%s)" % ", ".join(_fingerprint(v, depth) for v in obj)
+    if isinstance(obj, dict):
+        items = sorted((_fingerprint(k, depth), _fingerprint(v, depth))
+                       for k, v in obj.items())
+        return "{%s}" % ", ".join("%s: %s" % kv for kv in items)
+    if isinstance(obj, types.FunctionType):
+        code = obj.__code__
+        closure = [c.cell_contents for c in (obj.__closure__ or [])]
+        values = [(name, obj.__globals__[name]) for name in _code_names(code)
+                  if name in obj.__globals__ and not
+                  isinstance(obj.__globals__[name], (types.ModuleType, type,
+                                                     types.FunctionType))]
+        return "function(%s, %s, %s, %s)" % (_fingerprint(code, depth),
+                                             _fingerprint(obj.__defaults__, depth),
+                                             _fingerprint(closure, depth),
+                                             _fingerprint(values, depth))
+    if isinstance(obj, types.CodeType):
+        return "code(%s, %s, %s)" % (hashlib.sha1(obj.co_code).hexdigest(),
+                                     _fingerprint(obj.co_consts, depth),
+                                     _fingerprint(obj.co_names, depth))
+    if isinstance(obj, types.ModuleType):
+        return obj.__name__
+    if isinstance(obj, type):
+        return "%s.%s" % (obj.__module__, obj.__name__)
+    if hasattr(obj, "__dict__"):
+        attrs = dict((k, v) for k, v in vars(obj).items()
+                     if not k.startswith("_") and k not in _run_time_attrs)
+        return "%s%s" % (type(obj).__name__, _fingerprint(attrs, depth))
+    return type(obj).__name__
+
+def _code_names(code):
+    # The global names used by *code* and the functions defined in it
+    names = list(code.co_names)
+    for c in code.co_consts:
+        if isinstance(c, types.CodeType):
+            names += _code_names(c)
+    return names
+
+class LightCone(object):
+    r"""
+    A light cone made from a sequence of slices, each of which is a dataset
+    covering a range of redshift. Photons are generated from each slice at the
+    lowest redshift of its range, and projected to the redshift in the middle
+    of the range, and the events from all of the slices are combined into a
+    single :class:`~pyxsim.event_list.EventList` with a shared field of view.
+
+    Parameters
+    ----------
+    slices : list of tuples
+        The slices of the light cone, each a tuple of (dataset, (zmin, zmax))
+        or (dataset, (zmin, zmax), region). The dataset may be a yt dataset or
+        the name of a file which can be loaded by yt, which is only loaded when
+        the photons for the slice are generated. The region, if given, is a
+        function which takes the dataset and returns the data source to
+        generate the photons from. Otherwise, the whole dataset is used.
+    fov : float, (value, unit) tuple, or :class:`~yt.units.yt_array.YTQuantity`
+        The width of the field of view of the events. If units are not specified,
+        it is assumed to be in arcminutes.
+    nx : integer
+        The number of pixels on a side of the field of view.
+    sky_center : array_like, optional
+        The RA, Dec of the center of the field of view in degrees.
+        Default: (30.0, 45.0)
+    cosmology : :class:`~yt.utilities.cosmology.Cosmology`, optional
+        The cosmology for the distances to the slices. If not given, the
+        cosmology of the first dataset is used if it has one, otherwise LCDM
+        with the default yt parameters.
+    cache_dir : string, optional
+        A directory in which the photons of each slice are stored after they
+        are generated. If a slice already has photons in this directory with
+        the same redshift, area, and exposure time, which were generated from
+        the same dataset and region with the same source model and parameters,
+        they are read instead of being generated again, so that e.g. new
+        projections or instrument simulations of the light cone do not require
+        generating the photons.
+
+    Notes
+    -----
+    The slices are processed serially. When run in parallel, the photons of each
+    slice are generated and projected by all of the processes together, since
+    writing the photons of a slice uses collective operations over all of them,
+    so the slices themselves are not distributed among the processes.
+
+    Examples
+    --------
+    >>> slices = [("DD0040/DD0040", (0.05, 0.1)),
+    ...           ("DD0035/DD0035", (0.1, 0.2), lambda ds: ds.box(le, re))]
+    >>> lc = LightCone(slices, (20.0, "arcmin"), 1024, cache_dir="lc_photons")
+    >>> lc.make_photons(3000.0, 1.0e5, thermal_model)
+    >>> events = lc.project_photons("z", absorb_model=tbabs_model)
+    """
+    def __init__(self, slices, fov, nx, sky_center=None, cosmology=None,
+                 cache_dir=None):
+        self.slices = []
+        for sl in slices:
+            if len(sl) == 2:
+                sl = tuple(sl) + (None,)
+            ds, zrange, region = sl
+            zmin, zmax = zrange
+            if zmin <= 0.0 or zmax < zmin:
+                raise ValueError("The redshift range of each slice must have "
+                                 "0 < zmin <= zmax, not (%g, %g)!" % (zmin, zmax))
+            self.slices.append((ds, (float(zmin), float(zmax)), region))
+        self.fov = parse_value(fov, "arcmin")
+        self.nx = int(nx)
+        if sky_center is None:
+            sky_center = [30., 45.]
+        self.sky_center = YTArray(sky_center, "degree")
+        self.dtheta = (self.fov/self.nx).in_units("degree")
+        self.cosmology = cosmology
+        self.cache_dir = cache_dir
+        self._photons = [None]*len(self.slices)
+        self._fingerprints = [None]*len(self.slices)
+
+    @property
+    def redshifts(self):
+        """
+        The redshifts in the middle of the ranges of the slices, at which
+        the events of the slices are projected.
+        """
+        return np.array([0.5*(zmin+zmax) for ds, (zmin, zmax), region in self.slices])
+
+    def _cache_file(self, i):
+        return os.path.join(self.cache_dir, "slice_%04d.h5" % i)
+
+    def _slice_fingerprint(self, i, source_model, parameters, center,
+                           velocity_fields):
+        # A digest of everything which determines the photons of slice i
+        # apart from the redshift, area, and exposure time
+        ds, zrange, region = self.slices[i]
+        desc = [_dataset_fingerprint(ds), _fingerprint(region),
+                _fingerprint(source_model), _fingerprint(parameters),
+                _fingerprint(center), _fingerprint(velocity_fields)]
+        return hashlib.sha1("\n".join(desc).encode("utf8")).hexdigest()
+
+    def _load_slice(self, i):
+        ds, zrange, region = self.slices[i]
+        if isinstance(ds, string_types):
+            from yt.convenience import load
+            ds = load(ds)
+        if region is None:
+            data_source = ds.all_data()
+        else:
+            data_source = region(ds)
+        return ds, data_source
+
+    def make_photons(self, area, exp_time, source_model, parameters=None,
+                     center=None, velocity_fields=None, clobber=False):
+        r"""
+        Generate the photons for each slice of the light cone at the lowest
+        redshift of its range, using
+        :meth:`~pyxsim.photon_list.PhotonList.from_data_source`. The slices
+        are processed one after the other, and the photons of each slice are
+        generated in parallel if pyXSIM is run with MPI. If the light cone has
+        a *cache_dir*, the photons are written there, and slices which were
+        already generated with the same redshift, area, exposure time, dataset,
+        region, source model, and parameters are skipped. Region functions are
+        compared by their code and the values they refer to.
+
+        Parameters
+        ----------
+        area : float, (value, unit) tuple, or :class:`~yt.units.yt_array.YTQuantity`
+            The collecting area to determine the number of photons. If units are
+            not specified, it is assumed to be in cm^2.
+        exp_time : float, (value, unit) tuple, or :class:`~yt.units.yt_array.YTQuantity`
+            The exposure time to determine the number of photons. If units are
+            not specified, it is assumed to be in seconds.
+        source_model : :class:`~pyxsim.source_models.SourceModel`
+            A source model used to generate the photons.
+        parameters : dict, optional
+            A dictionary of parameters to be passed for the source model to use, if necessary.
+        center : string or array_like, optional
+            The origin of the photon spatial coordinates in each slice. See
+            :meth:`~pyxsim.photon_list.PhotonList.from_data_source`.
+        velocity_fields : list of fields, optional
+            The yt fields to use for the velocity.
+        clobber : boolean, optional
+            If True, the photons are generated again even if they are in the cache.
+        """
+        area = parse_value(area, "cm**2")
+        exp_time = parse_value(exp_time, "s")
+        if self.cache_dir is not None and not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        for i, (ds, (zmin, zmax), region) in enumerate(self.slices):
+            fingerprint = self._slice_fingerprint(i, source_model, parameters, center,
+                                                  velocity_fields)
+            if not clobber and self._is_cached(i, zmin, area, exp_time, fingerprint):
+                mylog.info("Using the cached photons for slice %d." % i)
+                continue
+            mylog.info("Generating photons for slice %d at z = %g." % (i, zmin))
+            ds, data_source = self._load_slice(i)
+            if self.cosmology is None:
+                if hasattr(ds, "cosmology"):
+                    self.cosmology = ds.cosmology
+                else:
+                    self.cosmology = Cosmology()
+            if parameters is None:
+                params = None
+            else:
+                params = parameters.copy()
+            photons = PhotonList.from_data_source(data_source, zmin, area, exp_time,
+                                                  source_model, parameters=params,
+                                                  center=center, cosmology=self.cosmology,
+                                                  velocity_fields=velocity_fields)
+            if self.cache_dir is None:
+                self._photons[i] = photons
+                self._fingerprints[i] = fingerprint
+            else:
+                photons.write_h5_file(self._cache_file(i))
+                if comm.rank == 0:
+                    import h5py
+                    with h5py.File(self._cache_file(i), "r+") as f:
+                        f.attrs["slice_fingerprint"] = fingerprint
+                comm.barrier()
+                self._photons[i] = None
+
+    def _is_cached(self, i, redshift, area, exp_time, fingerprint):
+        # Whether the photons for slice i were generated with the same
+        # parameters and from the same slice with the same source model,
+        # either in memory or in the cache directory
+        photons = self._photons[i]
+        if photons is not None:
+            p = photons.parameters
+            cached_fingerprint = self._fingerprints[i]
+        elif self.cache_dir is not None and os.path.exists(self._cache_file(i)):
+            import h5py
+            with h5py.File(self._cache_file(i), "r") as f:
+                p = _parse_h5_parameters(f["parameters"])
+                cached_fingerprint = f.attrs.get("slice_fingerprint", None)
+        else:
+            return False
+        if cached_fingerprint is None or \
+            force_unicode(cached_fingerprint) != fingerprint:
+            return False
+        return np.isclose(float(p["FiducialRedshift"]), redshift, rtol=1.0e-10) and \
+            np.isclose(float(p["FiducialArea"].in_units("cm**2")), float(area), rtol=1.0e-10) and \
+            np.isclose(float(p["FiducialExposureTime"].in_units("s")), float(exp_time), rtol=1.0e-10)
+
+    def _get_photons(self, i):
+        if self._photons[i] is not None:
+            return self._photons[i]
+        if self.cache_dir is not None and os.path.exists(self._cache_file(i)):
+            return PhotonList.from_file(self._cache_file(i))
+        raise RuntimeError("The photons for slice %d have not been generated! " % i +
+                           "Call make_photons first.")
+
+    def project_photons(self, normal, area_new=None, exp_time_new=None,
+                        absorb_model=None, no_shifting=False, north_vector=None,
+                        prng=None, light_curve=None):
+        r"""
+        Project the photons of each slice of the light cone to the redshift in
+        the middle of its range with :meth:`~pyxsim.photon_list.PhotonList.project_photons`,
+        and combine the events of all of the slices into a single
+        :class:`~pyxsim.event_list.EventList` on the field of view of the
+        light cone. Only the photons of one slice at a time are held in memory.
+        Events which fall outside of the field of view are removed.
+
+        Parameters
+        ----------
+        normal : character, array_like, or list of them
+            The normal vector to the plane of projection, as in
+            :meth:`~pyxsim.photon_list.PhotonList.project_photons`, or a list of
+            one normal for each slice.
+        area_new : float, (value, unit) tuple, or :class:`~yt.units.yt_array.YTQuantity`, optional
+            New value for the (constant) collecting area of the detector.
+        exp_time_new : float, (value, unit) tuple, or :class:`~yt.units.yt_array.YTQuantity`, optional
+            The new value for the exposure time.
+        absorb_model : :class:`~pyxsim.spectral_models.AbsorptionModel`, optional
+            A model for foreground galactic absorption.
+        no_shifting : boolean, optional
+            If set, the photon energies will not be Doppler shifted.
+        north_vector : a sequence of floats, optional
+            A vector defining the "up" direction for off-axis projections.
+        prng : :class:`~numpy.random.RandomState` object or :mod:`~numpy.random`, optional
+            A pseudo-random number generator. Typically will only be specified
+            if you have a reason to generate the same set of random numbers, such as for a
+            test. Default is the :mod:`numpy.random` module.
+        light_curve : :class:`~pyxsim.light_curves.LightCurve` or list of them, optional
+            The light curve which the times of the events are drawn from, or a
+            list of one light curve for each slice (None for a constant slice).
+            If not set, the times of the events are uniform over the exposure.
+        """
+        if isinstance(normal, string_types) or not iterable(normal) or \
+            not (isinstance(normal[0], string_types) or iterable(normal[0])):
+            normal = [normal]*len(self.slices)
+        if len(normal) != len(self.slices):
+            raise ValueError("The number of normals does not match the number of slices!")
+        if light_curve is None or isinstance(light_curve, LightCurve):
+            light_curve = [light_curve]*len(self.slices)
+        if len(light_curve) != len(self.slices):
+            raise ValueError("The number of light curves does not match the number of slices!")
+
+        dtheta = float(self.dtheta)
+        pix_center = 0.5*(self.nx+1)
+        data = {}
+        parameters = None
+        for i, zobs in enumerate(self.redshifts):
+            photons = self._get_photons(i)
+            events = photons.project_photons(normal[i], area_new=area_new,
+                                             exp_time_new=exp_time_new,
+                                             redshift_new=zobs, absorb_model=absorb_model,
+                                             sky_center=self.sky_center, no_shifting=no_shifting,
+                                             north_vector=north_vector, prng=prng,
+                                             light_curve=light_curve[i])
+            del photons
+            # The events of every slice are on a tangent plane about the same
+            # sky center, so their pixel coordinates are rescaled to the
+            # pixels of the light cone without going through the sky
+            # coordinates
+            scale = float(events.parameters["dtheta"])/dtheta
+            p = events.parameters["pix_center"]
+            x = (events.events["xpix"]-p[0])*scale+pix_center
+            y = (events.events["ypix"]-p[1])*scale+pix_center
+            inside = (x >= 0.5) & (x < self.nx+0.5) & (y >= 0.5) & (y < self.nx+0.5)
+            mylog.info("%d events from slice %d at z = %g are in the field of view." %
+                       (inside.sum(), i, zobs))
+            data.setdefault("xpix", []).append(x[inside])
+            data.setdefault("ypix", []).append(y[inside])
+            # The sky coordinates are computed again from the new pixel
+            # coordinates when they are needed, and every other column of
+            # the events is kept
+            for key, value in events.events.items():
+                if key not in ["xpix", "ypix", "xsky", "ysky"]:
+                    data.setdefault(key, []).append(value[inside])
+            if parameters is None:
+                parameters = events.parameters
+            del events
+
+        new_parameters = {"ExposureTime": parameters["ExposureTime"],
+                          "Area": parameters["Area"],
+                          "sky_center": self.sky_center,
+                          "pix_center": np.array([pix_center]*2),
+                          "dtheta": YTQuantity(dtheta, "degree")}
+        new_events = dict((k, np.concatenate(v)) for k, v in data.items())
+
+        return EventList(new_events, new_parameters)
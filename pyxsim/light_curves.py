@@ -0,0 +1,103 @@
+"""
+Classes for light curves of variable sources.
+"""
+import numpy as np
+from yt.units.yt_array import YTArray
+from yt.utilities.on_demand_imports import _astropy
+
+class LightCurve(object):
+    r"""
+    A light curve of a variable source, i.e. the rate of photons as a
+    function of time, which is linearly interpolated between the tabulated
+    times and held constant outside of them. Only the shape of the light
+    curve matters, since the number of events is determined by the flux
+    or the photons of the source, so the rates may have any normalization.
+
+    Parameters
+    ----------
+    time : array_like
+        The times of the light curve. If units are not specified, they are
+        assumed to be in seconds.
+    rate : array_like
+        The (relative) rates at the times *time*.
+
+    Examples
+    --------
+    >>> t = np.linspace(0.0, 100000.0, 1001)
+    >>> lc = LightCurve(t, 1.0+0.5*np.sin(2.*np.pi*t/20000.))
+    """
+    def __init__(self, time, rate):
+        if isinstance(time, YTArray):
+            time = time.in_units("s").d
+        self.time = np.asarray(time, dtype="float64")
+        self.rate = np.asarray(rate, dtype="float64")
+        if self.time.shape != self.rate.shape or self.time.ndim != 1:
+            raise ValueError("The times and rates of the light curve must be "
+                             "one-dimensional arrays of the same size!")
+        if np.any(np.diff(self.time) <= 0.0):
+            raise ValueError("The times of the light curve must be increasing!")
+        if np.any(self.rate < 0.0):
+            raise ValueError("The rates of the light curve must not be negative!")
+
+    @classmethod
+    def from_file(cls, filename):
+        r"""
+        Read a light curve from a FITS file with a ``"RATE"`` binary table
+        with ``"TIME"`` (s) and ``"RATE"`` columns, such as the files written
+        by :meth:`~pyxsim.event_list.EventList.write_light_curve`, or from a
+        text file with columns of the time (s) and the rate.
+        """
+        if filename.lower().endswith((".fits", ".fits.gz", ".lc")):
+            with _astropy.pyfits.open(filename) as f:
+                data = f["RATE"].data
+                time = np.array(data["TIME"], dtype="float64")
+                rate = np.array(data["RATE"], dtype="float64")
+        else:
+            time, rate = np.loadtxt(filename, unpack=True, usecols=(0, 1))
+        return cls(time, rate)
+
+    def _cumulative(self, exp_time):
+        # The nodes of the light curve within the exposure, including its
+        # ends, and the cumulative integral of the rate at the nodes
+        t = self.time[(self.time > 0.0) & (self.time < exp_time)]
+        t = np.concatenate([[0.0], t, [exp_time]])
+        r = np.interp(t, self.time, self.rate)
+        cum = np.concatenate([[0.0], np.cumsum(0.5*(r[1:]+r[:-1])*np.diff(t))])
+        if cum[-1] <= 0.0:
+            raise ValueError("The light curve is zero over the exposure!")
+        return t, r, cum
+
+    def generate_times(self, num_events, exp_time, prng=None):
+        r"""
+        Generate *num_events* times between 0 and the exposure time
+        *exp_time* (in seconds) distributed according to the light curve,
+        by inverting its cumulative distribution for all of the events at
+        once.
+
+        Parameters
+        ----------
+        num_events : integer
+            The number of times to generate.
+        exp_time : float
+            The exposure time in seconds.
+        prng : :class:`~numpy.random.RandomState` object or :mod:`numpy.random`, optional
+            A pseudo-random number generator. Typically will only be specified
+            if you have a reason to generate the same set of random numbers, such as for a
+            test. Default is the :mod:`numpy.random` module.
+        """
+        if prng is None:
+            prng = np.random
+        exp_time = float(exp_time)
+        t, r, cum = self._cumulative(exp_time)
+        c = prng.uniform(size=num_events)*cum[-1]
+        i = np.clip(np.searchsorted(cum, c, side="right")-1, 0, t.size-2)
+        c -= cum[i]
+        # Within a segment the rate is linear, r0 + s*dt, so the cumulative
+        # integral is quadratic in dt, with this numerically stable root
+        r0 = r[i]
+        s = (r[i+1]-r0)/(t[i+1]-t[i])
+        denom = r0 + np.sqrt(np.clip(r0*r0+2.*s*c, 0.0, None))
+        dt = np.zeros(num_events)
+        pos = denom > 0.0
+        dt[pos] = 2.*c[pos]/denom[pos]
+        return np.minimum(t[i]+dt, t[i+1])
@@ -13,11 +13,63 @@ from yt.utilities.parallel_tools.parallel_analysis_interface import \
     communication_system, get_mpi_type, parallel_capable, parallel_objects
 from yt.units.yt_array import YTQuantity, YTArray, uconcatenate
 import h5py
-from pyxsim.utils import parse_value, force_unicode, validate_parameters
+import os
+from pyxsim.utils import parse_value, force_unicode, validate_parameters, \
+    create_h5_dataset, h5_file_version, manifest_filename, shard_filename, \
+    write_manifest, read_manifest
 from pyxsim.event_list import EventList
+from pyxsim.cutils import doppler_shift
 
 comm = communication_system.communicators[-1]
 
+# Mapping of photon fields to the dataset names in HDF5 files
+h5_photon_fields = [("x", "x"), ("y", "y"), ("z", "z"),
+                    ("vx", "vx"), ("vy", "vy"), ("vz", "vz"),
+                    ("dx", "dx"), ("NumberOfPhotons", "num_photons"),
+                    ("Energy", "energy")]
+
+def _h5_dtype(key, float_type):
+    if key == "NumberOfPhotons":
+        return "int64"
+    else:
+        return float_type
+
+def _parse_h5_parameters(p):
+    parameters = {}
+    parameters["FiducialExposureTime"] = YTQuantity(p["fid_exp_time"].value, "s")
+    parameters["FiducialArea"] = YTQuantity(p["fid_area"].value, "cm**2")
+    parameters["FiducialRedshift"] = p["fid_redshift"].value
+    parameters["FiducialAngularDiameterDistance"] = YTQuantity(p["fid_d_a"].value, "Mpc")
+    dims = p["dimension"].value
+    if not isinstance(dims, np.ndarray):
+        dims = np.array([dims]*3)
+    parameters["Dimension"] = dims
+    width = p["width"].value
+    if not isinstance(width, np.ndarray):
+        width = np.array([width]*3)
+    parameters["Width"] = YTArray(width, "kpc")
+    parameters["HubbleConstant"] = p["hubble"].value
+    parameters["OmegaMatter"] = p["omega_matter"].value
+    parameters["OmegaLambda"] = p["omega_lambda"].value
+    if "data_type" in p:
+        parameters["DataType"] = force_unicode(p["data_type"].value)
+    else:
+        parameters["DataType"] = "cells"
+    return parameters
+
+def _exclusive_scan(value):
+    # Returns the sum of *value* over the processes before this one,
+    # and the sum over all of the processes
+    offset = comm.comm.exscan(value)
+    if offset is None:
+        offset = 0
+    total = comm.comm.allreduce(value)
+    return offset, total
+
+def _shard_filename(filename, i):
+    prefix, ext = os.path.splitext(filename)
+    return "%s.%04d%s" % (prefix, i, ext)
+
 axes_lookup = {"x": ("y","z"),
                "y": ("z","x"),
                "z": ("x","y")}
@@ -60,6 +112,112 @@ def concatenate_photons(photons):
         else:
             photons[key] = YTArray([], photon_units[key])
 
+class CellEnergies(object):
+    """
+    A ragged view of the photon energies of a range of cells in a
+    :class:`~pyxsim.photon_list.PhotonList`, backed by the flat array of
+    energies and the offsets of the cells into it, so that no array is
+    copied and no per-cell objects are created unless a cell is indexed.
+    Reductions over the energies of each cell are vectorized.
+
+    Examples
+    --------
+    >>> energies = photons["Energy"]
+    >>> len(energies) == photons.num_cells
+    True
+    >>> e0 = energies[0]
+    >>> mean_energy = energies.mean()
+    """
+    def __init__(self, energy, offsets):
+        self._energy = energy
+        self.offsets = offsets
+
+    @property
+    def units(self):
+        return self._energy.units
+
+    @property
+    def flat(self):
+        """
+        The energies of all of the cells in the view as one array.
+        """
+        return self._energy[self.offsets[0]:self.offsets[-1]]
+
+    @property
+    def counts(self):
+        """
+        The number of photons in each cell.
+        """
+        return np.diff(self.offsets)
+
+    def __len__(self):
+        return self.offsets.size-1
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            start, stop, step = item.indices(len(self))
+            if step != 1:
+                raise IndexError("Only contiguous slices of cells are supported!")
+            stop = max(start, stop)
+            return CellEnergies(self._energy, self.offsets[start:stop+1])
+        i = int(item)
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError("Cell index %d is out of range for %d cells!" % (item, len(self)))
+        return self._energy[self.offsets[i]:self.offsets[i+1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._energy[self.offsets[i]:self.offsets[i+1]]
+
+    def __repr__(self):
+        return "CellEnergies(%d cells, %d photons, units=%s)" % \
+            (len(self), self.offsets[-1]-self.offsets[0], self.units)
+
+    def _reduceat(self, ufunc, fill):
+        # Only the starts of the cells with photons are passed to reduceat,
+        # since it returns the element at the start of an empty segment
+        # rather than the identity
+        counts = self.counts
+        out = np.empty(len(self))
+        out[:] = fill
+        has_photons = counts > 0
+        if has_photons.any():
+            starts = self.offsets[:-1][has_photons]-self.offsets[0]
+            out[has_photons] = ufunc.reduceat(np.asarray(self.flat), starts)
+        return out
+
+    def sum(self):
+        """
+        The sum of the photon energies in each cell.
+        """
+        return YTArray(self._reduceat(np.add, 0.0), self.units)
+
+    def mean(self):
+        """
+        The mean photon energy in each cell, which is NaN for cells
+        without photons.
+        """
+        counts = self.counts
+        out = self._reduceat(np.add, np.nan)
+        out[counts > 0] /= counts[counts > 0]
+        return YTArray(out, self.units)
+
+    def min(self):
+        """
+        The minimum photon energy in each cell, which is NaN for cells
+        without photons.
+        """
+        return YTArray(self._reduceat(np.minimum, np.nan), self.units)
+
+    def max(self):
+        """
+        The maximum photon energy in each cell, which is NaN for cells
+        without photons.
+        """
+        return YTArray(self._reduceat(np.maximum, np.nan), self.units)
+
 class PhotonList(object):
 
     def __init__(self, photons, parameters, cosmo):
@@ -94,8 +252,7 @@ class PhotonList(object):
 
     def __getitem__(self, key):
         if key == "Energy":
-            return [self.photons["Energy"][self.p_bins[i]:self.p_bins[i+1]]
-                    for i in range(self.num_cells)]
+            return CellEnergies(self.photons["Energy"], self.p_bins)
         else:
             return self.photons[key]
 
@@ -105,7 +262,7 @@ class PhotonList(object):
     def __repr__(self):
         return self.photons.__repr__()
 
-    def __add__(self, other):
+    def _validate_compatible(self, other):
         validate_parameters(self.parameters, other.parameters)
         for param in ["hubble_constant", "omega_matter", "omega_lambda",
                       "omega_curvature"]:
@@ -115,58 +272,141 @@ class PhotonList(object):
             if not check_equal:
                 raise RuntimeError("The values for the parameter '%s' in the two" % param +
                                    " cosmologies are not identical (%s vs. %s)!" % (v1, v2))
+        if set(self.photons.keys()) != set(other.photons.keys()):
+            raise RuntimeError("The two photon lists do not have the same fields!")
+
+    def __add__(self, other):
+        return PhotonList.concatenate([self, other])
+
+    @classmethod
+    def concatenate(cls, photon_lists):
+        r"""
+        Concatenate a sequence of :class:`~pyxsim.photon_list.PhotonList`
+        instances, which must have been created with the same parameters
+        and cosmology, into a new one. Each field of the new list is
+        allocated once and filled from all of the lists, so adding many
+        lists together does not copy the photons more than once.
+
+        Parameters
+        ----------
+        photon_lists : list of :class:`~pyxsim.photon_list.PhotonList` instances
+            The photon lists to concatenate.
+
+        Examples
+        --------
+        >>> photons = PhotonList.concatenate([photons1, photons2, photons3])
+        """
+        photon_lists = list(photon_lists)
+        if len(photon_lists) == 0:
+            raise ValueError("No photon lists to concatenate!")
+        first = photon_lists[0]
+        for other in photon_lists[1:]:
+            first._validate_compatible(other)
+        photons = {}
+        for key, v in first.photons.items():
+            units = getattr(v, "units", None)
+            size = sum(len(pl.photons[key]) for pl in photon_lists)
+            arr = np.empty(size, dtype=np.asarray(v).dtype)
+            start = 0
+            for pl in photon_lists:
+                w = pl.photons[key]
+                if units is not None:
+                    w = w.in_units(units)
+                arr[start:start+len(w)] = np.asarray(w)
+                start += len(w)
+            if units is not None:
+                arr = YTArray(arr, units)
+            photons[key] = arr
+        return cls(photons, first.parameters, first.cosmo)
+
+    def select(self, selection):
+        r"""
+        Return a new :class:`~pyxsim.photon_list.PhotonList` with a subset
+        of the cells of this one and all of their photons, e.g. to cut a
+        sub-region out of a large photon list without generating the photons
+        again. The energies of the selected cells are gathered with a single
+        vectorized index computed from the offsets of the cells.
+
+        Parameters
+        ----------
+        selection : boolean array, integer array, or tuple of two array_like
+            The cells to select, given either as a boolean mask or an array of
+            indices over the cells, or as a box in the photon coordinates with
+            the tuple (left_edge, right_edge), in which case the cells with
+            positions within the box are selected. If the edges of the box
+            do not have units, they are assumed to be in kpc.
+
+        Examples
+        --------
+        >>> inner = photons.select(([-100.0]*3, [100.0]*3))
+        >>> bright = photons.select(photons["NumberOfPhotons"] > 10)
+        """
+        if isinstance(selection, tuple):
+            edges = []
+            for edge in selection:
+                if isinstance(edge, YTArray):
+                    edge = edge.in_units("kpc").d
+                edges.append(np.asarray(edge, dtype="float64")*np.ones(3))
+            le, re = edges
+            mask = np.ones(self.num_cells, dtype="bool")
+            for i, ax in enumerate("xyz"):
+                pos = self.photons[ax].in_units("kpc").d
+                mask &= (pos >= le[i]) & (pos < re[i])
+            selection = mask
+        selection = np.asarray(selection)
+        if selection.dtype == np.bool_:
+            if selection.shape != (self.num_cells,):
+                raise IndexError("The mask has %d elements, but there are %d cells!" %
+                                 (selection.size, self.num_cells))
+            idxs = np.nonzero(selection)[0]
+        else:
+            idxs = selection.astype("int64")
+        n_ph = np.asarray(self.photons["NumberOfPhotons"])[idxs]
+        new_bins = np.cumsum(n_ph)
+        # The photons of the selected cells are at offsets which are shifted
+        # from their new positions by the same amount within each cell
+        shift = np.repeat(self.p_bins[idxs]-(new_bins-n_ph), n_ph)
+        eidxs = np.arange(new_bins[-1] if n_ph.size > 0 else 0, dtype="int64")+shift
         photons = {}
-        for item1, item2 in zip(self.photons.items(), other.photons.items()):
-            k1, v1 = item1
-            k2, v2 = item2
-            photons[k1] = uconcatenate([v1,v2])
-        return PhotonList(photons, self.parameters, self.cosmo)
+        for key, v in self.photons.items():
+            if key == "Energy":
+                photons[key] = v[eidxs]
+            else:
+                photons[key] = v[idxs]
+        return PhotonList(photons, self.parameters.copy(), self.cosmo)
 
     @classmethod
     def from_file(cls, filename):
         r"""
-        Initialize a :class:`~pyxsim.photon_list.PhotonList` from the HDF5 file *filename*.
+        Initialize a :class:`~pyxsim.photon_list.PhotonList` from the HDF5 file *filename*,
+        or from the directory *filename* of a sharded file set written by
+        :meth:`~pyxsim.photon_list.PhotonList.write_shards`. In the latter case, each
+        process reads a set of whole shards.
         """
+        if os.path.isdir(filename):
+            return cls._from_shards(filename)
 
         photons = {}
-        parameters = {}
 
         f = h5py.File(filename, "r")
 
-        p = f["/parameters"]
-        parameters["FiducialExposureTime"] = YTQuantity(p["fid_exp_time"].value, "s")
-        parameters["FiducialArea"] = YTQuantity(p["fid_area"].value, "cm**2")
-        parameters["FiducialRedshift"] = p["fid_redshift"].value
-        parameters["FiducialAngularDiameterDistance"] = YTQuantity(p["fid_d_a"].value, "Mpc")
-        dims = p["dimension"].value
-        if not isinstance(dims, np.ndarray):
-            dims = np.array([dims]*3)
-        parameters["Dimension"] = dims
-        width = p["width"].value
-        if not isinstance(width, np.ndarray):
-            width = np.array([width]*3)
-        parameters["Width"] = YTArray(width, "kpc")
-        parameters["HubbleConstant"] = p["hubble"].value
-        parameters["OmegaMatter"] = p["omega_matter"].value
-        parameters["OmegaLambda"] = p["omega_lambda"].value
-        if "data_type" in p:
-            parameters["DataType"] = force_unicode(p["data_type"].value)
-        else:
-            parameters["DataType"] = "cells"
+        parameters = _parse_h5_parameters(f["/parameters"])
 
         d = f["/data"]
 
-        num_cells = d["x"][:].shape[0]
+        num_cells = d["x"].shape[0]
         start_c = comm.rank*num_cells//comm.size
         end_c = (comm.rank+1)*num_cells//comm.size
 
-        photons["x"] = YTArray(d["x"][start_c:end_c], "kpc")
-        photons["y"] = YTArray(d["y"][start_c:end_c], "kpc")
-        photons["z"] = YTArray(d["z"][start_c:end_c], "kpc")
-        photons["dx"] = YTArray(d["dx"][start_c:end_c], "kpc")
-        photons["vx"] = YTArray(d["vx"][start_c:end_c], "km/s")
-        photons["vy"] = YTArray(d["vy"][start_c:end_c], "km/s")
-        photons["vz"] = YTArray(d["vz"][start_c:end_c], "km/s")
+        # Files may store these fields in single precision, so we always
+        # convert them back to double precision here
+        photons["x"] = YTArray(d["x"][start_c:end_c].astype("float64", copy=False), "kpc")
+        photons["y"] = YTArray(d["y"][start_c:end_c].astype("float64", copy=False), "kpc")
+        photons["z"] = YTArray(d["z"][start_c:end_c].astype("float64", copy=False), "kpc")
+        photons["dx"] = YTArray(d["dx"][start_c:end_c].astype("float64", copy=False), "kpc")
+        photons["vx"] = YTArray(d["vx"][start_c:end_c].astype("float64", copy=False), "km/s")
+        photons["vy"] = YTArray(d["vy"][start_c:end_c].astype("float64", copy=False), "km/s")
+        photons["vz"] = YTArray(d["vz"][start_c:end_c].astype("float64", copy=False), "km/s")
 
         n_ph = d["num_photons"][:]
 
@@ -177,7 +417,7 @@ class PhotonList(object):
         end_e = start_e + np.int64(n_ph[start_c:end_c].sum())
 
         photons["NumberOfPhotons"] = n_ph[start_c:end_c]
-        photons["Energy"] = YTArray(d["energy"][start_e:end_e], "keV")
+        photons["Energy"] = YTArray(d["energy"][start_e:end_e].astype("float64", copy=False), "keV")
 
         f.close()
 
@@ -187,6 +427,40 @@ class PhotonList(object):
 
         return cls(photons, parameters, cosmo)
 
+    @classmethod
+    def _from_shards(cls, dirname):
+        f, shards = read_manifest(dirname)
+        parameters = _parse_h5_parameters(f["parameters"])
+        f.close()
+
+        # Each process reads a contiguous set of whole shards, so no
+        # process needs to know the sizes of the other shards
+        my_shards = np.array_split(np.arange(len(shards)), comm.size)[comm.rank]
+
+        data = dict((key, []) for key, name in h5_photon_fields)
+        for i in my_shards:
+            fs = h5py.File(shards[i]["filename"], "r")
+            for key, name in h5_photon_fields:
+                data[key].append(fs["data"][name][:].astype(_h5_dtype(key, "float64"), copy=False))
+            fs.close()
+
+        photons = {}
+        for key, name in h5_photon_fields:
+            if len(data[key]) == 0:
+                v = np.array([], dtype=_h5_dtype(key, "float64"))
+            else:
+                v = np.concatenate(data[key])
+            if key == "NumberOfPhotons":
+                photons[key] = v
+            else:
+                photons[key] = YTArray(v, photon_units[key])
+
+        cosmo = Cosmology(hubble_constant=parameters["HubbleConstant"],
+                          omega_matter=parameters["OmegaMatter"],
+                          omega_lambda=parameters["OmegaLambda"])
+
+        return cls(photons, parameters, cosmo)
+
     @classmethod
     def from_data_source(cls, data_source, redshift, area,
                          exp_time, source_model, parameters=None,
@@ -381,12 +655,255 @@ class PhotonList(object):
 
         return cls(photons, parameters, cosmo)
 
-    def write_h5_file(self, photonfile):
+    def extend(self, data_source, source_model, area_new=None, exp_time_new=None,
+               redshift_new=None, dist_new=None, parameters=None, center=None,
+               velocity_fields=None, photonfile=None):
+        r"""
+        Add photons to this :class:`~pyxsim.photon_list.PhotonList`, so that
+        it has enough photons to be projected with a new collecting area,
+        exposure time, and redshift or distance with
+        :meth:`~pyxsim.photon_list.PhotonList.project_photons`. Only the
+        missing photons are generated from the data source, for the extra
+        exposure time needed at the fiducial area and redshift, and the
+        fiducial exposure time of the list is increased by that amount. If the
+        list already has enough photons, nothing is done.
+
+        Since the fiducial exposure time is increased, the exposure time
+        must be given to :meth:`~pyxsim.photon_list.PhotonList.project_photons`
+        afterwards if it was not changed, i.e. *exp_time_new* should be set
+        to the former fiducial exposure time.
+
+        Parameters
+        ----------
+        data_source : :class:`~yt.data_objects.data_containers.YTSelectionContainer`
+            The data source from which the photons of this list were generated.
+        source_model : :class:`~pyxsim.source_models.SourceModel`
+            The source model used to generate the photons of this list.
+        area_new : float, (value, unit) tuple, or :class:`~yt.units.yt_array.YTQuantity`, optional
+            The collecting area which the photons will be projected with.
+            If units are not specified, it is assumed to be in cm^2.
+        exp_time_new : float, (value, unit) tuple, or :class:`~yt.units.yt_array.YTQuantity`, optional
+            The exposure time which the photons will be projected with. If units
+            are not specified, it is assumed to be in seconds.
+        redshift_new : float, optional
+            The redshift which the photons will be projected at.
+        dist_new : float, (value, unit) tuple, or :class:`~yt.units.yt_array.YTQuantity`, optional
+            The distance which the photons will be projected at, for nearby sources.
+            If units are not specified, it is assumed to be in Mpc.
+        parameters : dict, optional
+            A dictionary of parameters to be passed for the source model to use, if necessary.
+        center : string or array_like, optional
+            The origin of the photon spatial coordinates, which must be the
+            same as that of this list. If not specified, the center this list
+            was generated with is used if it is known, otherwise the "center"
+            field parameter of the data source.
+        velocity_fields : list of fields, optional
+            The yt fields to use for the velocity.
+        photonfile : string, optional
+            The HDF5 file or sharded file set which this list was read from or
+            written to. If given, the new photons are appended to it and its
+            fiducial exposure time is updated. Photons may only be appended to
+            a single HDF5 file in serial; in parallel, use a sharded file set,
+            to which each process adds a new shard.
+
+        Examples
+        --------
+        >>> photons = PhotonList.from_file("my_photons.h5")
+        >>> photons.extend(sp, thermal_model, exp_time_new=(1.0, "Ms"),
+        ...                center=sp.center, photonfile="my_photons.h5")
+        >>> events = photons.project_photons("z", exp_time_new=(1.0, "Ms"))
+        """
+        fak = self._photon_factor(area_new, exp_time_new, redshift_new, dist_new)[0]
+        if fak <= 1.0:
+            mylog.info("The photon list already has enough photons for "
+                       "these parameters.")
+            return
+
+        exp_time0 = self.parameters["FiducialExposureTime"]
+        exp_time = exp_time0*fak
+        if exp_time_new is None:
+            mylog.info("The fiducial exposure time will be increased, so use "
+                       "exp_time_new = %g s to project the photons." % exp_time0)
+        redshift = self.parameters["FiducialRedshift"]
+        if redshift > 0.0:
+            dist = None
+        else:
+            dist = self.parameters["FiducialAngularDiameterDistance"]
+        if center is None and "center" in self.parameters:
+            center = self.parameters["center"]
+        if parameters is not None:
+            parameters = parameters.copy()
+
+        mylog.info("Generating photons for an additional exposure time of %g s." %
+                   (exp_time-exp_time0))
+        extra = PhotonList.from_data_source(data_source, redshift,
+                                            self.parameters["FiducialArea"],
+                                            exp_time-exp_time0, source_model,
+                                            parameters=parameters, center=center,
+                                            dist=dist, cosmology=self.cosmo,
+                                            velocity_fields=velocity_fields)
+        keys = ["Dimension", "Width", "DataType"]
+        validate_parameters(dict((k, self.parameters[k]) for k in keys),
+                            dict((k, extra.parameters[k]) for k in keys))
+
+        self.parameters["FiducialExposureTime"] = exp_time
+        extra.parameters = self.parameters
+        new_photons = PhotonList.concatenate([self, extra])
+        self.photons = new_photons.photons
+        self.num_cells = new_photons.num_cells
+        self.p_bins = new_photons.p_bins
+
+        if photonfile is not None:
+            self._append_to_file(photonfile, extra)
+
+    def _append_to_file(self, photonfile, extra):
+        # Appends the photons of *extra* to the file or file set *photonfile*,
+        # which holds the photons of this list before they were added, and
+        # writes the parameters of this list to it
+        if os.path.isdir(photonfile):
+            f, shards = read_manifest(photonfile)
+            f.close()
+            if not parallel_capable and sum(s["num_cells"] for s in shards) != \
+                self.num_cells-extra.num_cells:
+                raise RuntimeError("The file set %s does not have the same " % photonfile +
+                                   "number of cells as this photon list!")
+            with h5py.File(shards[0]["filename"], "r") as f:
+                d = f["data"]["energy"]
+                compression = d.compression
+                float_type = d.dtype.name
+            comm.barrier()
+
+            first = len(shards)
+            extra._write_h5_shard(os.path.join(photonfile, shard_filename(first+comm.rank)),
+                                  compression, float_type)
+
+            num_cells = extra.num_cells
+            num_photons = int(np.sum(extra.photons["NumberOfPhotons"]))
+            if parallel_capable:
+                sizes_c = comm.comm.gather(num_cells, root=0)
+                sizes_p = comm.comm.gather(num_photons, root=0)
+            else:
+                sizes_c = [num_cells]
+                sizes_p = [num_photons]
+
+            if comm.rank == 0:
+                filenames = [os.path.relpath(s["filename"], photonfile) for s in shards]
+                filenames += [shard_filename(first+i) for i in range(len(sizes_c))]
+                sizes_c = [s["num_cells"] for s in shards] + sizes_c
+                sizes_p = [s["num_photons"] for s in shards] + sizes_p
+                f = h5py.File(os.path.join(photonfile, manifest_filename), "w")
+                self._write_h5_parameters(f)
+                write_manifest(f, filenames, {"num_cells": sizes_c, "num_photons": sizes_p})
+                f.close()
+
+        else:
+            if parallel_capable:
+                raise RuntimeError("Photons can only be appended to a single HDF5 "
+                                   "file in serial. Use a sharded file set written "
+                                   "with write_shards instead.")
+            f = h5py.File(photonfile, "r+")
+            d = f["data"]
+            if d["num_photons"].shape[0] != self.num_cells-extra.num_cells:
+                f.close()
+                raise RuntimeError("The file %s does not have the same " % photonfile +
+                                   "number of cells as this photon list!")
+            for key, name in h5_photon_fields:
+                if getattr(d[name], "is_virtual", False) or d[name].maxshape[0] is not None:
+                    f.close()
+                    raise IOError("The datasets in %s cannot be resized. " % photonfile +
+                                  "Write the photons with write_h5_file in serial "
+                                  "to append to them.")
+            for key, name in h5_photon_fields:
+                data = extra._h5_data(key)
+                dset = d[name]
+                size = dset.shape[0]
+                dset.resize((size+data.shape[0],))
+                dset[size:] = data
+            p = f["parameters"]
+            del p["fid_exp_time"]
+            p.create_dataset("fid_exp_time", data=float(self.parameters["FiducialExposureTime"]))
+            f.close()
+
+        comm.barrier()
+
+    def write_h5_file(self, photonfile, compression=None, single_precision=False):
         """
         Write the :class:`~pyxsim.photon_list.PhotonList` to the HDF5 file *photonfile*.
+
+        Parameters
+        ----------
+        photonfile : string
+            The name of the HDF5 file to write.
+        compression : string, optional
+            The lossless compression filter to apply to the cell and photon
+            datasets, either "gzip" or "lzf". Default is no compression.
+        single_precision : boolean, optional
+            If True, the cell positions, velocities, and widths and the photon
+            energies are stored in single precision. Default: False
+
+        Notes
+        -----
+        When running in parallel, each process writes its own cells and photons
+        at offsets computed with an exclusive scan. If h5py has been built with
+        MPI support, the processes write directly into *photonfile*. Otherwise,
+        each process writes a shard file (named like *photonfile* with the
+        process number appended), and *photonfile* is written as an index of
+        virtual datasets which map onto the shards, so the shard files must be
+        kept alongside it.
         """
+        if single_precision:
+            float_type = "float32"
+        else:
+            float_type = "float64"
 
-        if parallel_capable:
+        if not parallel_capable:
+            if comm.rank == 0:
+                f = h5py.File(photonfile, "w")
+                self._write_h5_parameters(f)
+                d = f.create_group("data")
+                for key, name in h5_photon_fields:
+                    data = self._h5_data(key)
+                    create_h5_dataset(d, name, data, compression=compression,
+                                      dtype=_h5_dtype(key, float_type))
+                f.close()
+
+        elif h5py.get_config().mpi:
+
+            num_cells = len(self.photons["x"])
+            num_photons = int(np.sum(self.photons["NumberOfPhotons"]))
+            offset_c, total_c = _exclusive_scan(num_cells)
+            offset_p, total_p = _exclusive_scan(num_photons)
+
+            f = h5py.File(photonfile, "w", driver="mpio", comm=comm.comm)
+            self._write_h5_parameters(f)
+            d = f.create_group("data")
+            for key, name in h5_photon_fields:
+                if key == "Energy":
+                    offset, total = offset_p, total_p
+                else:
+                    offset, total = offset_c, total_c
+                data = self._h5_data(key)
+                dset = create_h5_dataset(d, name, total, compression=compression,
+                                         dtype=_h5_dtype(key, float_type))
+                with dset.collective:
+                    dset[offset:offset+data.shape[0]] = data
+            f.close()
+
+        elif hasattr(h5py, "VirtualLayout"):
+
+            self._write_h5_shard(_shard_filename(photonfile, comm.rank),
+                                 compression, float_type)
+
+            sizes_c = comm.comm.gather(len(self.photons["x"]), root=0)
+            sizes_p = comm.comm.gather(int(np.sum(self.photons["NumberOfPhotons"])), root=0)
+
+            if comm.rank == 0:
+                self._write_h5_index(photonfile, sizes_c, sizes_p, float_type)
+
+        else:
+
+            # Older versions of h5py without virtual datasets: gather
+            # everything to the root process and write it from there
 
             mpi_long = get_mpi_type("int64")
             mpi_double = get_mpi_type("float64")
@@ -397,106 +914,205 @@ class PhotonList(object):
             local_num_photons = np.sum(self.photons["NumberOfPhotons"])
             sizes_p = comm.comm.gather(local_num_photons, root=0)
 
+            data = {}
             if comm.rank == 0:
                 num_cells = sum(sizes_c)
                 num_photons = sum(sizes_p)
                 disps_c = [sum(sizes_c[:i]) for i in range(len(sizes_c))]
                 disps_p = [sum(sizes_p[:i]) for i in range(len(sizes_p))]
-                x = np.zeros(num_cells)
-                y = np.zeros(num_cells)
-                z = np.zeros(num_cells)
-                vx = np.zeros(num_cells)
-                vy = np.zeros(num_cells)
-                vz = np.zeros(num_cells)
-                dx = np.zeros(num_cells)
-                n_ph = np.zeros(num_cells, dtype="int64")
-                e = np.zeros(num_photons)
+                for key, name in h5_photon_fields:
+                    if key == "Energy":
+                        data[key] = np.zeros(num_photons)
+                    elif key == "NumberOfPhotons":
+                        data[key] = np.zeros(num_cells, dtype="int64")
+                    else:
+                        data[key] = np.zeros(num_cells)
             else:
                 sizes_c = []
                 sizes_p = []
                 disps_c = []
                 disps_p = []
-                x = np.empty([])
-                y = np.empty([])
-                z = np.empty([])
-                vx = np.empty([])
-                vy = np.empty([])
-                vz = np.empty([])
-                dx = np.empty([])
-                n_ph = np.empty([])
-                e = np.empty([])
-
-            comm.comm.Gatherv([self.photons["x"].d, local_num_cells, mpi_double],
-                              [x, (sizes_c, disps_c), mpi_double], root=0)
-            comm.comm.Gatherv([self.photons["y"].d, local_num_cells, mpi_double],
-                              [y, (sizes_c, disps_c), mpi_double], root=0)
-            comm.comm.Gatherv([self.photons["z"].d, local_num_cells, mpi_double],
-                              [z, (sizes_c, disps_c), mpi_double], root=0)
-            comm.comm.Gatherv([self.photons["vx"].d, local_num_cells, mpi_double],
-                              [vx, (sizes_c, disps_c), mpi_double], root=0)
-            comm.comm.Gatherv([self.photons["vy"].d, local_num_cells, mpi_double],
-                              [vy, (sizes_c, disps_c), mpi_double], root=0)
-            comm.comm.Gatherv([self.photons["vz"].d, local_num_cells, mpi_double],
-                              [vz, (sizes_c, disps_c), mpi_double], root=0)
-            comm.comm.Gatherv([self.photons["dx"].d, local_num_cells, mpi_double],
-                              [dx, (sizes_c, disps_c), mpi_double], root=0)
-            comm.comm.Gatherv([self.photons["NumberOfPhotons"], local_num_cells, mpi_long],
-                              [n_ph, (sizes_c, disps_c), mpi_long], root=0)
-            comm.comm.Gatherv([self.photons["Energy"].d, local_num_photons, mpi_double],
-                              [e, (sizes_p, disps_p), mpi_double], root=0)
+                for key, name in h5_photon_fields:
+                    data[key] = np.empty([])
+
+            for key, name in h5_photon_fields:
+                if key == "Energy":
+                    comm.comm.Gatherv([self._h5_data(key), local_num_photons, mpi_double],
+                                      [data[key], (sizes_p, disps_p), mpi_double], root=0)
+                elif key == "NumberOfPhotons":
+                    comm.comm.Gatherv([self._h5_data(key), local_num_cells, mpi_long],
+                                      [data[key], (sizes_c, disps_c), mpi_long], root=0)
+                else:
+                    comm.comm.Gatherv([self._h5_data(key), local_num_cells, mpi_double],
+                                      [data[key], (sizes_c, disps_c), mpi_double], root=0)
 
-        else:
+            if comm.rank == 0:
+                f = h5py.File(photonfile, "w")
+                self._write_h5_parameters(f)
+                d = f.create_group("data")
+                for key, name in h5_photon_fields:
+                    create_h5_dataset(d, name, data[key], compression=compression,
+                                      dtype=_h5_dtype(key, float_type))
+                f.close()
 
-            x = self.photons["x"].d
-            y = self.photons["y"].d
-            z = self.photons["z"].d
-            vx = self.photons["vx"].d
-            vy = self.photons["vy"].d
-            vz = self.photons["vz"].d
-            dx = self.photons["dx"].d
-            n_ph = self.photons["NumberOfPhotons"]
-            e = self.photons["Energy"].d
+        comm.barrier()
 
-        if comm.rank == 0:
+    def write_shards(self, dirname, compression=None, single_precision=False,
+                     clobber=False):
+        """
+        Write the :class:`~pyxsim.photon_list.PhotonList` to a sharded file set in
+        the directory *dirname*. Each process writes its cells and photons to its
+        own shard file, and a manifest file with the parameters and the sizes and
+        offsets of the shards is written alongside them. The file set can be read
+        back in with :meth:`~pyxsim.photon_list.PhotonList.from_file`, and merged
+        with other file sets using :func:`~pyxsim.utils.merge_files`.
 
-            f = h5py.File(photonfile, "w")
+        Parameters
+        ----------
+        dirname : string
+            The directory to write the shards and manifest to. It is created if
+            it does not exist.
+        compression : string, optional
+            The lossless compression filter to apply to the cell and photon
+            datasets, either "gzip" or "lzf". Default is no compression.
+        single_precision : boolean, optional
+            If True, the cell positions, velocities, and widths and the photon
+            energies are stored in single precision. Default: False
+        clobber : boolean, optional
+            Set to True to overwrite a previous file set in *dirname*.
+        """
+        if os.path.exists(os.path.join(dirname, manifest_filename)) and not clobber:
+            raise IOError("Cannot overwrite existing file set in %s. " % dirname +
+                          "If you want to do this, set clobber=True.")
 
-            # Parameters
+        if single_precision:
+            float_type = "float32"
+        else:
+            float_type = "float64"
 
-            p = f.create_group("parameters")
-            p.create_dataset("fid_area", data=float(self.parameters["FiducialArea"]))
-            p.create_dataset("fid_exp_time", data=float(self.parameters["FiducialExposureTime"]))
-            p.create_dataset("fid_redshift", data=self.parameters["FiducialRedshift"])
-            p.create_dataset("hubble", data=self.parameters["HubbleConstant"])
-            p.create_dataset("omega_matter", data=self.parameters["OmegaMatter"])
-            p.create_dataset("omega_lambda", data=self.parameters["OmegaLambda"])
-            p.create_dataset("fid_d_a", data=float(self.parameters["FiducialAngularDiameterDistance"]))
-            p.create_dataset("dimension", data=self.parameters["Dimension"])
-            p.create_dataset("width", data=self.parameters["Width"].v)
-            p.create_dataset("data_type", data=self.parameters["DataType"])
+        if comm.rank == 0 and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        comm.barrier()
 
-            # Data
+        self._write_h5_shard(os.path.join(dirname, shard_filename(comm.rank)),
+                             compression, float_type)
 
-            d = f.create_group("data")
-            d.create_dataset("x", data=x)
-            d.create_dataset("y", data=y)
-            d.create_dataset("z", data=z)
-            d.create_dataset("vx", data=vx)
-            d.create_dataset("vy", data=vy)
-            d.create_dataset("vz", data=vz)
-            d.create_dataset("dx", data=dx)
-            d.create_dataset("num_photons", data=n_ph)
-            d.create_dataset("energy", data=e)
+        num_cells = len(self.photons["x"])
+        num_photons = int(np.sum(self.photons["NumberOfPhotons"]))
+        if parallel_capable:
+            sizes_c = comm.comm.gather(num_cells, root=0)
+            sizes_p = comm.comm.gather(num_photons, root=0)
+        else:
+            sizes_c = [num_cells]
+            sizes_p = [num_photons]
 
+        if comm.rank == 0:
+            f = h5py.File(os.path.join(dirname, manifest_filename), "w")
+            self._write_h5_parameters(f)
+            write_manifest(f, [shard_filename(i) for i in range(len(sizes_c))],
+                           {"num_cells": sizes_c, "num_photons": sizes_p})
             f.close()
 
         comm.barrier()
 
+    def _write_h5_shard(self, filename, compression, float_type):
+        f = h5py.File(filename, "w")
+        d = f.create_group("data")
+        for key, name in h5_photon_fields:
+            create_h5_dataset(d, name, self._h5_data(key), compression=compression,
+                              dtype=_h5_dtype(key, float_type))
+        f.close()
+
+    def _write_h5_index(self, photonfile, sizes_c, sizes_p, float_type):
+        # Write the parameters and the virtual datasets which map onto the
+        # shards of each process, given the numbers of cells and photons
+        # in each shard
+        f = h5py.File(photonfile, "w")
+        self._write_h5_parameters(f)
+        d = f.create_group("data")
+        for key, name in h5_photon_fields:
+            if key == "Energy":
+                sizes = sizes_p
+            else:
+                sizes = sizes_c
+            dtype = _h5_dtype(key, float_type)
+            layout = h5py.VirtualLayout(shape=(sum(sizes),), dtype=dtype)
+            start = 0
+            for i, size in enumerate(sizes):
+                if size > 0:
+                    # Relative paths are resolved from the directory
+                    # of the index file
+                    fn = os.path.basename(_shard_filename(photonfile, i))
+                    layout[start:start+size] = h5py.VirtualSource(fn, "data/%s" % name,
+                                                                  shape=(size,))
+                start += size
+            d.create_virtual_dataset(name, layout)
+        f.close()
+
+    def _h5_data(self, key):
+        return np.ascontiguousarray(self.photons[key], dtype=_h5_dtype(key, "float64"))
+
+    def _write_h5_parameters(self, f):
+        f.attrs["version"] = h5_file_version
+
+        p = f.create_group("parameters")
+        p.create_dataset("fid_area", data=float(self.parameters["FiducialArea"]))
+        p.create_dataset("fid_exp_time", data=float(self.parameters["FiducialExposureTime"]))
+        p.create_dataset("fid_redshift", data=self.parameters["FiducialRedshift"])
+        p.create_dataset("hubble", data=self.parameters["HubbleConstant"])
+        p.create_dataset("omega_matter", data=self.parameters["OmegaMatter"])
+        p.create_dataset("omega_lambda", data=self.parameters["OmegaLambda"])
+        p.create_dataset("fid_d_a", data=float(self.parameters["FiducialAngularDiameterDistance"]))
+        p.create_dataset("dimension", data=self.parameters["Dimension"])
+        p.create_dataset("width", data=self.parameters["Width"].v)
+        p.create_dataset("data_type", data=self.parameters["DataType"])
+
+    def _photon_factor(self, area_new, exp_time_new, redshift_new, dist_new):
+        # Returns the fraction of the photons in the list which are observed
+        # with a new area, exposure time, and redshift or distance, along
+        # with the parsed new parameters and the energy scale factor
+        zobs0 = self.parameters["FiducialRedshift"]
+        D_A0 = self.parameters["FiducialAngularDiameterDistance"]
+        scale_factor = 1.0
+
+        if (exp_time_new is None and area_new is None and
+            redshift_new is None and dist_new is None):
+            return 1.0, area_new, exp_time_new, zobs0, D_A0, scale_factor
+
+        if exp_time_new is None:
+            Tratio = 1.
+        else:
+            exp_time_new = parse_value(exp_time_new, "s")
+            Tratio = exp_time_new/self.parameters["FiducialExposureTime"]
+        if area_new is None:
+            Aratio = 1.
+        else:
+            area_new = parse_value(area_new, "cm**2")
+            Aratio = area_new/self.parameters["FiducialArea"]
+        if redshift_new is None and dist_new is None:
+            Dratio = 1.
+            zobs = zobs0
+            D_A = D_A0
+        else:
+            if dist_new is not None:
+                if redshift_new is not None and redshift_new > 0.0:
+                    mylog.warning("Redshift must be zero for nearby sources. Resetting redshift to 0.0.")
+                zobs = 0.0
+                D_A = parse_value(dist_new, "Mpc")
+            else:
+                zobs = redshift_new
+                D_A = self.cosmo.angular_diameter_distance(0.0,zobs).in_units("Mpc")
+                scale_factor = (1.+zobs0)/(1.+zobs)
+            Dratio = D_A0*D_A0*(1.+zobs0)**3 / \
+                     (D_A*D_A*(1.+zobs)**3)
+        fak = float(Aratio*Tratio*Dratio)
+        return fak, area_new, exp_time_new, zobs, D_A, scale_factor
+
     def project_photons(self, normal, area_new=None, exp_time_new=None,
                         redshift_new=None, dist_new=None,
                         absorb_model=None, sky_center=None,
                         no_shifting=False, north_vector=None,
-                        prng=None):
+                        prng=None, light_curve=None):
         r"""
         Projects photons onto an image plane given a line of sight.
         Returns a new :class:`~pyxsim.event_list.EventList`.
@@ -535,6 +1151,9 @@ class PhotonList(object):
             A pseudo-random number generator. Typically will only be specified
             if you have a reason to generate the same set of random numbers, such as for a
             test. Default is the :mod:`numpy.random` module.
+        light_curve : :class:`~pyxsim.light_curves.LightCurve`, optional
+            If set, the events are given times drawn from this light curve.
+            Otherwise, the times are uniform over the exposure.
 
         Examples
         --------
@@ -580,51 +1199,17 @@ class PhotonList(object):
 
         parameters = {}
 
-        zobs0 = self.parameters["FiducialRedshift"]
-        D_A0 = self.parameters["FiducialAngularDiameterDistance"]
-        scale_factor = 1.0
-
-        if (exp_time_new is None and area_new is None and
-            redshift_new is None and dist_new is None):
-            my_n_obs = n_ph_tot
-            zobs = zobs0
-            D_A = D_A0
-        else:
-            if exp_time_new is None:
-                Tratio = 1.
-            else:
-                exp_time_new = parse_value(exp_time_new, "s")
-                Tratio = exp_time_new/self.parameters["FiducialExposureTime"]
-            if area_new is None:
-                Aratio = 1.
-            else:
-                area_new = parse_value(area_new, "cm**2")
-                Aratio = area_new/self.parameters["FiducialArea"]
-            if redshift_new is None and dist_new is None:
-                Dratio = 1.
-                zobs = zobs0
-                D_A = D_A0
-            else:
-                if dist_new is not None:
-                    if redshift_new is not None and redshift_new > 0.0:
-                        mylog.warning("Redshift must be zero for nearby sources. Resetting redshift to 0.0.")
-                        zobs = 0.0
-                    D_A = parse_value(dist_new, "Mpc")
-                else:
-                    zobs = redshift_new
-                    D_A = self.cosmo.angular_diameter_distance(0.0,zobs).in_units("Mpc")
-                    scale_factor = (1.+zobs0)/(1.+zobs)
-                Dratio = D_A0*D_A0*(1.+zobs0)**3 / \
-                         (D_A*D_A*(1.+zobs)**3)
-            fak = Aratio*Tratio*Dratio
-            if fak > 1:
-                raise ValueError("This combination of requested parameters results in "
-                                 "%g%% more photons collected than are " % (100.*(fak-1.)) +
-                                 "available in the sample. Please reduce the collecting "
-                                 "area, exposure time, or increase the distance/redshift "
-                                 "of the object. Alternatively, generate a larger sample "
-                                 "of photons.")
-            my_n_obs = np.int64(n_ph_tot*fak)
+        fak, area_new, exp_time_new, zobs, D_A, scale_factor = \
+            self._photon_factor(area_new, exp_time_new, redshift_new, dist_new)
+        if fak > 1.0+1.0e-10:
+            raise ValueError("This combination of requested parameters results in "
+                             "%g%% more photons collected than are " % (100.*(fak-1.)) +
+                             "available in the sample. Please reduce the collecting "
+                             "area, exposure time, or increase the distance/redshift "
+                             "of the object. Alternatively, generate a larger sample "
+                             "of photons, or add the missing photons to this one "
+                             "with PhotonList.extend.")
+        my_n_obs = min(np.int64(n_ph_tot*fak), n_ph_tot)
 
         if my_n_obs == n_ph_tot:
             idxs = np.arange(my_n_obs, dtype='int64')
@@ -646,8 +1231,8 @@ class PhotonList(object):
             xsky += self.photons[axes_lookup[normal][0]].d[obs_cells]
             ysky += self.photons[axes_lookup[normal][1]].d[obs_cells]
 
-            if not no_shifting:
-                vz = self.photons["v%s" % normal]
+            n_hat = np.zeros(3)
+            n_hat["xyz".index(normal)] = 1.0
 
         else:
 
@@ -660,10 +1245,7 @@ class PhotonList(object):
                 y = prng.normal(loc=0.0, scale=1.0, size=my_n_obs)
                 z = prng.normal(loc=0.0, scale=1.0, size=my_n_obs)
 
-            if not no_shifting:
-                vz = self.photons["vx"]*z_hat[0] + \
-                     self.photons["vy"]*z_hat[1] + \
-                     self.photons["vz"]*z_hat[2]
+            n_hat = z_hat
 
             x *= delta
             y *= delta
@@ -675,13 +1257,24 @@ class PhotonList(object):
             xsky = x*x_hat[0] + y*x_hat[1] + z*x_hat[2]
             ysky = x*y_hat[0] + y*y_hat[1] + z*y_hat[2]
 
+        energy = self.photons["Energy"]
         if no_shifting:
-            eobs = self.photons["Energy"][idxs]
+            eobs = energy.d[idxs]
+            eobs *= scale_factor
         else:
-            shift = -vz.in_cgs()/clight
-            shift = np.sqrt((1.-shift)/(1.+shift))
-            eobs = self.photons["Energy"][idxs]*shift[obs_cells]
-        eobs *= scale_factor
+            # The velocities are projected and converted to units of the
+            # speed of light within the Doppler kernel, which only loops
+            # over the observed photons
+            v_to_beta = float(self.photons["vx"].uq.in_cgs()/clight)
+            eobs = np.empty(my_n_obs)
+            doppler_shift(np.ascontiguousarray(energy.d, dtype="float64"),
+                          idxs, obs_cells.astype("int64"),
+                          np.ascontiguousarray(self.photons["vx"].d, dtype="float64"),
+                          np.ascontiguousarray(self.photons["vy"].d, dtype="float64"),
+                          np.ascontiguousarray(self.photons["vz"].d, dtype="float64"),
+                          n_hat[0]*v_to_beta, n_hat[1]*v_to_beta, n_hat[2]*v_to_beta,
+                          float(scale_factor), eobs)
+        eobs = YTArray(eobs, energy.units)
 
         if absorb_model is None:
             detected = np.ones(eobs.shape, dtype='bool')
@@ -696,6 +1289,17 @@ class PhotonList(object):
         events["ypix"] = ysky[detected]/dx_min.v + 0.5*(nx+1)
         events["eobs"] = eobs[detected]
 
+        if exp_time_new is None:
+            exp_time = self.parameters["FiducialExposureTime"]
+        else:
+            exp_time = exp_time_new
+        if light_curve is None:
+            events["time"] = prng.uniform(low=0.0, high=float(exp_time),
+                                          size=events["eobs"].size)
+        else:
+            events["time"] = light_curve.generate_times(events["eobs"].size,
+                                                        exp_time, prng=prng)
+
         events = comm.par_combine_object(events, datatype="dict", op="cat")
 
         num_events = len(events["xpix"])
@@ -703,10 +1307,7 @@ class PhotonList(object):
         if comm.rank == 0:
             mylog.info("Total number of observed photons: %d" % num_events)
 
-        if exp_time_new is None:
-            parameters["ExposureTime"] = self.parameters["FiducialExposureTime"]
-        else:
-            parameters["ExposureTime"] = exp_time_new
+        parameters["ExposureTime"] = exp_time
         if area_new is None:
             parameters["Area"] = self.parameters["FiducialArea"]
         else:
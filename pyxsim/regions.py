@@ -0,0 +1,436 @@
+"""
+Classes for spatial regions, which are used to select events from an
+:class:`~pyxsim.event_list.EventList`. Regions are defined in pixel
+coordinates, and can be combined using the ``&``, ``|``, and ``~`` operators.
+"""
+import numpy as np
+import os
+from abc import ABCMeta, abstractmethod
+from six import add_metaclass
+
+class UnsupportedRegion(ValueError):
+    """
+    Raised by :func:`~pyxsim.regions.parse_ds9_region` for a ds9 region
+    with a shape or coordinate system which it does not support.
+    """
+    pass
+
+@add_metaclass(ABCMeta)
+class Region(object):
+    """
+    The base class for regions in pixel coordinates. Subclasses
+    must implement :meth:`contains` and :meth:`bounding_box`.
+    """
+    @abstractmethod
+    def contains(self, x, y):
+        """
+        Return a boolean array which is True where the pixel
+        coordinates *x*, *y* are inside the region.
+        """
+        pass
+
+    @abstractmethod
+    def bounding_box(self):
+        """
+        Return the bounding box (xmin, xmax, ymin, ymax) of the
+        region, or None if it is unbounded.
+        """
+        pass
+
+    def __and__(self, other):
+        return IntersectionRegion(self, other)
+
+    def __or__(self, other):
+        return UnionRegion(self, other)
+
+    def __invert__(self):
+        return ComplementRegion(self)
+
+class CircleRegion(Region):
+    r"""
+    A circular region.
+
+    Parameters
+    ----------
+    x, y : floats
+        The center of the circle in pixel coordinates.
+    radius : float
+        The radius of the circle in pixels.
+
+    Examples
+    --------
+    >>> reg = CircleRegion(512.5, 512.5, 50.0)
+    """
+    def __init__(self, x, y, radius):
+        self.x = x
+        self.y = y
+        self.radius = radius
+
+    def contains(self, x, y):
+        return (x-self.x)**2+(y-self.y)**2 <= self.radius**2
+
+    def bounding_box(self):
+        return (self.x-self.radius, self.x+self.radius,
+                self.y-self.radius, self.y+self.radius)
+
+class AnnulusRegion(Region):
+    r"""
+    An annular region, which includes the inner radius but not
+    the outer one, so that adjacent annuli do not overlap.
+
+    Parameters
+    ----------
+    x, y : floats
+        The center of the annulus in pixel coordinates.
+    inner_radius : float
+        The inner radius of the annulus in pixels.
+    outer_radius : float
+        The outer radius of the annulus in pixels.
+
+    Examples
+    --------
+    >>> reg = AnnulusRegion(512.5, 512.5, 50.0, 100.0)
+    """
+    def __init__(self, x, y, inner_radius, outer_radius):
+        self.x = x
+        self.y = y
+        self.inner_radius = inner_radius
+        self.outer_radius = outer_radius
+
+    def contains(self, x, y):
+        r2 = (x-self.x)**2+(y-self.y)**2
+        return (r2 >= self.inner_radius**2) & (r2 < self.outer_radius**2)
+
+    def bounding_box(self):
+        return (self.x-self.outer_radius, self.x+self.outer_radius,
+                self.y-self.outer_radius, self.y+self.outer_radius)
+
+class BoxRegion(Region):
+    r"""
+    A rectangular region, which may be rotated.
+
+    Parameters
+    ----------
+    x, y : floats
+        The center of the box in pixel coordinates.
+    width, height : floats
+        The width and height of the box in pixels.
+    angle : float, optional
+        The counter-clockwise rotation angle of the box from
+        the x-axis in degrees. Default: 0.0
+
+    Examples
+    --------
+    >>> reg = BoxRegion(512.5, 512.5, 100.0, 40.0, angle=30.0)
+    """
+    def __init__(self, x, y, width, height, angle=0.0):
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.angle = angle
+
+    def contains(self, x, y):
+        u, v = _rotate(x-self.x, y-self.y, self.angle)
+        return (np.abs(u) <= 0.5*self.width) & (np.abs(v) <= 0.5*self.height)
+
+    def bounding_box(self):
+        theta = np.radians(self.angle)
+        hw = 0.5*(np.abs(self.width*np.cos(theta))+np.abs(self.height*np.sin(theta)))
+        hh = 0.5*(np.abs(self.width*np.sin(theta))+np.abs(self.height*np.cos(theta)))
+        return (self.x-hw, self.x+hw, self.y-hh, self.y+hh)
+
+class EllipseRegion(Region):
+    r"""
+    An elliptical region, which may be rotated.
+
+    Parameters
+    ----------
+    x, y : floats
+        The center of the ellipse in pixel coordinates.
+    a, b : floats
+        The semi-major and semi-minor axes of the ellipse in pixels.
+    angle : float, optional
+        The counter-clockwise rotation angle of the semi-major
+        axis from the x-axis in degrees. Default: 0.0
+
+    Examples
+    --------
+    >>> reg = EllipseRegion(512.5, 512.5, 100.0, 40.0, angle=30.0)
+    """
+    def __init__(self, x, y, a, b, angle=0.0):
+        self.x = x
+        self.y = y
+        self.a = a
+        self.b = b
+        self.angle = angle
+
+    def contains(self, x, y):
+        u, v = _rotate(x-self.x, y-self.y, self.angle)
+        return (u/self.a)**2+(v/self.b)**2 <= 1.0
+
+    def bounding_box(self):
+        theta = np.radians(self.angle)
+        hw = np.sqrt((self.a*np.cos(theta))**2+(self.b*np.sin(theta))**2)
+        hh = np.sqrt((self.a*np.sin(theta))**2+(self.b*np.cos(theta))**2)
+        return (self.x-hw, self.x+hw, self.y-hh, self.y+hh)
+
+class PolygonRegion(Region):
+    r"""
+    A polygonal region.
+
+    Parameters
+    ----------
+    x, y : array_like
+        The pixel coordinates of the vertices of the polygon.
+
+    Examples
+    --------
+    >>> reg = PolygonRegion([500., 600., 550.], [500., 500., 580.])
+    """
+    def __init__(self, x, y):
+        self.x = np.asarray(x, dtype="float64")
+        self.y = np.asarray(y, dtype="float64")
+
+    def contains(self, x, y):
+        # Even-odd rule: count the crossings of a ray in the +x direction
+        # with each of the edges
+        inside = np.zeros(np.shape(x), dtype="bool")
+        xj = self.x[-1]
+        yj = self.y[-1]
+        for xi, yi in zip(self.x, self.y):
+            if yi != yj:
+                cross = ((yi > y) != (yj > y)) & (x < (xj-xi)*(y-yi)/(yj-yi)+xi)
+                inside ^= cross
+            xj = xi
+            yj = yi
+        return inside
+
+    def bounding_box(self):
+        return (self.x.min(), self.x.max(), self.y.min(), self.y.max())
+
+class IntersectionRegion(Region):
+    def __init__(self, region1, region2):
+        self.region1 = region1
+        self.region2 = region2
+
+    def contains(self, x, y):
+        return self.region1.contains(x, y) & self.region2.contains(x, y)
+
+    def bounding_box(self):
+        box1 = self.region1.bounding_box()
+        box2 = self.region2.bounding_box()
+        if box1 is None:
+            return box2
+        if box2 is None:
+            return box1
+        return (max(box1[0], box2[0]), min(box1[1], box2[1]),
+                max(box1[2], box2[2]), min(box1[3], box2[3]))
+
+class UnionRegion(Region):
+    def __init__(self, region1, region2):
+        self.region1 = region1
+        self.region2 = region2
+
+    def contains(self, x, y):
+        return self.region1.contains(x, y) | self.region2.contains(x, y)
+
+    def bounding_box(self):
+        box1 = self.region1.bounding_box()
+        box2 = self.region2.bounding_box()
+        if box1 is None or box2 is None:
+            return None
+        return (min(box1[0], box2[0]), max(box1[1], box2[1]),
+                min(box1[2], box2[2]), max(box1[3], box2[3]))
+
+class ComplementRegion(Region):
+    def __init__(self, region):
+        self.region = region
+
+    def contains(self, x, y):
+        return ~self.region.contains(x, y)
+
+    def bounding_box(self):
+        return None
+
+class EverywhereRegion(Region):
+    def contains(self, x, y):
+        return np.ones(np.shape(x), dtype="bool")
+
+    def bounding_box(self):
+        return None
+
+def _rotate(dx, dy, angle):
+    theta = np.radians(angle)
+    c = np.cos(theta)
+    s = np.sin(theta)
+    return dx*c+dy*s, -dx*s+dy*c
+
+class EventIndex(object):
+    r"""
+    A spatial index of events on a grid of square cells, which is used
+    to find the events which may be inside a region without testing
+    all of them.
+
+    Parameters
+    ----------
+    x, y : array_like
+        The pixel coordinates of the events.
+    cell_size : float, optional
+        The width of the cells in pixels. Default: 16.0
+    """
+    def __init__(self, x, y, cell_size=16.0):
+        self.cell_size = cell_size
+        self.num_events = len(x)
+        if self.num_events == 0:
+            self.x0 = self.y0 = 0.0
+            self.nx = self.ny = 1
+        else:
+            self.x0 = x.min()
+            self.y0 = y.min()
+            self.nx = int((x.max()-self.x0)//cell_size)+1
+            self.ny = int((y.max()-self.y0)//cell_size)+1
+        ix = ((x-self.x0)//cell_size).astype("int64")
+        iy = ((y-self.y0)//cell_size).astype("int64")
+        cell = iy*self.nx+ix
+        # The events are sorted by cell, so the events in a row of cells
+        # are contiguous in this order
+        self.order = np.argsort(cell, kind="mergesort")
+        counts = np.bincount(cell, minlength=self.nx*self.ny)
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+
+    def candidates(self, box):
+        """
+        Return the indices of the events in the cells which overlap
+        the bounding box *box* (xmin, xmax, ymin, ymax), or None if
+        all of the events are candidates.
+        """
+        if box is None:
+            return None
+        ix0 = max(int((box[0]-self.x0)//self.cell_size), 0)
+        ix1 = min(int((box[1]-self.x0)//self.cell_size), self.nx-1)
+        iy0 = max(int((box[2]-self.y0)//self.cell_size), 0)
+        iy1 = min(int((box[3]-self.y0)//self.cell_size), self.ny-1)
+        if ix1 < ix0 or iy1 < iy0:
+            return np.array([], dtype="int64")
+        rows = np.arange(iy0, iy1+1)*self.nx
+        starts = self.offsets[rows+ix0]
+        ends = self.offsets[rows+ix1+1]
+        lengths = ends-starts
+        # Concatenate the ranges [start, end) of each row of cells
+        idxs = np.arange(lengths.sum()) + np.repeat(starts-np.cumsum(lengths)+lengths, lengths)
+        return self.order[idxs]
+
+def parse_ds9_region(region, wcs):
+    r"""
+    Parse a ds9 region string or file into a :class:`~pyxsim.regions.Region`
+    in the pixel coordinates of *wcs*. Supports the circle, annulus, box,
+    ellipse, and polygon shapes in image or sky (fk5/icrs) coordinates, and
+    excluded ("-") regions. The included shapes are combined with the ``|``
+    operator, and the excluded shapes are removed from them. Raises
+    :class:`~pyxsim.regions.UnsupportedRegion` for other shapes or
+    coordinate systems.
+
+    Parameters
+    ----------
+    region : string
+        The ds9 region string, or the name of a file containing one.
+    wcs : :class:`~astropy.wcs.WCS`
+        The WCS of the pixel coordinates.
+    """
+    if os.path.exists(region):
+        with open(region, "r") as f:
+            region = f.read()
+    dtheta = abs(wcs.wcs.cdelt[1])
+    coord_sys = "physical"
+    include = None
+    exclude = None
+    for line in region.replace(";", "\n").split("\n"):
+        line = line.split("#")[0].strip()
+        if len(line) == 0 or line.startswith("global"):
+            continue
+        lower = line.lower()
+        if lower in ["image", "physical", "fk5", "icrs", "j2000", "fk4", "galactic",
+                     "ecliptic", "linear", "amplifier", "detector"]:
+            coord_sys = lower
+            continue
+        excluded = line.startswith("-")
+        line = line.lstrip("+-")
+        if "(" not in line:
+            raise ValueError("Cannot parse the region '%s'!" % line)
+        shape, args = line.split("(", 1)
+        shape = shape.strip().lower()
+        args = [a.strip() for a in args.split(")")[0].split(",")]
+        reg = _make_ds9_shape(shape, args, coord_sys, wcs, dtheta)
+        if excluded:
+            exclude = reg if exclude is None else exclude | reg
+        else:
+            include = reg if include is None else include | reg
+    if include is None:
+        include = EverywhereRegion()
+    if exclude is not None:
+        include = include & ~exclude
+    return include
+
+def _make_ds9_shape(shape, args, coord_sys, wcs, dtheta):
+    if coord_sys in ["image", "physical"]:
+        sky = False
+    elif coord_sys in ["fk5", "icrs", "j2000"]:
+        sky = True
+    else:
+        raise UnsupportedRegion("The '%s' coordinate system is not supported!" % coord_sys)
+
+    def _position(a, b):
+        if sky:
+            ra = _parse_angle(a, hours=True)
+            dec = _parse_angle(b)
+            x, y = wcs.wcs_world2pix(ra, dec, 1)
+            return float(x), float(y)
+        else:
+            return float(a), float(b)
+
+    def _size(a):
+        if a.endswith('"'):
+            return float(a[:-1])/3600./dtheta
+        elif a.endswith("'"):
+            return float(a[:-1])/60./dtheta
+        elif a.endswith("d"):
+            return float(a[:-1])/dtheta
+        elif a.endswith("i") or a.endswith("p"):
+            return float(a[:-1])
+        elif sky:
+            return float(a)/dtheta
+        else:
+            return float(a)
+
+    if shape == "polygon":
+        xy = [_position(args[i], args[i+1]) for i in range(0, len(args), 2)]
+        return PolygonRegion([v[0] for v in xy], [v[1] for v in xy])
+    x, y = _position(args[0], args[1])
+    if shape == "circle":
+        return CircleRegion(x, y, _size(args[2]))
+    elif shape == "annulus":
+        radii = [_size(a) for a in args[2:]]
+        reg = AnnulusRegion(x, y, radii[0], radii[1])
+        for r0, r1 in zip(radii[1:-1], radii[2:]):
+            reg = reg | AnnulusRegion(x, y, r0, r1)
+        return reg
+    elif shape == "box":
+        angle = float(args[4]) if len(args) > 4 else 0.0
+        return BoxRegion(x, y, _size(args[2]), _size(args[3]), angle=angle)
+    elif shape == "ellipse":
+        angle = float(args[4]) if len(args) > 4 else 0.0
+        return EllipseRegion(x, y, _size(args[2]), _size(args[3]), angle=angle)
+    else:
+        raise UnsupportedRegion("The '%s' region shape is not supported!" % shape)
+
+def _parse_angle(a, hours=False):
+    if ":" in a:
+        sign = -1.0 if a.startswith("-") else 1.0
+        d, m, s = [abs(float(v)) for v in a.split(":")]
+        value = sign*(d+m/60.+s/3600.)
+        if hours:
+            value *= 15.0
+        return value
+    else:
+        return float(a.rstrip("d"))
@@ -4,6 +4,7 @@ by the end-user, but will be employed by methods of InstrumentSimulators.
 """
 
 import numpy as np
+import h5py
 from yt.utilities.on_demand_imports import _astropy
 from yt.units.yt_array import YTArray
 from pyxsim.utils import mylog, check_file_location
@@ -46,7 +47,8 @@ class AuxiliaryResponseFile(object):
     def __str__(self):
         return self.filename
 
-    def detect_events(self, energy, area, prng=None):
+    def detect_events(self, energy, area, prng=None, theta=None,
+                      vignetting=None):
         """
         Use the ARF to determine a subset of photons which will be
         detected. Returns a boolean NumPy array which is the same
@@ -64,10 +66,19 @@ class AuxiliaryResponseFile(object):
             A pseudo-random number generator. Typically will only be specified
             if you have a reason to generate the same set of random numbers, such as for a
             test. Default is the :mod:`~numpy.random` module.
+        theta : array_like, optional
+            The off-axis angles of the photons in arcminutes. Only used if
+            *vignetting* is specified.
+        vignetting : :class:`~pyxsim.responses.VignettingTable`, optional
+            If specified, the effective area is multiplied by the vignetting
+            factor at the energy and off-axis angle of each photon.
         """
         if prng is None:
             prng = np.random
-        earea = np.interp(energy, self.emid, self.eff_area, left=0.0, right=0.0)
+        if vignetting is None:
+            earea = np.interp(energy, self.emid, self.eff_area, left=0.0, right=0.0)
+        else:
+            earea = self.interpolate_vignetted_area(energy, theta, vignetting)
         randvec = area.v*prng.uniform(size=energy.shape)
         return randvec < earea
 
@@ -82,6 +93,116 @@ class AuxiliaryResponseFile(object):
         earea = np.interp(energy, self.emid, self.eff_area, left=0.0, right=0.0)
         return YTArray(earea, "cm**2")
 
+    def interpolate_vignetted_area(self, energy, theta, vignetting):
+        """
+        Interpolate the effective area multiplied by the vignetting factor to
+        the energies provided by the supplied *energy* array (in keV) and the
+        off-axis angles in the *theta* array (in arcminutes). The product is
+        tabulated on the grid of ARF energies and vignetting off-axis angles
+        once, and then bilinearly interpolated for all of the events.
+        """
+        emid = self.emid.d
+        area_grid = self.eff_area.d[:,np.newaxis]*vignetting.interpolate_energies(emid)
+        energy = np.asarray(energy)
+        ie = np.clip(np.searchsorted(emid, energy)-1, 0, emid.size-2)
+        we = (energy-emid[ie])/(emid[ie+1]-emid[ie])
+        it, jt, wt = vignetting.theta_weights(theta)
+        earea = (1.-we)*((1.-wt)*area_grid[ie,it]+wt*area_grid[ie,jt])
+        earea += we*((1.-wt)*area_grid[ie+1,it]+wt*area_grid[ie+1,jt])
+        earea[(energy < emid[0]) | (energy > emid[-1])] = 0.0
+        return YTArray(earea, "cm**2")
+
+class VignettingTable(object):
+    r"""
+    A class for tables of the vignetting, i.e. the fraction of the
+    on-axis effective area which is available as a function of energy
+    and off-axis angle. 
+
+    The tables may be stored in one of two formats:
+
+    * A FITS file in the OGIP format, with a ``"VIGNET"`` binary table
+      containing the columns ``"ENERG_LO"``, ``"ENERG_HI"`` (keV),
+      ``"THETA"`` (arcminutes), and ``"VIGNET"`` in the first row. If the
+      vignetting depends on azimuthal angle, the first azimuthal angle is used.
+    * An HDF5 file with the datasets ``"energy"`` (keV, size NE), ``"theta"``
+      (arcminutes, size NT), and ``"vignetting"`` (shape NE x NT).
+
+    Parameters
+    ----------
+    filename : string
+        The filename of the vignetting table to be read.
+
+    Examples
+    --------
+    >>> vig = VignettingTable("athena_wfi_vignetting.fits")
+    """
+    def __init__(self, filename):
+        self.filename = check_file_location(filename, "response_files")
+        if h5py.is_hdf5(self.filename):
+            f = h5py.File(self.filename, "r")
+            self.energy = f["energy"][:].astype("float64")
+            self.theta = f["theta"][:].astype("float64")
+            vignet = f["vignetting"][:].astype("float64")
+            f.close()
+        else:
+            f = _astropy.pyfits.open(self.filename)
+            data = f["VIGNET"].data
+            self.energy = 0.5*(data["ENERG_LO"][0]+data["ENERG_HI"][0]).astype("float64")
+            self.theta = np.asarray(data["THETA"][0], dtype="float64")
+            vignet = np.asarray(data["VIGNET"][0], dtype="float64")
+            f.close()
+            # OGIP tables are ordered as (phi, theta, energy)
+            while vignet.ndim > 2:
+                vignet = vignet[0]
+            vignet = vignet.T
+        if vignet.shape != (self.energy.size, self.theta.size):
+            raise RuntimeError("The shape of the vignetting table in %s " % self.filename +
+                               "does not match the energy and off-axis angle grid!")
+        self.vignetting = np.nan_to_num(vignet)
+
+    def __str__(self):
+        return self.filename
+
+    def interpolate_energies(self, energy):
+        """
+        Interpolate the vignetting table to the energies in *energy*, in keV,
+        returning an array with shape (energy.size, number of off-axis angles).
+        """
+        vig = np.zeros((energy.size, self.theta.size))
+        for i in range(self.theta.size):
+            vig[:,i] = np.interp(energy, self.energy, self.vignetting[:,i])
+        return vig
+
+    def theta_weights(self, theta):
+        """
+        Determine the lower and upper indices into the table and the linear
+        interpolation weights for the off-axis angles in *theta* (in
+        arcminutes). Angles outside the table are clamped to its ends.
+        """
+        theta = np.asarray(theta)
+        if self.theta.size == 1:
+            it = np.zeros(theta.shape, dtype="int64")
+            return it, it, np.zeros(theta.shape)
+        theta = np.clip(theta, self.theta[0], self.theta[-1])
+        it = np.clip(np.searchsorted(self.theta, theta)-1, 0, self.theta.size-2)
+        wt = (theta-self.theta[it])/(self.theta[it+1]-self.theta[it])
+        return it, it+1, wt
+
+    def interpolate(self, energy, theta):
+        """
+        Bilinearly interpolate the vignetting to the energies in *energy* (in keV)
+        and the off-axis angles in *theta* (in arcminutes).
+        """
+        energy, theta = np.broadcast_arrays(energy, theta)
+        it, jt, wt = self.theta_weights(theta)
+        vig_lo = np.zeros(energy.shape)
+        vig_hi = np.zeros(energy.shape)
+        for i in range(self.theta.size):
+            vig = np.interp(energy, self.energy, self.vignetting[:,i])
+            vig_lo[it == i] = vig[it == i]
+            vig_hi[jt == i] = vig[jt == i]
+        return (1.-wt)*vig_lo+wt*vig_hi
+
 class RedistributionMatrixFile(object):
     r"""
     A class for redistribution matrix files (RMFs).
@@ -128,3 +249,205 @@ class RedistributionMatrixFile(object):
 
     def __str__(self):
         return self.filename
+
+sigma_to_fwhm = 2.*np.sqrt(2.*np.log(2.))
+
+class GaussianPSF(object):
+    r"""
+    A circular Gaussian point-spread function (PSF), which is the same
+    for all energies and off-axis angles.
+
+    Parameters
+    ----------
+    fwhm : float
+        The FWHM of the PSF in degrees.
+
+    Examples
+    --------
+    >>> psf = GaussianPSF(0.0001388889)
+    """
+    def __init__(self, fwhm):
+        self.fwhm = fwhm
+        self.sigma = fwhm/sigma_to_fwhm
+
+    def __str__(self):
+        return "Gaussian PSF with FWHM = %g deg" % self.fwhm
+
+    def generate_offsets(self, energy, theta, prng=None):
+        """
+        Generate random offsets in degrees for events at the energies
+        *energy* (in keV) and off-axis angles *theta* (in arcminutes),
+        which are ignored for this PSF. Returns the x and y offsets.
+        """
+        if prng is None:
+            prng = np.random
+        n = energy.size
+        dx = prng.normal(scale=self.sigma, size=n)
+        dy = prng.normal(scale=self.sigma, size=n)
+        return dx, dy
+
+class TabulatedPSF(object):
+    r"""
+    A point-spread function (PSF) tabulated as a set of 2D images on a
+    grid of energies and off-axis angles. Events are assigned the image
+    which is nearest to their energy and off-axis angle, and their offsets
+    are drawn from the image using a precomputed cumulative distribution.
+
+    The tables may be stored in one of two formats:
+
+    * A FITS file with one image HDU for each energy and off-axis angle,
+      with the keywords ``"ENERGY"`` (in keV) and ``"THETA"`` (in arcminutes,
+      assumed to be zero if not present). The pixel scale is taken from
+      ``"CDELT2"`` (in degrees), and the center of the PSF from ``"CRPIX1"``
+      and ``"CRPIX2"`` if present, otherwise the center of the image.
+    * An HDF5 file with the datasets ``"energy"`` (keV, size NE), ``"theta"``
+      (arcminutes, size NT), ``"images"`` (shape NE x NT x NY x NX), and
+      ``"pixel_scale"`` (degrees). The PSF centers are assumed to be at the
+      centers of the images.
+
+    Parameters
+    ----------
+    filename : string
+        The path to the FITS or HDF5 file containing the PSF images.
+
+    Examples
+    --------
+    >>> psf = TabulatedPSF("my_psf_library.fits")
+    >>> ACIS_I_psf = InstrumentSimulator(0.0001366667, 8192, psf,
+    ...                                  "acisi_aimpt_cy18.arf",
+    ...                                  "acisi_aimpt_cy18.rmf")
+    """
+    def __init__(self, filename):
+        self.filename = check_file_location(filename, "response_files")
+        if h5py.is_hdf5(self.filename):
+            images, centers, scales = self._read_h5_file()
+        else:
+            images, centers, scales = self._read_fits_file()
+        self.num_energies = self.energy.size
+        self.num_theta = self.theta.size
+        self.shapes = []
+        self.cdfs = []
+        for image in images:
+            image = np.nan_to_num(np.asarray(image, dtype="float64"))
+            if image.sum() <= 0.0:
+                raise RuntimeError("The PSF file %s contains an " % self.filename +
+                                   "image with zero or negative total!")
+            cdf = np.cumsum(np.maximum(image, 0.0).ravel())
+            cdf /= cdf[-1]
+            self.shapes.append(image.shape)
+            self.cdfs.append(cdf)
+        self.centers = centers
+        self.scales = scales
+        self.fwhm = self._image_fwhm(images, np.argmin(self.theta))
+        # Bin edges halfway between the tabulated values, so that events
+        # are assigned to the nearest image
+        self._ebounds = 0.5*(self.energy[1:]+self.energy[:-1])
+        self._tbounds = 0.5*(self.theta[1:]+self.theta[:-1])
+
+    def __str__(self):
+        return self.filename
+
+    def _image_fwhm(self, images, i):
+        # The FWHM of image i in degrees, from the radius at which the
+        # image falls to half of its maximum, interpolated between the
+        # farthest pixel above half and the nearest pixel below it
+        image = np.nan_to_num(np.asarray(images[i], dtype="float64"))
+        ny, nx = image.shape
+        xc, yc = self.centers[i]
+        y, x = np.mgrid[0:ny,0:nx]+0.5
+        r = np.hypot(x-xc, y-yc).ravel()
+        v = image.ravel()/image.max()
+        above = v >= 0.5
+        if above.all():
+            return 2.0*r.max()*self.scales[i]
+        i1 = np.flatnonzero(above)[np.argmax(r[above])]
+        i2 = np.flatnonzero(~above)[np.argmin(r[~above])]
+        if r[i2] <= r[i1] or v[i1] == v[i2]:
+            r_half = 0.5*(r[i1]+r[i2])
+        else:
+            r_half = r[i1]+(v[i1]-0.5)/(v[i1]-v[i2])*(r[i2]-r[i1])
+        return 2.0*r_half*self.scales[i]
+
+    def _read_h5_file(self):
+        f = h5py.File(self.filename, "r")
+        self.energy = f["energy"][:].astype("float64")
+        self.theta = f["theta"][:].astype("float64")
+        data = f["images"][:]
+        scale = float(f["pixel_scale"][()])
+        f.close()
+        ne, nt, ny, nx = data.shape
+        if ne != self.energy.size or nt != self.theta.size:
+            raise RuntimeError("The shape of the PSF images in %s " % self.filename +
+                               "does not match the energy and off-axis angle grid!")
+        images = [data[i,j] for i in range(ne) for j in range(nt)]
+        centers = [(0.5*nx, 0.5*ny)]*(ne*nt)
+        scales = [scale]*(ne*nt)
+        return images, centers, scales
+
+    def _read_fits_file(self):
+        hdulist = _astropy.pyfits.open(self.filename)
+        table = {}
+        for hdu in hdulist:
+            if hdu.data is None or hdu.header.get("NAXIS", 0) != 2:
+                continue
+            header = hdu.header
+            e = float(header["ENERGY"])
+            t = float(header.get("THETA", 0.0))
+            ny, nx = hdu.data.shape
+            # Convert the 1-based reference pixel to the offset of the PSF
+            # center from the corner of the image, in pixels
+            xc = header.get("CRPIX1", 0.5*(nx+1)) - 0.5
+            yc = header.get("CRPIX2", 0.5*(ny+1)) - 0.5
+            table[e, t] = (hdu.data.copy(), (xc, yc), abs(float(header["CDELT2"])))
+        hdulist.close()
+        if len(table) == 0:
+            raise RuntimeError("No PSF images were found in %s!" % self.filename)
+        self.energy = np.unique([k[0] for k in table])
+        self.theta = np.unique([k[1] for k in table])
+        images = []
+        centers = []
+        scales = []
+        for e in self.energy:
+            for t in self.theta:
+                if (e, t) not in table:
+                    raise RuntimeError("The PSF file %s does not have an image " % self.filename +
+                                       "for energy %g keV and off-axis angle %g arcmin!" % (e, t))
+                image, center, scale = table[e, t]
+                images.append(image)
+                centers.append(center)
+                scales.append(scale)
+        return images, centers, scales
+
+    def generate_offsets(self, energy, theta, prng=None):
+        """
+        Generate random offsets in degrees for events at the energies
+        *energy* (in keV) and off-axis angles *theta* (in arcminutes).
+        Returns the x and y offsets.
+        """
+        if prng is None:
+            prng = np.random
+        energy = np.asarray(energy)
+        n = energy.size
+        bins = np.searchsorted(self._ebounds, energy)*self.num_theta
+        if self.num_theta > 1:
+            bins += np.searchsorted(self._tbounds, theta)
+        dx = np.zeros(n)
+        dy = np.zeros(n)
+        # Group the events by image, so that each image is sampled only once
+        idxs = np.argsort(bins, kind="mergesort")
+        counts = np.bincount(bins, minlength=len(self.cdfs))
+        start = 0
+        for ibin, count in enumerate(counts):
+            if count == 0:
+                continue
+            ii = idxs[start:start+count]
+            start += count
+            ny, nx = self.shapes[ibin]
+            xc, yc = self.centers[ibin]
+            pix = np.searchsorted(self.cdfs[ibin], prng.uniform(size=count), side="right")
+            np.minimum(pix, nx*ny-1, out=pix)
+            iy = pix // nx
+            ix = pix - iy*nx
+            dx[ii] = (ix+prng.uniform(size=count)-xc)*self.scales[ibin]
+            dy[ii] = (iy+prng.uniform(size=count)-yc)*self.scales[ibin]
+        return dx, dy
@@ -0,0 +1,53 @@
+from pyxsim.event_list import EventList
+from pyxsim.tests.utils import create_dummy_wcs
+from numpy.random import RandomState
+import numpy as np
+
+def setup():
+    from yt.config import ytcfg
+    ytcfg["yt", "__withintesting"] = "True"
+
+def test_background_template():
+
+    wcs = create_dummy_wcs()
+    events = EventList.create_empty_list((100., "ks"), (1000., "cm**2"), wcs)
+    ebins = np.linspace(0.1, 10.0, 101)
+    spec = 1.0e-6*np.ones(100)
+    nx = 1024
+
+    # A template with only the left half of the field
+    template = np.zeros((64, 64))
+    template[:,:32] = 1.0
+
+    # The same seed gives the same background
+    events1 = events.add_background(ebins, spec, prng=RandomState(39), template=template)
+    events2 = events.add_background(ebins, spec, prng=RandomState(39), template=template)
+    assert events1.num_events > 0
+    for key in ["xpix", "ypix", "eobs"]:
+        assert np.all(events1[key] == events2[key])
+    assert np.all(events1["xpix"] >= 0.5) and np.all(events1["xpix"] < 0.5*nx+0.5)
+    assert np.all(events1["ypix"] >= 0.5) and np.all(events1["ypix"] < nx+0.5)
+
+    # With a template for each energy band, the events of each band follow
+    # its own image
+    templates = np.zeros((2, 64, 64))
+    templates[0,:,:32] = 1.0
+    templates[1,:,32:] = 1.0
+    events3 = events.add_background(ebins, spec, prng=RandomState(39),
+                                    template=templates, template_bins=[0.1, 5.0, 10.0])
+    low = events3["eobs"].d < 5.0
+    assert np.all(events3["xpix"][low] < 0.5*nx+0.5)
+    assert np.all(events3["xpix"][~low] >= 0.5*nx+0.5)
+
+    # Negative, non-finite, or empty templates are rejected
+    for bad in [-template, np.where(template > 0.0, np.nan, 0.0),
+                np.zeros((64, 64)), np.ones(64)]:
+        try:
+            events.add_background(ebins, spec, prng=RandomState(39), template=bad)
+        except ValueError:
+            pass
+        else:
+            assert False
+
+if __name__ == "__main__":
+    test_background_template()
@@ -0,0 +1,323 @@
+from pyxsim.event_list import EventList, write_fits_event_file
+from pyxsim.utils import merge_files
+from pyxsim.tests.utils import create_dummy_wcs
+from numpy.random import RandomState
+import numpy as np
+import tempfile
+import shutil
+import os
+import h5py
+
+prng = RandomState(31)
+
+def setup():
+    from yt.config import ytcfg
+    ytcfg["yt", "__withintesting"] = "True"
+
+def make_events():
+    wcs = create_dummy_wcs()
+    events = EventList.create_empty_list((100., "ks"), (1000., "cm**2"), wcs)
+    ebins = np.linspace(0.1, 10.0, 101)
+    spec = 1.0e-6*np.ones(100)
+    return events.add_background(ebins, spec, prng=prng)
+
+def test_fits_blocks():
+
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    events = make_events()
+    n = events.num_events
+    assert n > 3000
+
+    # Several blocks, the last of which is partial
+    events.write_fits_file("blocks.fits", clobber=True, block_size=1000)
+    new_events = EventList.from_fits_file("blocks.fits")
+    assert new_events.num_events == n
+    for key in ["xpix", "ypix"]:
+        assert np.all(new_events[key] == events[key])
+    assert np.allclose(new_events["eobs"].d, events["eobs"].d, rtol=1.0e-6)
+
+    # An empty block in the middle of the stream
+    keys = ["xpix", "ypix", "eobs"]
+    blocks = [dict((k, events.events[k][:1000]) for k in keys),
+              dict((k, events.events[k][:0]) for k in keys),
+              dict((k, events.events[k][1000:]) for k in keys)]
+    write_fits_event_file("empty_block.fits", events.parameters, blocks, clobber=True)
+    new_events = EventList.from_fits_file("empty_block.fits")
+    assert new_events.num_events == n
+    assert np.all(new_events["xpix"] == events["xpix"])
+
+    # A failure while streaming the blocks leaves no file behind
+    def bad_blocks():
+        yield dict((k, events.events[k][:1000]) for k in keys)
+        raise RuntimeError("Failed to make a block!")
+    try:
+        write_fits_event_file("bad.fits", events.parameters, bad_blocks(), clobber=True)
+    except RuntimeError:
+        pass
+    else:
+        assert False
+    assert not os.path.exists("bad.fits")
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
+
+def test_h5_layout():
+
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    events = make_events()
+
+    events.write_h5_file("events.h5")
+    new_events = EventList.from_h5_file("events.h5")
+    for key in ["xpix", "ypix", "eobs"]:
+        assert np.all(new_events[key] == events[key])
+
+    events.write_h5_file("events_sp.h5", compression="lzf", single_precision=True)
+    f = h5py.File("events_sp.h5", "r")
+    assert f.attrs["version"] == 2
+    for key in ["xpix", "ypix", "eobs"]:
+        assert f["data"][key].dtype == np.float32
+        assert f["data"][key].compression == "lzf"
+        assert f["data"][key].maxshape == (None,)
+    f.close()
+    new_events = EventList.from_h5_file("events_sp.h5")
+    for key in ["xpix", "ypix", "eobs"]:
+        assert np.all(new_events[key] == np.asarray(events[key]).astype("float32"))
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
+
+def test_selective_reads():
+
+    import pyxsim.event_list
+
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    # Use small blocks so that the reads and the energy index span many of them
+    chunk_size = pyxsim.event_list.h5_chunk_size
+    pyxsim.event_list.h5_chunk_size = 256
+
+    try:
+        events = make_events()
+        x = events["xpix"]
+        y = events["ypix"]
+        e = events["eobs"].d
+        emin, emax = 2.0, 5.0
+        box = (300.0, 700.0, 200.0, 600.0)
+        in_band = (e >= emin) & (e < emax)
+        in_box = (x >= box[0]) & (x <= box[1]) & (y >= box[2]) & (y <= box[3])
+        order = np.argsort(e[in_band & in_box], kind="mergesort")
+
+        events.write_h5_file("events.h5")
+        events.write_h5_file("events_sorted.h5", sort_by_energy=True)
+        events.write_fits_file("events.fits", clobber=True)
+
+        for fn, sort in [("events.h5", False), ("events_sorted.h5", True),
+                         ("events.fits", False)]:
+            if fn.endswith(".fits"):
+                read = EventList.from_fits_file
+            else:
+                read = EventList.from_h5_file
+            new_events = read(fn, emin=emin, emax=emax, box=box,
+                              fields=["xpix", "ypix", "eobs"])
+            assert new_events.num_events == (in_band & in_box).sum()
+            new_x = new_events["xpix"]
+            new_e = new_events["eobs"].d
+            if sort:
+                assert np.all(new_x == x[in_band & in_box][order])
+            else:
+                assert np.all(new_x == x[in_band & in_box])
+                assert np.allclose(new_e, e[in_band & in_box], rtol=1.0e-6)
+            # Only the energy band
+            new_events = read(fn, emin=emin, emax=emax)
+            assert new_events.num_events == in_band.sum()
+            assert new_events["eobs"].d.min() >= emin
+            assert new_events["eobs"].d.max() < emax
+
+        new_events = EventList.from_h5_file("events_sorted.h5", emin=emin)
+        assert np.all(new_events["eobs"].d == np.sort(e[e >= emin]))
+
+        new_events = EventList.from_h5_file("events.h5", fields=["ypix"])
+        assert list(new_events.keys()) == ["ypix"]
+        assert np.all(new_events["ypix"] == y)
+    finally:
+        pyxsim.event_list.h5_chunk_size = chunk_size
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
+
+def test_shards():
+
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    events1 = make_events()
+    events2 = make_events()
+
+    events1.write_shards("set1", shard_size=1000)
+    assert len([fn for fn in os.listdir("set1") if fn.startswith("shard_")]) == \
+        (events1.num_events+999)//1000
+    new_events = EventList.from_h5_file("set1")
+    for key in ["xpix", "ypix", "eobs"]:
+        assert np.all(new_events[key] == events1[key])
+    events2.write_shards("set2")
+    events2.write_h5_file("events2.h5")
+
+    # Merging file sets only writes a new manifest over all of the shards
+    merge_files(["set1", "set2"], "merged", add_exposure_times=True)
+    assert os.listdir("merged") == ["manifest.h5"]
+    merged = EventList.from_h5_file("merged")
+    assert merged.num_events == events1.num_events+events2.num_events
+    assert merged.parameters["ExposureTime"] == 2*events1.parameters["ExposureTime"]
+    for key in ["xpix", "ypix", "eobs"]:
+        assert np.all(merged[key] == np.concatenate([events1[key], events2[key]]))
+    merged = EventList.from_h5_file("merged", emin=2.0, emax=5.0)
+    e = np.concatenate([events1["eobs"].d, events2["eobs"].d])
+    assert np.all(merged["eobs"].d == e[(e >= 2.0) & (e < 5.0)])
+
+    # File sets and single files cannot be merged together
+    try:
+        merge_files(["set1", "events2.h5"], "mixed.h5")
+    except ValueError:
+        pass
+    else:
+        assert False
+    assert not os.path.exists("mixed.h5")
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
+
+def test_image_cube():
+
+    from yt.utilities.on_demand_imports import _astropy
+
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    events = make_events()
+    events.parameters["dtheta"] = abs(events.parameters["dtheta"])
+    events = EventList(events.events, events.parameters)
+    x = events["xpix"]
+    y = events["ypix"]
+    e = events["eobs"].d
+
+    ebins = np.linspace(0.5, 7.0, 14)
+    for reblock in [1, 4, 3]:
+        nb = -(-1024 // reblock)
+        cube = events.make_image_cube(ebins, reblock=reblock)
+        assert cube.shape == (ebins.size-1, nb, nb)
+        # Each band has the counts of the events in it, binned as with histogramdd
+        H = np.histogramdd([e, y, x], bins=[ebins, 0.5+np.arange(nb+1)*reblock,
+                                            0.5+np.arange(nb+1)*reblock])[0]
+        assert np.all(cube == H)
+        assert cube.sum() == ((e >= ebins[0]) & (e < ebins[-1])).sum()
+
+    events.write_fits_cube("cube.fits", ebins, reblock=4, clobber=True)
+    events.write_fits_image("image.fits", emin=ebins[0], emax=ebins[-1], reblock=4,
+                            clobber=True)
+    f = _astropy.pyfits.open("cube.fits")
+    assert np.all(f[0].data == events.make_image_cube(ebins, reblock=4))
+    assert f[0].header["CTYPE3"] == "ENERGY"
+    assert np.isclose(f[0].header["CDELT3"], 0.5)
+    assert np.isclose(f[0].header["CRVAL3"], 0.75)
+    hdr = f[0].header
+    f.close()
+    f = _astropy.pyfits.open("image.fits")
+    assert np.all(f[0].data == events.make_image_cube(ebins, reblock=4).sum(axis=0))
+    f.close()
+    # The reblocked pixel of each event is at the same sky position
+    wcs = _astropy.pywcs.WCS(naxis=2)
+    wcs.wcs.crpix = [hdr["CRPIX1"], hdr["CRPIX2"]]
+    wcs.wcs.crval = [hdr["CRVAL1"], hdr["CRVAL2"]]
+    wcs.wcs.cdelt = [hdr["CDELT1"], hdr["CDELT2"]]
+    wcs.wcs.ctype = [hdr["CTYPE1"], hdr["CTYPE2"]]
+    assert hdr["CRPIX1"] == 128.5 and hdr["CRPIX2"] == 128.5
+    ra, dec = wcs.wcs_pix2world((x-0.5)/4.0+0.5, (y-0.5)/4.0+0.5, 1)
+    assert np.allclose(ra, events["xsky"].d, rtol=0.0, atol=1.0e-10)
+    assert np.allclose(dec, events["ysky"].d, rtol=0.0, atol=1.0e-10)
+
+    # Bands which are not evenly spaced are written to an extension
+    ebins = np.array([0.5, 1.0, 2.0, 7.0])
+    events.write_fits_cube("cube.fits", ebins, clobber=True)
+    f = _astropy.pyfits.open("cube.fits")
+    assert f[0].header["CTYPE3"] == "BAND"
+    assert np.all(f["EBOUNDS"].data["E_MIN"] == ebins[:-1])
+    assert np.all(f["EBOUNDS"].data["E_MAX"] == ebins[1:])
+    assert np.all(f[0].data.sum(axis=(1, 2)) == np.histogram(e, bins=ebins)[0])
+    f.close()
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
+
+def test_event_columns():
+
+    from yt.units.yt_array import YTArray
+
+    events = make_events()
+    n = events.num_events
+    parameters = events.parameters
+
+    # The columns are stored as plain arrays with the types and units of the
+    # schema, and the units are attached when they are accessed
+    columns = {"xpix": events["xpix"], "ypix": events["ypix"],
+               "eobs": YTArray(events["eobs"].d*1000.0, "eV"),
+               "PI": np.floor(events["eobs"].d*100.0),
+               "time": np.arange(n)*1.0}
+    events = EventList(columns, parameters)
+    for key, dtype in [("xpix", "float64"), ("eobs", "float64"), ("PI", "int64")]:
+        assert type(events.events[key]) is np.ndarray
+        assert events.events[key].dtype == dtype
+        assert events.events[key].flags.c_contiguous
+    assert str(events["eobs"].units) == "keV"
+    assert np.allclose(events["eobs"].d, columns["eobs"].d/1000.0, rtol=1.0e-15)
+    assert np.all(events["PI"] == columns["PI"])
+    assert not isinstance(events["xpix"], YTArray)
+    assert events["xsky"].units == events["ysky"].units
+    assert str(events["xsky"].units) in ["deg", "degree"]
+
+    # Selecting events keeps all of the columns aligned, which the times
+    # let us check, since they are the original indices of the events
+    mask = (events["eobs"].d > 2.0) & (events["xpix"] < 600.0)
+    idxs = prng.permutation(n)[:n//3]
+    for sel, orig in [(mask, np.flatnonzero(mask)), (idxs, idxs),
+                      (slice(10, 1000, 7), np.arange(10, 1000, 7))]:
+        new_events = events.select(sel)
+        assert new_events.num_events == orig.size
+        assert set(new_events.keys()) == set(events.keys())
+        assert np.all(new_events["time"] == orig)
+        for key in events.keys():
+            assert np.all(new_events.events[key] == events.events[key][orig])
+            assert new_events.events[key].dtype == events.events[key].dtype
+
+    # Selecting a slice does not copy the columns
+    new_events = events.select(slice(100, 200))
+    for key in events.keys():
+        assert np.shares_memory(new_events.events[key], events.events[key])
+
+    # Adding event lists concatenates the columns by key, and the sky
+    # coordinates are only kept if both lists have them
+    other = EventList(dict((k, columns[k]) for k in ["time", "PI", "eobs", "ypix", "xpix"]),
+                      parameters)
+    all_events = events + other
+    assert all_events.num_events == 2*n
+    assert "xsky" not in all_events
+    for key in other.keys():
+        assert np.all(all_events.events[key] ==
+                      np.concatenate([events.events[key], other.events[key]]))
+
+if __name__ == "__main__":
+    test_fits_blocks()
+    test_h5_layout()
+    test_selective_reads()
+    test_shards()
+    test_image_cube()
+    test_event_columns()
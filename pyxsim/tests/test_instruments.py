@@ -0,0 +1,276 @@
+from pyxsim.responses import AuxiliaryResponseFile, VignettingTable
+from pyxsim.instruments import InstrumentSimulator, ChipLayout, same_tangent_plane
+from pyxsim.event_list import EventList
+from pyxsim.tests.utils import create_dummy_wcs
+from yt.units.yt_array import YTArray, YTQuantity
+from numpy.random import RandomState
+import numpy as np
+import tempfile
+import shutil
+import os
+import h5py
+
+prng = RandomState(27)
+
+def setup():
+    from yt.config import ytcfg
+    ytcfg["yt", "__withintesting"] = "True"
+
+def test_vignetting():
+
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    energy = np.array([0.5, 2.0, 8.0])
+    theta = np.array([0.0, 5.0, 10.0])
+    vignetting = np.array([[1.0, 0.8, 0.5],
+                           [1.0, 0.7, 0.4],
+                           [1.0, 0.6, 0.2]])
+    f = h5py.File("vignetting.h5", "w")
+    f.create_dataset("energy", data=energy)
+    f.create_dataset("theta", data=theta)
+    f.create_dataset("vignetting", data=vignetting)
+    f.close()
+
+    vig = VignettingTable("vignetting.h5")
+    arf = AuxiliaryResponseFile("aciss_aimpt_cy18.arf")
+
+    e = prng.uniform(0.5, 8.0, size=10000)
+    area = arf.interpolate_area(YTArray(e, "keV")).d
+
+    # On-axis, the vignetted area is the area of the ARF
+    area0 = arf.interpolate_vignetted_area(e, np.zeros(e.size), vig).d
+    assert np.allclose(area0, area, rtol=1.0e-10, atol=0.0)
+
+    # At a tabulated off-axis angle and energy, the area is scaled by
+    # the vignetting factor
+    e = arf.emid.d[(arf.emid.d > 0.5) & (arf.emid.d < 8.0)]
+    area10 = arf.interpolate_vignetted_area(e, 10.0*np.ones(e.size), vig).d
+    assert np.allclose(area10, arf.eff_area.d[(arf.emid.d > 0.5) & (arf.emid.d < 8.0)] *
+                       np.interp(e, energy, vignetting[:,2]), rtol=1.0e-10, atol=0.0)
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
+
+def test_chip_layout():
+
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    with open("layout.txt", "w") as f:
+        f.write("# Two chips with a gap between them\n")
+        f.write("chip -100 -5 -100 100\n\nchip 5 100 -100 100\n")
+        f.write("bad 50 50\n")
+    layout = ChipLayout.from_file("layout.txt")
+    assert layout.mask.shape == (200, 200)
+    assert layout.mask.sum() == 2*95*200-1
+    assert not layout.on_chips(np.array([50.5, 0.0]), np.array([50.5, 0.0])).any()
+    assert layout.on_chips(np.array([-50.0, 99.9]), np.array([-99.9, 0.0])).all()
+
+    wcs = create_dummy_wcs()
+    events = EventList.create_empty_list((100., "ks"), (1000., "cm**2"), wcs)
+    ebins = np.linspace(0.1, 10.0, 101)
+    spec = 1.0e-6*np.ones(100)
+    events = events.add_background(ebins, spec, prng=prng)
+    events.parameters["dtheta"] = abs(events.parameters["dtheta"])
+
+    # Without dither, events in the chip gap and on the bad pixel are removed
+    inst = InstrumentSimulator(0.001, 1024, 0.001, "aciss_aimpt_cy18.arf",
+                               "aciss_aimpt_cy18.rmf", chips=layout)
+    detx = events["xpix"]-events.parameters["pix_center"][0]
+    dety = events["ypix"]-events.parameters["pix_center"][1]
+    on_chip = (((detx >= -100) & (detx < -5)) | ((detx >= 5) & (detx < 100))) & \
+        (dety >= -100) & (dety < 100) & \
+        ~((np.floor(detx) == 50) & (np.floor(dety) == 50))
+    new_events = EventList(events.events.copy(), events.parameters.copy())
+    inst.apply_chip_layout(new_events, prng)
+    assert new_events.num_events == on_chip.sum()
+    assert np.all(new_events["xpix"] == events["xpix"][on_chip])
+
+    # With dither, the positions on the detector are offset by the dither
+    # pattern at the time of each event, so some events in the gap survive
+    dither = (16.0, 8.0, 1000.0, 700.0)
+    inst = InstrumentSimulator(0.001, 1024, 0.001, "aciss_aimpt_cy18.arf",
+                               "aciss_aimpt_cy18.rmf", chips=layout,
+                               dither_params=dither)
+    dx, dy = inst.dither_offsets(np.array([250.0, 175.0, 500.0]))
+    assert np.allclose(dx, [16.0/3600., 16.0/3600.*np.sin(0.35*np.pi), 0.0], atol=1.0e-15)
+    assert np.allclose(dy[1], 8.0/3600.)
+    new_events = EventList(events.events.copy(), events.parameters.copy())
+    inst.apply_chip_layout(new_events, prng)
+    t = new_events["time"]
+    dx, dy = inst.dither_offsets(t)
+    assert layout.on_chips(new_events["xpix"]-events.parameters["pix_center"][0]-dx/0.001,
+                           new_events["ypix"]-events.parameters["pix_center"][1]-dy/0.001).all()
+    gap = np.abs(new_events["xpix"]-events.parameters["pix_center"][0]) < 5.0
+    assert gap.sum() > 0
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
+
+def test_pileup():
+
+    from pyxsim.responses import RedistributionMatrixFile
+    from yt.units.yt_array import YTQuantity
+
+    frame_time = 3.2
+    emax = RedistributionMatrixFile("aciss_aimpt_cy18.rmf").ehi[-1]
+
+    # A bright source with three events in each of 110 frames, of which
+    # the last 10 pile up above the maximum energy of the response, and
+    # 50 faint sources far apart with one event each
+    nbright = 110
+    t = np.repeat(np.arange(nbright)*frame_time, 3)+prng.uniform(0.0, 0.9*frame_time, 3*nbright)
+    e = np.repeat(np.where(np.arange(nbright) < 100, 2.0, emax/2.0), 3)
+    x = 512.5+prng.uniform(0.1, 2.9, 3*nbright)
+    y = 512.5+prng.uniform(0.1, 2.9, 3*nbright)
+    nfaint = 50
+    t = np.concatenate([t, prng.uniform(0.0, nbright*frame_time, nfaint)])
+    e = np.concatenate([e, np.ones(nfaint)])
+    x = np.concatenate([x, 50.0+np.arange(nfaint)*10.0])
+    y = np.concatenate([y, 50.0*np.ones(nfaint)])
+    idxs = prng.permutation(t.size)
+    events = {"xpix": x[idxs], "ypix": y[idxs], "time": t[idxs],
+              "eobs": YTArray(e[idxs], "keV")}
+    parameters = {"ExposureTime": YTQuantity(nbright*frame_time, "s"),
+                  "Area": YTQuantity(1000.0, "cm**2"),
+                  "pix_center": np.array([512.5, 512.5]),
+                  "sky_center": YTArray([30.0, 45.0], "deg"),
+                  "dtheta": YTQuantity(0.0001366667, "deg")}
+    events = EventList(events, parameters)
+
+    inst = InstrumentSimulator(0.0001366667, 1024, 0.0001388889,
+                               "aciss_aimpt_cy18.arf", "aciss_aimpt_cy18.rmf",
+                               frame_time=frame_time)
+    inst.apply_pileup(events, prng)
+
+    assert events.num_events == 100+nfaint
+    assert events["eobs"].size == events.num_events
+    assert np.abs(events["eobs"].d.sum()-(100*6.0+nfaint)) < 1.0e-8
+    bright = np.abs(events["xpix"]-514.0) < 1.5
+    assert np.all(events["eobs"].d[bright] == 6.0)
+    assert np.all(events["eobs"].d[~bright] == 1.0)
+    assert events["eobs"].d.max() < emax
+
+def test_exposure_map():
+
+    from yt.utilities.on_demand_imports import _astropy
+
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    wcs = create_dummy_wcs()
+    events = EventList.create_empty_list((100., "ks"), (1000., "cm**2"), wcs)
+    ebins = np.linspace(0.1, 10.0, 101)
+    spec = 1.0e-6*np.ones(100)
+    events = events.add_background(ebins, spec, prng=prng)
+    events.parameters["dtheta"] = abs(events.parameters["dtheta"])
+
+    arf = AuxiliaryResponseFile("aciss_aimpt_cy18.arf", rmffile="aciss_aimpt_cy18.rmf")
+    de = (arf.ehi-arf.elo).d
+    area = (arf.eff_area.d*de).sum()/de.sum()
+    exp_time = float(events.parameters["ExposureTime"])
+
+    # Two chips with a gap between them, smeared by the dither
+    layout = ChipLayout([(-100, -5, -100, 100), (5, 100, -100, 100)])
+    inst = InstrumentSimulator(0.001, 1024, 0.001, "aciss_aimpt_cy18.arf",
+                               "aciss_aimpt_cy18.rmf", chips=layout,
+                               dither_params=(16.0, 8.0, 1000.0, 700.0))
+    new_events = inst(events, prng=prng)
+    reblock = 4
+    expmap = inst.make_exposure_map(new_events, reblock=reblock)
+    assert expmap.shape == (256, 256)
+    assert str(expmap.units) == "cm**2*s"
+    # Fully exposed in the middle of a chip and not at all far from the chips,
+    # and partly exposed in the chip gap
+    assert np.isclose(expmap.d[128,115], area*exp_time, rtol=1.0e-6)
+    assert expmap.d[128,168] == 0.0
+    assert expmap.d[10,115] == 0.0
+    assert 0.0 < expmap.d[128,128] < area*exp_time
+
+    # The exposure map is on the grid of the image, so the flux image can be
+    # written with it
+    new_events.write_fits_image("flux.fits", reblock=reblock, exposure_map=expmap,
+                                clobber=True)
+    new_events.write_fits_image("counts.fits", reblock=reblock, clobber=True)
+    counts = _astropy.pyfits.getdata("counts.fits")
+    flux = _astropy.pyfits.getdata("flux.fits")
+    assert flux.shape == expmap.shape
+    exposed = expmap.d > 0.0
+    assert np.allclose(flux[exposed], counts[exposed]/expmap.d[exposed])
+    assert np.all(flux[~exposed] == 0.0)
+    assert np.all(counts[~exposed] == 0)
+
+    # A layout which is entirely outside of the field is never exposed
+    layout = ChipLayout([(5000, 6000, 5000, 6000)])
+    inst = InstrumentSimulator(0.001, 1024, 0.001, "aciss_aimpt_cy18.arf",
+                               "aciss_aimpt_cy18.rmf", chips=layout)
+    expmap = inst.make_exposure_map(new_events, reblock=reblock)
+    assert expmap.shape == (256, 256)
+    assert np.all(expmap.d == 0.0)
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
+
+def test_rebin():
+
+    wcs = create_dummy_wcs()
+    n = 10000
+    events = {"xpix": prng.uniform(0.5, 1024.5, n),
+              "ypix": prng.uniform(0.5, 1024.5, n),
+              "eobs": YTArray(prng.uniform(0.1, 10.0, n), "keV")}
+    parameters = {"ExposureTime": YTQuantity(100000.0, "s"),
+                  "Area": YTQuantity(1000.0, "cm**2"),
+                  "pix_center": np.array([512.5, 512.5]),
+                  "sky_center": YTArray([30.0, 45.0], "deg"),
+                  "dtheta": YTQuantity(0.001, "deg")}
+    inst = InstrumentSimulator(0.0004, 2048, 0.0004, "aciss_aimpt_cy18.arf",
+                               "aciss_aimpt_cy18.rmf")
+    new_wcs = inst._make_wcs(parameters["sky_center"].d)
+
+    # On the same tangent plane, the pixel coordinates are transformed
+    # directly, so sky coordinates which are already there are not used
+    events = EventList(events, parameters.copy())
+    xsky, ysky = events["xsky"].d.copy(), events["ysky"].d.copy()
+    assert same_tangent_plane(events.wcs, new_wcs)
+    events.events["xsky"] = np.nan*xsky
+    events.events["ysky"] = np.nan*ysky
+    inst.rebin(events)
+    x, y = new_wcs.wcs_world2pix(xsky, ysky, 1)
+    assert np.allclose(events["xpix"], x, rtol=0.0, atol=1.0e-6)
+    assert np.allclose(events["ypix"], y, rtol=0.0, atol=1.0e-6)
+    assert np.all(events.parameters["pix_center"] == 1024.5)
+    assert events.parameters["dtheta"] == YTQuantity(0.0004, "deg")
+
+    # The sky coordinates are recomputed from the new pixel coordinates
+    # only when they are asked for
+    assert "xsky" not in events.events and "ysky" not in events.events
+    assert np.allclose(events["xsky"].d, xsky, rtol=0.0, atol=1.0e-9)
+    assert np.allclose(events["ysky"].d, ysky, rtol=0.0, atol=1.0e-9)
+
+    # With a different reference point, the positions go through the sky
+    # coordinates, for which the direct transform would be wrong
+    wcs.wcs.crval = [30.05, 44.95]
+    events = EventList(dict((k, events.events[k]) for k in ["xpix", "ypix", "eobs"]),
+                       events.parameters.copy(), wcs)
+    events.parameters["pix_center"] = wcs.wcs.crpix[:]
+    events.parameters["dtheta"] = YTQuantity(0.001, "deg")
+    xsky, ysky = events["xsky"].d.copy(), events["ysky"].d.copy()
+    assert not same_tangent_plane(events.wcs, new_wcs)
+    inst.rebin(events)
+    x, y = new_wcs.wcs_world2pix(xsky, ysky, 1)
+    assert np.allclose(events["xpix"], x, rtol=0.0, atol=1.0e-6)
+    assert np.allclose(events["ypix"], y, rtol=0.0, atol=1.0e-6)
+    assert np.all(events.wcs.wcs.crval == parameters["sky_center"].d)
+    assert np.allclose(events["xsky"].d, xsky, rtol=0.0, atol=1.0e-9)
+    assert np.allclose(events["ysky"].d, ysky, rtol=0.0, atol=1.0e-9)
+
+if __name__ == "__main__":
+    test_vignetting()
+    test_chip_layout()
+    test_pileup()
+    test_exposure_map()
+    test_rebin()
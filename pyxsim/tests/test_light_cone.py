@@ -0,0 +1,147 @@
+from pyxsim.light_cone import LightCone
+from pyxsim.tests.utils import create_dummy_photons
+from pyxsim.light_curves import LightCurve
+from numpy.random import RandomState
+import numpy as np
+import tempfile
+import h5py
+import shutil
+import os
+
+def setup():
+    from yt.config import ytcfg
+    ytcfg["yt", "__withintesting"] = "True"
+
+def test_light_cone():
+
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    zranges = [(0.05, 0.1), (0.1, 0.2), (0.2, 0.3)]
+    slices = [("slice_%d" % i, zr) for i, zr in enumerate(zranges)]
+    nx = 256
+    lc = LightCone(slices, (20.0, "arcmin"), nx, cache_dir="photons")
+    assert np.allclose(lc.redshifts, [0.075, 0.15, 0.25])
+
+    # Photons which are already in the cache for the lowest redshift of each
+    # slice are used, so the datasets are never loaded
+    os.makedirs("photons")
+    prng = RandomState(47)
+    photons = []
+    for i, (zmin, zmax) in enumerate(zranges):
+        p = create_dummy_photons(prng, redshift=zmin)
+        p.write_h5_file(lc._cache_file(i))
+        with h5py.File(lc._cache_file(i), "r+") as f:
+            f.attrs["slice_fingerprint"] = lc._slice_fingerprint(i, None, None, None, None)
+        photons.append(p)
+    area = photons[0].parameters["FiducialArea"]
+    exp_time = photons[0].parameters["FiducialExposureTime"]
+    lc.make_photons(area, exp_time, None)
+
+    events = lc.project_photons("z", prng=RandomState(48))
+    assert np.isclose(float(events.parameters["dtheta"]), 20.0/60.0/nx)
+    assert np.all(events.parameters["pix_center"] == 0.5*(nx+1))
+    assert np.all((events["xpix"] >= 0.5) & (events["xpix"] < nx+0.5))
+    assert np.all((events["ypix"] >= 0.5) & (events["ypix"] < nx+0.5))
+
+    # The events of each slice are its photons projected to the redshift in
+    # the middle of the slice and mapped onto the pixels of the light cone
+    prng = RandomState(48)
+    x = []
+    e = []
+    t = []
+    for p, z in zip(photons, lc.redshifts):
+        ev = p.project_photons("z", redshift_new=z, sky_center=lc.sky_center.d,
+                               prng=prng)
+        scale = float(ev.parameters["dtheta"])/float(lc.dtheta)
+        xs = (ev["xpix"]-ev.parameters["pix_center"][0])*scale+0.5*(nx+1)
+        ys = (ev["ypix"]-ev.parameters["pix_center"][1])*scale+0.5*(nx+1)
+        inside = (xs >= 0.5) & (xs < nx+0.5) & (ys >= 0.5) & (ys < nx+0.5)
+        assert inside.sum() > 0
+        x.append(xs[inside])
+        e.append(ev["eobs"].d[inside])
+        t.append(ev["time"][inside])
+    assert np.all(events["xpix"] == np.concatenate(x))
+    assert np.all(events["eobs"].d == np.concatenate(e))
+    assert np.all(events["time"] == np.concatenate(t))
+    assert set(events.keys()) == set(["xpix", "ypix", "eobs", "time"])
+
+    # The light curve of each slice is passed on to its projection, and
+    # the times of the events of every slice are kept
+    exp_time = float(exp_time)
+    burst = LightCurve([0.0, 0.1*exp_time, 0.11*exp_time, exp_time], [1.0, 1.0, 0.0, 0.0])
+    events = lc.project_photons("z", prng=RandomState(48),
+                                light_curve=[burst, None, burst])
+    assert events["time"].size == events.num_events
+    n = [xs.size for xs in x]
+    t0, t1, t2 = np.split(events["time"], np.cumsum(n)[:-1])
+    assert t0.max() <= 0.11*exp_time and t2.max() <= 0.11*exp_time
+    assert t1.max() > 0.5*exp_time
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
+
+def test_cache_fingerprint():
+
+    from pyxsim import PowerLawSourceModel
+
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    le = np.array([0.0, 0.0, 0.0])
+    slices = [("slice_0", (0.05, 0.1), lambda ds: ds.box(le, 0.5-le)),
+              ("slice_1", (0.1, 0.2))]
+    lc = LightCone(slices, (20.0, "arcmin"), 256, cache_dir="photons")
+    os.makedirs("photons")
+
+    prng = RandomState(49)
+    model = PowerLawSourceModel(1.0, 0.1, 10.0, "hard_emission", 1.1, prng=prng)
+    params = {"foo": 1.0}
+    fingerprint = lc._slice_fingerprint(0, model, params, "c", None)
+    p = create_dummy_photons(prng, redshift=0.05)
+    p.write_h5_file(lc._cache_file(0))
+    area = p.parameters["FiducialArea"]
+    exp_time = p.parameters["FiducialExposureTime"]
+
+    # Photons without a fingerprint are never reused
+    assert not lc._is_cached(0, 0.05, area, exp_time, fingerprint)
+    with h5py.File(lc._cache_file(0), "r+") as f:
+        f.attrs["slice_fingerprint"] = fingerprint
+    assert lc._is_cached(0, 0.05, area, exp_time, fingerprint)
+
+    # The fingerprint is the same for an identical source model, and does
+    # not depend on the state set while generating photons
+    model2 = PowerLawSourceModel(1.0, 0.1, 10.0, "hard_emission", 1.1,
+                                 prng=RandomState(50))
+    model2.redshift = 0.05
+    assert lc._slice_fingerprint(0, model2, params.copy(), "c", None) == fingerprint
+
+    # A different source model, parameters, center, dataset, or region
+    # gives a different fingerprint
+    model3 = PowerLawSourceModel(1.0, 0.1, 10.0, "hard_emission", 1.2, prng=prng)
+    assert lc._slice_fingerprint(0, model3, params, "c", None) != fingerprint
+    assert lc._slice_fingerprint(0, model, {"foo": 2.0}, "c", None) != fingerprint
+    assert lc._slice_fingerprint(0, model, params, "max", None) != fingerprint
+    lc2 = LightCone([("slice_2",)+slices[0][1:], slices[1]], (20.0, "arcmin"), 256,
+                    cache_dir="photons")
+    assert lc2._slice_fingerprint(0, model, params, "c", None) != fingerprint
+    # The region is compared by its code and the values it refers to
+    le[0] = 0.1
+    assert lc._slice_fingerprint(0, model, params, "c", None) != fingerprint
+    le[0] = 0.0
+    lc3 = LightCone([(slices[0][0], slices[0][1], lambda ds: ds.box(le, 0.6-le)),
+                     slices[1]], (20.0, "arcmin"), 256, cache_dir="photons")
+    assert lc3._slice_fingerprint(0, model, params, "c", None) != fingerprint
+    lc4 = LightCone([(slices[0][0], slices[0][1], lambda ds: ds.box(le, 0.5-le)),
+                     slices[1]], (20.0, "arcmin"), 256, cache_dir="photons")
+    assert lc4._slice_fingerprint(0, model, params, "c", None) == fingerprint
+    assert lc._slice_fingerprint(1, model, params, "c", None) != fingerprint
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    test_light_cone()
+    test_cache_fingerprint()
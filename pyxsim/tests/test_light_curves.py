@@ -0,0 +1,99 @@
+from pyxsim.event_list import EventList
+from pyxsim.light_curves import LightCurve
+from pyxsim.tests.utils import create_dummy_wcs
+from numpy.random import RandomState
+import numpy as np
+import tempfile
+import shutil
+import os
+
+prng = RandomState(24)
+
+def setup():
+    from yt.config import ytcfg
+    ytcfg["yt", "__withintesting"] = "True"
+
+def test_light_curves():
+
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    exp_time = 100000.0
+    t = np.linspace(0.0, exp_time, 11)
+    rate = np.array([1.0, 3.0]*5+[1.0])
+    lc = LightCurve(t, rate)
+
+    times = lc.generate_times(1000000, exp_time, prng=prng)
+    assert times.min() >= 0.0 and times.max() <= exp_time
+
+    # The rate is linear between the nodes, so the expected fractions of the
+    # events in the halves of each segment are known exactly
+    edges = np.linspace(0.0, exp_time, 21)
+    counts = np.histogram(times, bins=edges)[0]
+    r = np.interp(edges, t, rate)
+    expected = 0.5*(r[1:]+r[:-1])
+    expected *= times.size/expected.sum()
+    assert np.all(np.abs(counts-expected) < 5.0*np.sqrt(expected))
+
+    wcs = create_dummy_wcs()
+    events = EventList.create_empty_list((exp_time, "s"), (1000., "cm**2"), wcs)
+    ebins = np.linspace(0.1, 10.0, 101)
+    spec = 1.0e-5*np.ones(100)
+    events = events.add_point_sources([(30.0, 45.0)], ebins, spec, prng=prng,
+                                      light_curve=lc)
+    events = events.add_background(ebins, spec, prng=prng)
+    assert events["time"].size == events.num_events
+
+    events.write_h5_file("lc_events.h5", single_precision=True)
+    new_events = EventList.from_h5_file("lc_events.h5")
+    assert np.all(new_events["time"] == events["time"])
+
+    events.write_light_curve("lc.fits", 1000.0, clobber=True)
+    new_lc = LightCurve.from_file("lc.fits")
+    assert new_lc.time.size == 100
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
+
+def test_constant_times():
+
+    from yt.utilities.on_demand_imports import _astropy
+
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    exp_time = 100000.0
+    wcs = create_dummy_wcs()
+    events = EventList.create_empty_list((exp_time, "s"), (1000., "cm**2"), wcs)
+    ebins = np.linspace(0.1, 10.0, 101)
+    spec = 1.0e-5*np.ones(100)
+
+    # Events from constant sources get uniform times when they are created,
+    # which are reproducible with the same prng
+    events1 = events.add_point_sources([(30.0, 45.0)], ebins, spec, prng=RandomState(25))
+    events1 = events1.add_background(ebins, spec, prng=RandomState(26))
+    events2 = events.add_point_sources([(30.0, 45.0)], ebins, spec, prng=RandomState(25))
+    events2 = events2.add_background(ebins, spec, prng=RandomState(26))
+    assert events1["time"].size == events1.num_events
+    assert np.all(events1["time"] == events2["time"])
+    assert events1["time"].min() >= 0.0 and events1["time"].max() <= exp_time
+    counts = np.histogram(events1["time"], bins=10, range=(0.0, exp_time))[0]
+    expected = events1.num_events/10.
+    assert np.all(np.abs(counts-expected) < 5.0*np.sqrt(expected))
+
+    # Writing the events only writes the times they already have, and does
+    # not draw any random numbers
+    state = np.random.get_state()
+    events1.write_fits_file("events.fits", clobber=True)
+    assert np.all(np.random.get_state()[1] == state[1])
+    time = _astropy.pyfits.getdata("events.fits", "EVENTS")["TIME"]
+    assert np.all(time == events1["time"])
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    test_light_curves()
+    test_constant_times()
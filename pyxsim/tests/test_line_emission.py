@@ -2,7 +2,7 @@ from pyxsim import \
     LineSourceModel, PhotonList
 from pyxsim.tests.utils import \
     BetaModelSource
-from yt.units.yt_array import YTQuantity, uconcatenate
+from yt.units.yt_array import YTQuantity
 import numpy as np
 import yt.units as u
 from yt.utilities.physical_constants import clight
@@ -42,7 +42,7 @@ def test_line_emission():
     dist_fac = 1.0/(4.*np.pi*D_A*D_A*(1.+redshift)**3)
     dm_E = (sphere["dm_emission"]).sum()
 
-    E = uconcatenate(photons["Energy"])
+    E = photons["Energy"].flat
     n_E = len(E)
 
     n_E_pred = (exp_time*A*dm_E*dist_fac).in_units("dimensionless")
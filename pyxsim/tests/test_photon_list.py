@@ -0,0 +1,416 @@
+from pyxsim.photon_list import PhotonList, _shard_filename
+from pyxsim.utils import merge_files, validate_parameters
+from pyxsim.tests.utils import create_dummy_photons
+from numpy.random import RandomState
+from yt.testing import requires_module
+from yt.units.yt_array import YTQuantity
+import numpy as np
+import tempfile
+import shutil
+import os
+import h5py
+import subprocess
+import sys
+
+prng = RandomState(32)
+
+def setup():
+    from yt.config import ytcfg
+    ytcfg["yt", "__withintesting"] = "True"
+
+def test_h5_layout():
+
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    photons = create_dummy_photons(prng)
+
+    photons.write_h5_file("photons.h5")
+    new_photons = PhotonList.from_file("photons.h5")
+    for k in photons.keys():
+        assert np.all(np.asarray(new_photons.photons[k]) == np.asarray(photons.photons[k]))
+    for k in ["FiducialExposureTime", "FiducialArea", "FiducialRedshift"]:
+        assert new_photons.parameters[k] == photons.parameters[k]
+
+    photons.write_h5_file("photons_sp.h5", compression="gzip", single_precision=True)
+    f = h5py.File("photons_sp.h5", "r")
+    assert f.attrs["version"] == 2
+    d = f["data"]
+    assert d["energy"].dtype == np.float32
+    assert d["num_photons"].dtype == np.int64
+    assert d["energy"].compression == "gzip"
+    assert d["energy"].chunks is not None
+    assert d["energy"].maxshape == (None,)
+    f.close()
+    new_photons = PhotonList.from_file("photons_sp.h5")
+    assert np.all(new_photons["NumberOfPhotons"] == photons["NumberOfPhotons"])
+    for k in ["x", "vz", "Energy"]:
+        assert np.all(np.asarray(new_photons.photons[k]) ==
+                      np.asarray(photons.photons[k]).astype("float32"))
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
+
+def test_merge_parameters():
+
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    photons1 = create_dummy_photons(prng)
+    photons2 = create_dummy_photons(prng)
+    photons2.parameters["FiducialExposureTime"] *= 2.0
+    photons1.write_h5_file("photons1.h5")
+    photons2.write_h5_file("photons2.h5")
+
+    # The merged exposure time is written under the key of the photon files
+    merge_files(["photons1.h5", "photons2.h5"], "merged.h5", add_exposure_times=True)
+    f = h5py.File("merged.h5", "r")
+    assert "exp_time" not in f["parameters"]
+    assert f["parameters"]["fid_exp_time"][()] == 3.0e5
+    f.close()
+    merged = PhotonList.from_file("merged.h5")
+    assert merged.parameters["FiducialExposureTime"] == \
+        photons1.parameters["FiducialExposureTime"]+photons2.parameters["FiducialExposureTime"]
+    assert merged["NumberOfPhotons"].sum() == \
+        photons1["NumberOfPhotons"].sum()+photons2["NumberOfPhotons"].sum()
+
+    # Otherwise, the exposure times must be the same
+    try:
+        merge_files(["photons1.h5", "photons2.h5"], "merged.h5", clobber=True)
+    except RuntimeError:
+        pass
+    else:
+        assert False
+    merge_files(["photons1.h5", "photons1.h5"], "merged.h5", clobber=True)
+    f = h5py.File("merged.h5", "r")
+    assert f["parameters"]["fid_exp_time"][()] == 1.0e5
+    f.close()
+
+    # The parameters of both inputs are compared, including their keys
+    first = {"fid_area": 1.0e4, "fid_exp_time": 1.0e5, "data_type": "cells"}
+    validate_parameters(first, first.copy())
+    for second in [{"fid_area": 1.0e4, "fid_exp_time": 1.0e5},
+                   {"fid_area": 2.0e4, "fid_exp_time": 1.0e5, "data_type": "cells"},
+                   {"fid_area": 1.0e4, "fid_exp_time": 1.0e5, "data_type": "particles"}]:
+        try:
+            validate_parameters(first, second)
+        except RuntimeError:
+            pass
+        else:
+            assert False
+    validate_parameters(first, {"fid_area": 1.0e4, "fid_exp_time": 2.0e5,
+                                "data_type": "cells"}, skip=["fid_exp_time"])
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
+
+def assert_same_photons(photons1, photons2):
+    for k in photons1.keys():
+        assert np.all(np.asarray(photons1.photons[k]) == np.asarray(photons2.photons[k]))
+
+def test_virtual_write():
+
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    # The shards and index which the processes write in parallel without
+    # MPI-enabled h5py, here with an empty shard from the second process
+    photons = [create_dummy_photons(prng) for i in range(3)]
+    sizes_c = [p.num_cells for p in photons]
+    sizes_p = [p["NumberOfPhotons"].sum() for p in photons]
+    sizes_c.insert(1, 0)
+    sizes_p.insert(1, 0)
+    for i, p in zip([0, 2, 3], photons):
+        p._write_h5_shard(_shard_filename("photons.h5", i), None, "float32")
+    photons[0]._write_h5_index("photons.h5", sizes_c, sizes_p, "float32")
+
+    all_photons = PhotonList.concatenate(photons)
+    all_photons.write_h5_file("serial.h5", single_precision=True)
+
+    new_photons = PhotonList.from_file("photons.h5")
+    assert new_photons.num_cells == sum(sizes_c)
+    assert_same_photons(new_photons, PhotonList.from_file("serial.h5"))
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
+
+mpi_script = """
+import sys
+import h5py
+if sys.argv[1] == "gather":
+    # Write as with versions of h5py without virtual datasets
+    del h5py.VirtualLayout
+import yt
+yt.enable_parallelism()
+from numpy.random import RandomState
+from pyxsim.tests.utils import create_dummy_photons
+from pyxsim.photon_list import comm
+photons = create_dummy_photons(RandomState(100+comm.rank))
+photons.write_h5_file(sys.argv[2])
+"""
+
+@requires_module("mpi4py")
+def test_parallel_write():
+
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    with open("write_photons.py", "w") as f:
+        f.write(mpi_script)
+
+    nprocs = 3
+    all_photons = PhotonList.concatenate([create_dummy_photons(RandomState(100+i))
+                                          for i in range(nprocs)])
+
+    for mode in ["virtual", "gather"]:
+        fn = "photons_%s.h5" % mode
+        try:
+            subprocess.check_call(["mpirun", "-np", str(nprocs), sys.executable,
+                                   "write_photons.py", mode, fn])
+        except OSError:
+            # No MPI launcher
+            break
+        assert_same_photons(PhotonList.from_file(fn), all_photons)
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
+
+def test_doppler_shift():
+
+    from pyxsim.cutils import doppler_shift
+    from yt.utilities.physical_constants import clight
+
+    photons = create_dummy_photons(prng)
+    num_photons = photons["NumberOfPhotons"]
+    energy = photons.photons["Energy"]
+    # A random subset of the photons, and the cells they belong to
+    idxs = np.sort(prng.choice(energy.size, size=energy.size//2, replace=False))
+    cells = np.searchsorted(np.cumsum(num_photons), idxs, side="right")
+    scale_factor = 1.0/1.05
+
+    n_hat = np.array([0.3, -0.5, 0.7])
+    for normal in [np.array([0.0, 0.0, 1.0]), n_hat/np.sqrt((n_hat**2).sum())]:
+        # The shifts computed from the full arrays with units
+        vz = photons.photons["vx"]*normal[0] + \
+             photons.photons["vy"]*normal[1] + \
+             photons.photons["vz"]*normal[2]
+        shift = -vz.in_cgs()/clight
+        shift = np.sqrt((1.-shift)/(1.+shift))
+        eobs_old = energy[idxs]*shift[cells]
+        eobs_old *= scale_factor
+
+        v_to_beta = float(photons.photons["vx"].uq.in_cgs()/clight)
+        eobs = np.empty(idxs.size)
+        doppler_shift(energy.d, idxs.astype("int64"), cells.astype("int64"),
+                      photons.photons["vx"].d, photons.photons["vy"].d,
+                      photons.photons["vz"].d, normal[0]*v_to_beta,
+                      normal[1]*v_to_beta, normal[2]*v_to_beta, scale_factor, eobs)
+        assert np.allclose(eobs, eobs_old.in_units("keV").d, rtol=1.0e-14, atol=0.0)
+
+def test_cell_energies():
+
+    photons = create_dummy_photons(prng)
+    energy = photons.photons["Energy"]
+    num_photons = photons["NumberOfPhotons"]
+    offsets = np.insert(np.cumsum(num_photons), 0, 0)
+
+    # The view is backed by the flat array of energies without copying it
+    energies = photons["Energy"]
+    assert len(energies) == photons.num_cells
+    assert np.shares_memory(energies.flat, energy)
+    assert np.all(energies.flat == energy)
+    assert np.all(energies.counts == num_photons)
+    for i in [0, 7, 500, photons.num_cells-1]:
+        e = energies[i]
+        assert np.shares_memory(e, energy) or e.size == 0
+        assert np.all(e == energy[offsets[i]:offsets[i+1]])
+    assert np.all(energies[-1] == energies[photons.num_cells-1])
+    assert np.all(np.concatenate([e.d for e in energies]) == energy.d)
+
+    # Slices of cells are views too, and reductions match per-cell loops,
+    # with NaN for the cells without photons
+    sub = energies[100:300]
+    assert len(sub) == 200
+    assert np.shares_memory(sub.flat, energy)
+    assert np.all(sub.flat == energy[offsets[100]:offsets[300]])
+    empty = num_photons[100:300] == 0
+    assert empty.any()
+    cells = [energy.d[offsets[i]:offsets[i+1]] for i in range(100, 300)]
+    assert np.allclose(sub.sum().d, [c.sum() for c in cells], rtol=1.0e-14)
+    assert str(sub.sum().units) == "keV"
+    for func in ["mean", "min", "max"]:
+        r = getattr(sub, func)().d
+        assert np.all(np.isnan(r[empty]))
+        assert np.allclose(r[~empty], [getattr(c, func)() for c in cells if c.size > 0],
+                           rtol=1.0e-14)
+    try:
+        energies[photons.num_cells]
+    except IndexError:
+        pass
+    else:
+        assert False
+
+def test_concatenate_select():
+
+    photons = [create_dummy_photons(prng) for i in range(3)]
+    # Fields in other units are converted to the units of the first list
+    for ax in "xyz":
+        photons[1].photons[ax].convert_to_units("Mpc")
+
+    all_photons = PhotonList.concatenate(photons)
+    added = photons[0]+photons[1]+photons[2]
+    assert all_photons.num_cells == sum(p.num_cells for p in photons)
+    for key in all_photons.keys():
+        assert np.all(all_photons.photons[key] == added.photons[key])
+    for key in ["NumberOfPhotons", "Energy", "vz"]:
+        assert np.all(all_photons.photons[key] ==
+                      np.concatenate([p.photons[key] for p in photons]))
+    assert str(all_photons.photons["x"].units) == "kpc"
+    assert np.allclose(all_photons.photons["x"].d,
+                       np.concatenate([p.photons["x"].in_units("kpc").d for p in photons]),
+                       rtol=1.0e-14)
+    assert np.all(all_photons["Energy"][photons[0].num_cells] == photons[1]["Energy"][0])
+
+    # Selected cells keep their photons, whether selected with a mask,
+    # indices, or a box
+    mask = np.asarray(all_photons["NumberOfPhotons"]) > 20
+    idxs = np.flatnonzero(mask)
+    le, re = np.array([-200.0, -300.0, -100.0]), np.array([250.0, 100.0, 300.0])
+    in_box = np.ones(all_photons.num_cells, dtype="bool")
+    for i, ax in enumerate("xyz"):
+        pos = all_photons.photons[ax].d
+        in_box &= (pos >= le[i]) & (pos < re[i])
+    for sel, orig in [(mask, idxs), (idxs[::-1], idxs[::-1]),
+                      ((le, re), np.flatnonzero(in_box))]:
+        sub = all_photons.select(sel)
+        assert sub.num_cells == orig.size
+        for key in ["x", "vy", "dx", "NumberOfPhotons"]:
+            assert np.all(sub.photons[key] == all_photons.photons[key][orig])
+        energies = all_photons["Energy"]
+        assert np.all(sub["Energy"].flat == np.concatenate([energies[i] for i in orig]))
+
+    # Splitting a list and adding the parts together again gives back the
+    # photons of all of the cells
+    parts = all_photons.select(mask)+all_photons.select(~mask)
+    order = np.concatenate([idxs, np.flatnonzero(~mask)])
+    assert np.all(parts.photons["x"] == all_photons.photons["x"][order])
+    assert np.all(parts["Energy"].flat == all_photons.select(order)["Energy"].flat)
+    assert parts["Energy"].flat.size == all_photons["Energy"].flat.size
+
+    # Lists with different parameters cannot be added together
+    other = create_dummy_photons(prng, redshift=0.1)
+    try:
+        photons[0]+other
+    except RuntimeError:
+        pass
+    else:
+        assert False
+
+def test_extend():
+
+    from pyxsim import PowerLawSourceModel
+    from pyxsim.tests.utils import BetaModelSource
+    from yt.units.yt_array import YTQuantity
+    from yt.utilities.physical_constants import mp
+
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    bms = BetaModelSource()
+    ds = bms.ds
+
+    def _hard_emission(field, data):
+        return YTQuantity(1.0e-18, "s**-1*keV**-1")*data["density"]*data["cell_volume"]/mp
+    ds.add_field(("gas", "hard_emission"), function=_hard_emission, units="keV**-1*s**-1")
+
+    sphere = ds.sphere("c", (100., "kpc"))
+    center = list(sphere.center.d)
+    plaw_model = PowerLawSourceModel(1.0, 0.01, 11.0, "hard_emission", 1.1, prng=prng)
+
+    area = YTQuantity(500., "cm**2")
+    exp_time = YTQuantity(1.0e4, "s")
+    redshift = 0.05
+
+    photons = PhotonList.from_data_source(sphere, redshift, area, exp_time, plaw_model,
+                                          center=center)
+    photons.write_h5_file("photons.h5")
+    n0 = photons["NumberOfPhotons"].sum()
+    num_cells0 = photons.num_cells
+    x0 = photons["x"].copy()
+    energy0 = photons["Energy"].flat.copy()
+
+    # A list with enough photons is not extended
+    photons.extend(sphere, plaw_model, exp_time_new=0.5*exp_time, center=center)
+    assert photons["NumberOfPhotons"].sum() == n0
+
+    # Extending the list to four times the exposure time gives as many
+    # photons as generating them for that exposure time at once
+    photons.extend(sphere, plaw_model, exp_time_new=4.0*exp_time, center=center,
+                   photonfile="photons.h5")
+    assert photons.parameters["FiducialExposureTime"] == 4.0*exp_time
+    # The new cells are appended to the original ones, which are unchanged
+    assert photons.num_cells == len(photons["x"]) > num_cells0
+    assert np.all(photons["x"][:num_cells0] == x0)
+    assert np.all(photons["Energy"].flat[:energy0.size] == energy0)
+    n = photons["NumberOfPhotons"].sum()
+    big = PhotonList.from_data_source(sphere, redshift, area, 4.0*exp_time, plaw_model,
+                                      center=center)
+    n_big = big["NumberOfPhotons"].sum()
+    assert np.abs(n-n_big) < 5.0*np.sqrt(2.0*n_big)
+    assert n > 3*n0
+
+    # The photons were also appended to the file
+    new_photons = PhotonList.from_file("photons.h5")
+    assert new_photons.parameters["FiducialExposureTime"] == 4.0*exp_time
+    assert np.all(new_photons["NumberOfPhotons"] == photons["NumberOfPhotons"])
+    assert np.all(new_photons["Energy"].flat == photons["Energy"].flat)
+
+    events = photons.project_photons("z", exp_time_new=4.0*exp_time, prng=prng)
+    events_big = big.project_photons("z", prng=prng)
+    assert np.abs(events.num_events-events_big.num_events) < \
+        5.0*np.sqrt(2.0*events_big.num_events)
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
+
+def test_photon_factor():
+
+    photons = create_dummy_photons(prng)
+    z0 = photons.parameters["FiducialRedshift"]
+    D_A0 = photons.parameters["FiducialAngularDiameterDistance"]
+
+    # Only a new distance, for a nearby source
+    fak, area, exp_time, zobs, D_A, scale_factor = \
+        photons._photon_factor(None, None, None, (10.0, "Mpc"))
+    assert zobs == 0.0
+    assert D_A == YTQuantity(10.0, "Mpc")
+    assert scale_factor == 1.0
+    assert np.isclose(fak, float((D_A0/D_A)**2*(1.+z0)**3), rtol=1.0e-12)
+
+    # Only a new redshift
+    fak, area, exp_time, zobs, D_A, scale_factor = \
+        photons._photon_factor(None, None, 0.1, None)
+    assert zobs == 0.1
+    assert np.isclose(scale_factor, (1.+z0)/1.1, rtol=1.0e-12)
+    assert np.isclose(fak, float((D_A0/D_A)**2*((1.+z0)/1.1)**3), rtol=1.0e-12)
+
+    # Nothing new
+    fak, area, exp_time, zobs, D_A, scale_factor = \
+        photons._photon_factor(None, None, None, None)
+    assert fak == 1.0 and zobs == z0 and scale_factor == 1.0
+
+if __name__ == "__main__":
+    test_h5_layout()
+    test_merge_parameters()
+    test_virtual_write()
+    test_parallel_write()
+    test_doppler_shift()
+    test_cell_energies()
+    test_concatenate_select()
+    test_extend()
+    test_photon_factor()
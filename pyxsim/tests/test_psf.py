@@ -0,0 +1,75 @@
+from pyxsim.responses import TabulatedPSF, GaussianPSF
+from pyxsim.instruments import InstrumentSimulator
+from numpy.random import RandomState
+import numpy as np
+import tempfile
+import shutil
+import os
+import h5py
+
+prng = RandomState(25)
+
+def setup():
+    from yt.config import ytcfg
+    ytcfg["yt", "__withintesting"] = "True"
+
+def test_tabulated_psf():
+
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    energy = np.array([1.0, 5.0])
+    theta = np.array([0.0, 5.0, 10.0])
+    pixel_scale = 1.0e-4
+    nx = 128
+    x, y = np.mgrid[0:nx,0:nx]+0.5-0.5*nx
+    fwhm = np.array([[4.0, 8.0, 12.0], [6.0, 10.0, 16.0]])*pixel_scale
+    images = np.zeros((2, 3, nx, nx))
+    for i in range(2):
+        for j in range(3):
+            sigma = fwhm[i,j]/pixel_scale/2.35482
+            images[i,j] = np.exp(-0.5*(x*x+y*y)/(sigma*sigma))
+
+    f = h5py.File("psf.h5", "w")
+    f.create_dataset("energy", data=energy)
+    f.create_dataset("theta", data=theta)
+    f.create_dataset("images", data=images)
+    f.create_dataset("pixel_scale", data=pixel_scale)
+    f.close()
+
+    psf = TabulatedPSF("psf.h5")
+
+    n = 200000
+    for i, e in enumerate(energy):
+        for j, t in enumerate(theta):
+            dx, dy = psf.generate_offsets(e*np.ones(n), t*np.ones(n), prng=prng)
+            # Account for the finite pixel size of the image in the variance
+            width = np.sqrt(0.5*(dx.var()+dy.var())-pixel_scale**2/6.)*2.35482
+            assert np.abs(width-fwhm[i,j])/fwhm[i,j] < 0.02
+            assert np.abs(dx.mean()) < 0.05*fwhm[i,j]
+
+    # Events between grid points should be assigned to the nearest image
+    dx, dy = psf.generate_offsets(1.5*np.ones(n), 1.0*np.ones(n), prng=prng)
+    width = np.sqrt(0.5*(dx.var()+dy.var())-pixel_scale**2/6.)*2.35482
+    assert np.abs(width-fwhm[0,0])/fwhm[0,0] < 0.02
+
+    gpsf = GaussianPSF(fwhm[0,0])
+    dx, dy = gpsf.generate_offsets(np.ones(n), np.zeros(n), prng=prng)
+    assert np.abs(dx.std()*2.35482-fwhm[0,0])/fwhm[0,0] < 0.01
+
+    # The PSF may be a numpy scalar, and the FWHM is available for all PSFs
+    inst = InstrumentSimulator(pixel_scale, 128, np.float32(fwhm[0,0]),
+                               "aciss_aimpt_cy18.arf", "aciss_aimpt_cy18.rmf")
+    assert isinstance(inst.psf, GaussianPSF)
+    assert np.abs(inst.psf_scale-fwhm[0,0])/fwhm[0,0] < 1.0e-6
+    inst = InstrumentSimulator(pixel_scale, 128, psf,
+                               "aciss_aimpt_cy18.arf", "aciss_aimpt_cy18.rmf")
+    # The image is only sampled with a few pixels across the FWHM
+    assert np.abs(inst.psf_scale-fwhm[0,0])/fwhm[0,0] < 0.1
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    test_tabulated_psf()
@@ -0,0 +1,160 @@
+from pyxsim.event_list import EventList
+from pyxsim.regions import Region, CircleRegion, AnnulusRegion, BoxRegion, \
+    EllipseRegion, PolygonRegion, parse_ds9_region, UnsupportedRegion
+from pyxsim.instruments import InstrumentSimulator
+from pyxsim.tests.utils import create_dummy_wcs
+from numpy.random import RandomState
+import numpy as np
+import tempfile
+import shutil
+import os
+
+prng = RandomState(25)
+
+def setup():
+    from yt.config import ytcfg
+    ytcfg["yt", "__withintesting"] = "True"
+
+def test_regions():
+
+    wcs = create_dummy_wcs()
+
+    events = EventList.create_empty_list((100., "ks"), (1000., "cm**2"), wcs)
+    ebins = np.linspace(0.1, 10.0, 101)
+    spec = 1.0e-6*np.ones(100)
+    events = events.add_background(ebins, spec, prng=prng)
+
+    x = events["xpix"]
+    y = events["ypix"]
+
+    cx, cy = 400.0, 600.0
+
+    regions = [(CircleRegion(cx, cy, 50.0),
+                (x-cx)**2+(y-cy)**2 <= 2500.0),
+               (AnnulusRegion(cx, cy, 50.0, 100.0),
+                ((x-cx)**2+(y-cy)**2 >= 2500.0) & ((x-cx)**2+(y-cy)**2 < 10000.0)),
+               (BoxRegion(cx, cy, 100.0, 40.0, angle=90.0),
+                (np.abs(x-cx) <= 20.0) & (np.abs(y-cy) <= 50.0)),
+               (EllipseRegion(cx, cy, 100.0, 40.0),
+                ((x-cx)/100.0)**2+((y-cy)/40.0)**2 <= 1.0),
+               (PolygonRegion([cx-50., cx+50., cx+50., cx-50.], [cy-50., cy-50., cy+50., cy+50.]),
+                (np.abs(x-cx) < 50.0) & (np.abs(y-cy) < 50.0))]
+
+    for reg, mask in regions:
+        assert np.all(events.region_indices(reg) == np.where(mask)[0])
+        assert np.all(events.region_indices(~reg) == np.where(~mask)[0])
+
+    circle, cmask = regions[0]
+    box, bmask = regions[2]
+    assert np.all(events.region_indices(circle & ~box) == np.where(cmask & ~bmask)[0])
+    assert np.all(events.region_indices(circle | box) == np.where(cmask | bmask)[0])
+
+    ds9_reg = "# Region file format: DS9\nimage\ncircle(%g,%g,50)\n-box(%g,%g,40,100,0)" % (cx, cy, cx, cy)
+    new_events = events.filter_events(ds9_reg)
+    assert new_events.num_events == (cmask & ~bmask).sum()
+
+    ra, dec = wcs.wcs_pix2world(cx, cy, 1)
+    r = 50.0*wcs.wcs.cdelt[1]*3600.0
+    sky_reg = parse_ds9_region('fk5;circle(%.10f,%.10f,%.10f")' % (ra, dec, r), wcs)
+    assert np.all(events.region_indices(sky_reg) == np.where(cmask)[0])
+
+    # Shapes and coordinate systems which are not supported are left to pyregion
+    for reg in ["galactic;circle(100.0,20.0,0.1)", "image;point(400,600)"]:
+        try:
+            parse_ds9_region(reg, wcs)
+        except UnsupportedRegion:
+            pass
+        else:
+            assert False
+
+    try:
+        Region()
+    except TypeError:
+        pass
+    else:
+        assert False
+
+def test_region_index():
+
+    wcs = create_dummy_wcs()
+
+    events = EventList.create_empty_list((100., "ks"), (1000., "cm**2"), wcs)
+    ebins = np.linspace(0.1, 10.0, 101)
+    spec = 1.0e-6*np.ones(100)
+    events = events.add_background(ebins, spec, prng=prng)
+    events.parameters["dtheta"] = abs(events.parameters["dtheta"])
+
+    circle = CircleRegion(400.0, 600.0, 50.0)
+
+    def check(events):
+        x = events["xpix"]
+        y = events["ypix"]
+        mask = (x-400.0)**2+(y-600.0)**2 <= 2500.0
+        assert np.all(events.region_indices(circle) == np.where(mask)[0])
+
+    # The spatial index is built by the first region
+    check(events)
+    assert events._index is not None
+
+    # An instrument simulation makes a new event list, but the energy
+    # convolution also sorts the events of an event list in place, after
+    # which the index must be rebuilt
+    inst = InstrumentSimulator(0.001, 1024, 0.001, "aciss_aimpt_cy18.arf",
+                               "aciss_aimpt_cy18.rmf")
+    check(inst(events, prng=prng))
+    inst.convolve_energies(events, prng)
+    assert events._index is None
+    check(events)
+
+def test_region_spectra():
+
+    from yt.utilities.on_demand_imports import _astropy
+
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    wcs = create_dummy_wcs()
+
+    events = EventList.create_empty_list((100., "ks"), (1000., "cm**2"), wcs)
+    ebins = np.linspace(0.1, 10.0, 101)
+    spec = 1.0e-6*np.ones(100)
+    events = events.add_background(ebins, spec, prng=prng)
+
+    events.write_spectrum("spec.pi", bin_type="energy", clobber=True)
+    counts = _astropy.pyfits.getdata("spec.pi", "SPECTRUM")["COUNTS"]
+
+    # A ds9 region file which does not have the .reg extension, and its
+    # complement, together contain all of the events
+    with open("circle.txt", "w") as f:
+        f.write("image\ncircle(400,600,100)\n")
+    circle = parse_ds9_region("circle.txt", wcs)
+    events.write_region_spectra("two_spec.pi", ["circle.txt", ~circle],
+                                bin_type="energy", clobber=True)
+    f = _astropy.pyfits.open("two_spec.pi")
+    spec1 = f[1].data["COUNTS"]
+    spec2 = f[2].data["COUNTS"]
+    f.close()
+    assert spec1.sum() == events.region_indices(circle).size
+    assert np.all(spec1+spec2 == counts)
+
+    # A label map in a FITS file, which is detected without a FITS extension
+    label_map = np.ones((64, 64), dtype="int32")
+    label_map[:,32:] = 2
+    _astropy.pyfits.PrimaryHDU(label_map).writeto("labels.img")
+    events.write_region_spectra("label_spec.pi", "labels.img", bin_type="energy",
+                                clobber=True)
+    f = _astropy.pyfits.open("label_spec.pi")
+    spec1 = f[1].data["COUNTS"]
+    spec2 = f[2].data["COUNTS"]
+    f.close()
+    assert spec1.sum() == (events["xpix"] < 512.5).sum()
+    assert np.all(spec1+spec2 == counts)
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    test_regions()
+    test_region_index()
+    test_region_spectra()
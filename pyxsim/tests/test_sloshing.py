@@ -10,7 +10,6 @@ from yt.utilities.answer_testing.framework import requires_ds, \
     GenericArrayTest, data_dir_load
 from numpy.testing import assert_array_equal
 from numpy.random import RandomState
-from yt.units.yt_array import uconcatenate
 import os
 import tempfile
 import shutil
@@ -84,8 +83,8 @@ def test_sloshing():
 
     for k in photons1.keys():
         if k == "Energy":
-            arr1 = uconcatenate(photons1[k])
-            arr2 = uconcatenate(photons2[k])
+            arr1 = photons1[k].flat
+            arr2 = photons2[k].flat
         else:
             arr1 = photons1[k]
             arr2 = photons2[k]
@@ -0,0 +1,130 @@
+from pyxsim.event_list import EventList, _power_law_integral
+from yt.units.yt_array import YTQuantity
+from pyxsim.tests.utils import create_dummy_wcs
+from numpy.random import RandomState
+import numpy as np
+
+prng = RandomState(37)
+
+def setup():
+    from yt.config import ytcfg
+    ytcfg["yt", "__withintesting"] = "True"
+
+def source_indices(events, ra, dec):
+    # The index of the source of each event, which is identified by the
+    # pixel coordinates of the sources
+    xsrc, ysrc = events.wcs.wcs_world2pix(ra, dec, 1)
+    order = np.argsort(xsrc)
+    idxs = np.searchsorted(xsrc[order], events["xpix"])
+    assert np.all(xsrc[order][idxs] == events["xpix"])
+    return order[idxs]
+
+def source_counts(events, ra, dec):
+    # The number of events from each source
+    return np.bincount(source_indices(events, ra, dec), minlength=ra.size)
+
+def test_point_source_catalog():
+
+    wcs = create_dummy_wcs()
+    events = EventList.create_empty_list((100., "ks"), (1000., "cm**2"), wcs)
+    exposure = 1.0e8
+
+    num_sources = 400
+    ra = 30.0+np.linspace(-0.2, 0.2, num_sources)
+    dec = 45.0+prng.uniform(-0.2, 0.2, num_sources)
+    fluxes = 10**prng.uniform(-7.0, -5.0, num_sources)
+
+    ebins = np.linspace(0.1, 10.0, 100)
+    emid = 0.5*(ebins[1:]+ebins[:-1])
+    spec = emid**-1.5
+
+    # The numbers of events from the sources are Poisson-distributed
+    # about the expected numbers from their fluxes
+    new_events = events.add_point_source_catalog(ra, dec, ebins, spec, fluxes=fluxes,
+                                                 prng=prng)
+    counts = source_counts(new_events, ra, dec)
+    mu = exposure*fluxes
+    assert np.abs(counts.sum()-mu.sum()) < 5.0*np.sqrt(mu.sum())
+    chi2 = ((counts-mu)**2/mu).sum()
+    assert np.abs(chi2-num_sources) < 5.0*np.sqrt(2.0*num_sources)
+
+    # The energies of the events follow the shared spectral shape
+    hist = np.histogram(new_events["eobs"].d, bins=ebins)[0]
+    expected = counts.sum()*spec/spec.sum()
+    chi2 = ((hist-expected)**2/expected).sum()
+    assert np.abs(chi2-emid.size) < 5.0*np.sqrt(2.0*emid.size)
+
+    # With a spectrum for each source, the events of each source are drawn
+    # from its own spectrum and the fluxes are the sums of the spectra
+    spectra = np.zeros((num_sources, emid.size))
+    low = np.arange(num_sources) % 2 == 0
+    spectra[low,:10] = fluxes[low,np.newaxis]/10.
+    spectra[~low,-10:] = fluxes[~low,np.newaxis]/10.
+    new_events = events.add_point_source_catalog(ra, dec, ebins, spectra, prng=prng)
+    counts = source_counts(new_events, ra, dec)
+    chi2 = ((counts-mu)**2/mu).sum()
+    assert np.abs(chi2-num_sources) < 5.0*np.sqrt(2.0*num_sources)
+    from_low = low[source_indices(new_events, ra, dec)]
+    assert np.all(new_events["eobs"].d[from_low] <= ebins[10])
+    assert np.all(new_events["eobs"].d[~from_low] >= ebins[-11])
+
+    # A single source at a list of positions is the same as a catalog
+    new_events = events.add_point_sources([(ra[0], dec[0])], ebins, spectra[0],
+                                          prng=RandomState(40))
+    cat_events = events.add_point_source_catalog(ra[:1], dec[:1], ebins, spectra[:1],
+                                                 prng=RandomState(40))
+    assert np.all(new_events["eobs"] == cat_events["eobs"])
+
+def test_point_source_population():
+
+    wcs = create_dummy_wcs()
+    events = EventList.create_empty_list((100., "ks"), (1000., "cm**2"), wcs)
+    exposure = 1.0e8
+
+    smin, smax = 1.0e-17, 1.0e-12
+    norm = 1.5e16
+    sb = 1.0e-14
+    slopes = (1.6, 2.5)
+    new_events, sources = events.add_point_source_population(flux_limits=(smin, smax),
+                                                             flux_norm=norm, flux_break=sb,
+                                                             slopes=slopes, prng=prng,
+                                                             return_sources=True)
+    flux = sources["flux"].d
+    assert flux.min() >= smin and flux.max() <= smax
+
+    # The number of sources over the field of view is Poisson-distributed
+    # about the integral of the logN-logS
+    solid_angle = (1024*0.001)**2
+    def num_below(s):
+        s = np.asarray(s, dtype="float64")
+        n = _power_law_integral(smin/sb, np.minimum(s, sb)/sb, slopes[0])
+        n += np.where(s > sb, _power_law_integral(1.0, np.maximum(s, sb)/sb, slopes[1]), 0.0)
+        return solid_angle*norm*sb*n
+    num_sources = num_below(smax)
+    assert np.abs(flux.size-num_sources) < 5.0*np.sqrt(num_sources)
+
+    # The fluxes follow the logN-logS, which we check with the
+    # Kolmogorov-Smirnov statistic against its cumulative distribution
+    s = np.sort(flux)
+    cdf = num_below(s)/num_sources
+    n = np.arange(1, s.size+1)
+    ks = max((n/float(s.size)-cdf).max(), (cdf-(n-1)/float(s.size)).max())
+    assert ks < 1.63/np.sqrt(s.size)
+
+    # The photon indices are normally distributed
+    gamma = sources["photon_index"]
+    assert np.abs(gamma.mean()-1.9) < 5.0*0.2/np.sqrt(gamma.size)
+    assert np.abs(gamma.std()-0.2) < 0.01
+
+    # The number of events is Poisson-distributed about the expected number
+    # from the energy fluxes in the flux band converted to photon fluxes
+    e_flux = _power_law_integral(0.5, 2.0, gamma-1.)*YTQuantity(1.0, "keV").in_units("erg").v
+    p_flux = _power_law_integral(0.1, 10.0, gamma)
+    mu = exposure*(flux*p_flux/e_flux).sum()
+    assert np.abs(new_events.num_events-mu) < 5.0*np.sqrt(mu)
+    assert new_events["eobs"].d.min() >= 0.1
+    assert new_events["eobs"].d.max() <= 10.0
+
+if __name__ == "__main__":
+    test_point_source_catalog()
+    test_point_source_population()
@@ -111,3 +111,29 @@ def create_dummy_wcs():
     wcs.wcs.ctype = ["RA---TAN","DEC--TAN"]
     wcs.wcs.cunit = ["deg"]*2
     return wcs
+
+def create_dummy_photons(prng, num_cells=1000, redshift=0.05):
+    from yt.units.yt_array import YTArray, YTQuantity
+    from yt.utilities.cosmology import Cosmology
+    from pyxsim.photon_list import PhotonList
+    cosmo = Cosmology()
+    num_photons = prng.poisson(lam=20.0, size=num_cells)
+    num_photons[::7] = 0
+    photons = {"NumberOfPhotons": num_photons,
+               "Energy": YTArray(prng.uniform(0.1, 10.0, num_photons.sum()), "keV"),
+               "dx": YTArray(np.ones(num_cells), "kpc")}
+    for ax in "xyz":
+        photons[ax] = YTArray(prng.uniform(-500.0, 500.0, num_cells), "kpc")
+        photons["v"+ax] = YTArray(prng.normal(scale=300.0, size=num_cells), "km/s")
+    parameters = {"FiducialExposureTime": YTQuantity(1.0e5, "s"),
+                  "FiducialArea": YTQuantity(1.0e4, "cm**2"),
+                  "FiducialRedshift": redshift,
+                  "FiducialAngularDiameterDistance":
+                      cosmo.angular_diameter_distance(0.0, redshift).in_units("Mpc"),
+                  "Dimension": np.array([64]*3),
+                  "Width": YTArray([1000.0]*3, "kpc"),
+                  "HubbleConstant": cosmo.hubble_constant,
+                  "OmegaMatter": cosmo.omega_matter,
+                  "OmegaLambda": cosmo.omega_lambda,
+                  "DataType": "cells"}
+    return PhotonList(photons, parameters, cosmo)
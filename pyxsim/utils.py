@@ -2,7 +2,6 @@ import numpy as np
 from yt.funcs import iterable
 from yt.units.yt_array import YTQuantity
 from six import string_types
-from collections import defaultdict
 import h5py
 import os
 import sys
@@ -61,9 +60,80 @@ def parse_value(value, default_units, ds=None):
     else:
         return quan(value, default_units)
 
+# Version 1 files have unchunked, uncompressed datasets and no version
+# attribute. Version 2 files have chunked, resizable datasets, which may be
+# compressed or stored in single precision, and no derivable columns.
+h5_file_version = 2
+h5_chunk_size = 262144
+
+def create_h5_dataset(group, name, data, compression=None, dtype=None):
+    """
+    Create a chunked, resizable one-dimensional dataset *name* in the HDF5
+    *group* from the array *data*, optionally compressed with the "gzip"
+    or "lzf" filter (with byte shuffling) and converted to *dtype*. If
+    *data* is an integer, an empty dataset of that size is created instead,
+    which requires *dtype*.
+    """
+    if isinstance(data, (int, np.integer)):
+        size = int(data)
+        kwargs = {"shape": (size,)}
+    else:
+        data = np.asarray(data)
+        size = data.shape[0]
+        kwargs = {"data": data}
+    if compression is not None:
+        if compression not in ["gzip", "lzf"]:
+            raise ValueError("Compression must be 'gzip', 'lzf', or None, not '%s'!" % compression)
+        kwargs["compression"] = compression
+        kwargs["shuffle"] = True
+    chunk = max(1, min(size, h5_chunk_size))
+    return group.create_dataset(name, dtype=dtype, chunks=(chunk,),
+                                maxshape=(None,), **kwargs)
+
+# A sharded file set is a directory of HDF5 shard files, each with a "data"
+# group, and a manifest file with the parameters, the shard file names
+# (relative to the directory), and the sizes and offsets of each shard
+manifest_filename = "manifest.h5"
+shard_counts = {"num_cells": "cell_offsets",
+                "num_photons": "photon_offsets",
+                "num_events": "event_offsets"}
+
+def shard_filename(i):
+    return "shard_%04d.h5" % i
+
+def write_manifest(f, shard_files, counts):
+    """
+    Write the list of *shard_files* and the dictionary of per-shard *counts*
+    (e.g. "num_photons") to the "shards" group of the open manifest file
+    *f*, along with the cumulative offsets of each shard.
+    """
+    s = f.create_group("shards")
+    s.create_dataset("filenames", data=np.array(shard_files, dtype="S"))
+    for key, sizes in counts.items():
+        sizes = np.array(sizes, dtype="int64")
+        s.create_dataset(key, data=sizes)
+        s.create_dataset(shard_counts[key], data=np.cumsum(sizes)-sizes)
+
+def read_manifest(dirname):
+    """
+    Open the manifest of the sharded file set in *dirname*. Returns the
+    open file and a list of the shards, each a dictionary with the path to
+    the shard file and its counts.
+    """
+    f = h5py.File(os.path.join(dirname, manifest_filename), "r")
+    s = f["shards"]
+    shards = []
+    for i, fn in enumerate(s["filenames"][:]):
+        shard = {"filename": os.path.join(dirname, force_unicode(fn))}
+        for key in shard_counts:
+            if key in s:
+                shard[key] = int(s[key][i])
+        shards.append(shard)
+    return f, shards
+
 def validate_parameters(first, second, skip=[]):
     keys1 = list(first.keys())
-    keys2 = list(first.keys())
+    keys2 = list(second.keys())
     keys1.sort()
     keys2.sort()
     if keys1 != keys2:
@@ -88,9 +158,10 @@ def merge_files(input_files, output_file, clobber=False,
     Parameters
     ----------
     input_files : list of strings
-        List of filenames that will be merged together.
+        List of filenames or directories of sharded file sets that will be
+        merged together.
     output_file : string
-        Name of the merged file to be outputted.
+        Name of the merged file (or directory) to be outputted.
     clobber : boolean, default False
         If a the output file already exists, set this to True to
         overwrite it.
@@ -109,47 +180,141 @@ def merge_files(input_files, output_file, clobber=False,
     Currently, to merge files it is mandated that all of the parameters have the
     same values, with the exception of the exposure time parameter "exp_time". If
     add_exposure_times=False, the maximum exposure time will be used.
+
+    The merged datasets are copied from the input files block by block, so the
+    files are never read into memory in their entirety. If the inputs are all
+    sharded file sets (directories), *output_file* is a directory in which only
+    a new manifest is written, which refers to the shards of all of the inputs.
+    Sharded file sets and single files cannot be merged together.
     """
+    is_dir = [os.path.isdir(fn) for fn in input_files]
+    if all(is_dir):
+        _merge_manifests(input_files, output_file, clobber, add_exposure_times)
+        return
+    elif any(is_dir):
+        raise ValueError("Cannot merge sharded file sets (%s) " %
+                         ", ".join([fn for fn, d in zip(input_files, is_dir) if d]) +
+                         "with single files (%s)! " %
+                         ", ".join([fn for fn, d in zip(input_files, is_dir) if not d]) +
+                         "The inputs must be either all directories or all files.")
+
     if os.path.exists(output_file) and not clobber:
         raise IOError("Cannot overwrite existing file %s. " % output_file +
                       "If you want to do this, set clobber=True.")
 
-    f_in = h5py.File(input_files[0], "r")
+    f_in = [h5py.File(fn, "r") for fn in input_files]
+
+    exp_time_key, tot_exp_time = _merge_parameters(f_in, add_exposure_times)
+
+    # Older event files store the derivable sky coordinates, which we skip
+    keys = [k for k in f_in[0]["data"] if k not in ["xsky", "ysky"]]
+    for fn, f in zip(input_files, f_in):
+        if set(k for k in f["data"] if k not in ["xsky", "ysky"]) != set(keys):
+            raise RuntimeError("The file %s does not have the same datasets " % fn +
+                               "as the file %s!" % input_files[0])
+        if "num_photons" in keys:
+            d = f["data"]
+            n = d["num_photons"].shape[0]
+            num_photons = sum([d["num_photons"][i0:i0+h5_chunk_size].sum()
+                               for i0 in range(0, n, h5_chunk_size)])
+            if num_photons != d["energy"].shape[0]:
+                raise RuntimeError("The number of photons in the file %s does " % fn +
+                                   "not match the number of photon energies!")
+
     f_out = h5py.File(output_file, "w")
+    f_out.attrs["version"] = h5_file_version
 
-    exp_time_key = ""
     p_out = f_out.create_group("parameters")
-    for key, param in f_in["parameters"].items():
-        if key.endswith("exp_time"):
-            exp_time_key = key
+    for key, param in f_in[0]["parameters"].items():
+        if key == exp_time_key:
+            p_out[key] = tot_exp_time
         else:
             p_out[key] = param.value
 
-    skip = [exp_time_key] if add_exposure_times else []
-    for fn in input_files[1:]:
-        f = h5py.File(fn, "r")
-        validate_parameters(f_in["parameters"], f["parameters"], skip=skip)
+    # The output datasets are allocated from the total sizes of the input
+    # datasets and filled in block by block, so that only one block at a
+    # time is held in memory
+    d_out = f_out.create_group("data")
+    for key in keys:
+        dsets = [f["data"][key] for f in f_in]
+        size = sum([dset.shape[0] for dset in dsets])
+        dtype = np.result_type(*[dset.dtype for dset in dsets])
+        compression = dsets[0].compression
+        if compression not in ["gzip", "lzf"]:
+            compression = None
+        dset_out = create_h5_dataset(d_out, key, size, compression=compression,
+                                     dtype=dtype)
+        start = 0
+        for dset in dsets:
+            n = dset.shape[0]
+            for i0 in range(0, n, h5_chunk_size):
+                i1 = min(i0+h5_chunk_size, n)
+                dset_out[start+i0:start+i1] = dset[i0:i1]
+            start += n
+
+    f_out.close()
+    for f in f_in:
         f.close()
 
-    f_in.close()
+def _merge_manifests(input_dirs, output_dir, clobber, add_exposure_times):
+    # Merging sharded file sets only requires a new manifest which refers
+    # to all of the shards, so no data is copied
+    output_manifest = os.path.join(output_dir, manifest_filename)
+    if os.path.exists(output_manifest) and not clobber:
+        raise IOError("Cannot overwrite existing file %s. " % output_manifest +
+                      "If you want to do this, set clobber=True.")
+
+    manifests = [read_manifest(dirname) for dirname in input_dirs]
+    f_in = [f for f, shards in manifests]
+
+    exp_time_key, tot_exp_time = _merge_parameters(f_in, add_exposure_times)
 
-    data = defaultdict(list)
-    tot_exp_time = 0.0
+    keys = [k for k in shard_counts if k in f_in[0]["shards"]]
+    shard_files = []
+    counts = dict((k, []) for k in keys)
+    for dirname, (f, shards) in zip(input_dirs, manifests):
+        if set(k for k in shard_counts if k in f["shards"]) != set(keys):
+            raise RuntimeError("The file set %s does not have the same type " % dirname +
+                               "as the file set %s!" % input_dirs[0])
+        for shard in shards:
+            shard_files.append(os.path.relpath(shard["filename"], output_dir))
+            for k in keys:
+                counts[k].append(shard[k])
 
-    for i, fn in enumerate(input_files):
-        f = h5py.File(fn, "r")
-        if add_exposure_times:
-            tot_exp_time += f["/parameters"][exp_time_key].value
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    f_out = h5py.File(output_manifest, "w")
+    f_out.attrs["version"] = h5_file_version
+    p_out = f_out.create_group("parameters")
+    for key, param in f_in[0]["parameters"].items():
+        if key == exp_time_key:
+            p_out[key] = tot_exp_time
         else:
-            tot_exp_time = max(tot_exp_time, f["/parameters"][exp_time_key].value)
-        for key in f["/data"]:
-            data[key].append(f["/data"][key][:])
+            p_out[key] = param.value
+    write_manifest(f_out, shard_files, counts)
+    f_out.close()
+
+    for f in f_in:
         f.close()
 
-    p_out["exp_time"] = tot_exp_time
+def _merge_parameters(f_in, add_exposure_times):
+    params = [_read_h5_parameters(f["parameters"]) for f in f_in]
 
-    d = f_out.create_group("data")
-    for k in data:
-        d.create_dataset(k, data=np.concatenate(data[k]))
+    exp_time_key = ""
+    for key in params[0]:
+        if key.endswith("exp_time"):
+            exp_time_key = key
 
-    f_out.close()
+    skip = [exp_time_key] if add_exposure_times else []
+    for p in params[1:]:
+        validate_parameters(params[0], p, skip=skip)
+
+    if add_exposure_times:
+        tot_exp_time = sum([p[exp_time_key] for p in params])
+    else:
+        tot_exp_time = max([p[exp_time_key] for p in params])
+
+    return exp_time_key, tot_exp_time
+
+def _read_h5_parameters(p):
+    return dict((k, force_unicode(v[()])) for k, v in p.items())